@@ -5,36 +5,18 @@ It also includes functionality to post responses to a webhook for further proces
 
 import json
 import logging
-import os
-import time
-
-import dotenv
-import openai
-from openai import OpenAI
 
+import config
+from assistant_output import parse_or_reask, thread_reask
+from assistant_runs import run_assistant
+from assistant_sessions import sessions
 from post_to_webhook import post_to_webhook
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Load environment variables
-dotenv.load_dotenv()
-
-
-# Load API key and initialize OpenAI client
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-client = OpenAI()
-
-# Define assistant IDs
-assistant_id = os.getenv("STORY_ASSISTANT_ID")
 
-# Create a new thread for communication with the assistant
-threadResponse = openai.beta.threads.create()
-thread = threadResponse
-
-
-def generate_story(story_configuration):
+async def generate_story(story_configuration):
     """
     Generates a story based on the provided story configuration using OpenAI's API.
 
@@ -50,44 +32,43 @@ def generate_story(story_configuration):
     post_to_webhook(f"Input story configuration: {story_configuration}")
 
     try:
-        # Add user input as a message to the thread
-        client.beta.threads.messages.create(
-            thread_id=thread.id, role="user", content=user_input
-        )
-
-        # Run the assistant and wait for completion
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id, assistant_id=assistant_id
-        )
-        while True:
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread.id, run_id=run.id
+        client = config.openai_client()
+        assistant_id = config.get("STORY_ASSISTANT_ID")
+        # Run the assistant in a thread of its own and wait for completion
+        async with sessions.session() as thread_id:
+            # Add user input as a message to the thread
+            await client.beta.threads.messages.create(
+                thread_id=thread_id, role="user", content=user_input
             )
-            if run_status.status == "completed":
-                break
-            time.sleep(1)
 
-        # Retrieve the assistant's response
-        messages = client.beta.threads.messages.list(thread_id=thread.id).data
-        post_to_webhook(f"Story generation Response RAW: {messages}")
-        story_response = next(
-            (
-                m.content[0].text.value
-                for m in messages
-                if m.role == "assistant" and m.content
-            ),
-            None,
-        )
+            run = await run_assistant(client, thread_id, assistant_id)
+            sessions.record_usage(thread_id, run.usage)
+
+            # Retrieve the assistant's response
+            messages = (
+                await client.beta.threads.messages.list(thread_id=thread_id)
+            ).data
+            post_to_webhook(f"Story generation Response RAW: {messages}")
+            story_response = next(
+                (
+                    m.content[0].text.value
+                    for m in messages
+                    if m.role == "assistant" and m.content
+                ),
+                None,
+            )
 
-        if story_response:
-            # Remove 'book_data = ' from the beginning of the response
-            formatted_response = story_response.replace("book_data = ", "", 1).strip()
-            post_to_webhook(f"Formatted story response: {formatted_response}")
-            return json.loads(formatted_response)
-        else:
-            logging.error("No story response received")
-            post_to_webhook("No story response received")
-            return {}
+            if not story_response:
+                logging.error("No story response received")
+                post_to_webhook("No story response received")
+                return {}
+            # The reply may start with 'book_data = '; a reply that cannot be used is
+            # asked for again in this thread
+            book_data = await parse_or_reask(
+                "story", story_response, thread_reask(client, thread_id, assistant_id)
+            )
+        post_to_webhook(f"Formatted story response: {book_data}")
+        return book_data
 
     except Exception as e:
         logging.error(f"Error in story generation: {e}")
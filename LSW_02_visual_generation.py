@@ -4,78 +4,75 @@ This module contains functions for generating visual descriptions using OpenAI's
 
 import json
 import logging
-import os
-import time
-
-import dotenv
-import openai
 
+import config
+from assistant_cache import assistant_cache
+from assistant_output import parse_or_reask, thread_reask
+from assistant_runs import run_assistant
+from assistant_sessions import sessions
 from post_to_webhook import post_to_webhook
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Load API key and initialize OpenAI client
-dotenv.load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
-client = openai.Client()
-
-assistant_id = os.getenv("VISUAL_ASSISTANT_ID")
+NO_RESPONSE = "No response from the assistant."
 
 
-def generate_visual_description(visual_configuration):
+@assistant_cache.cached(
+    "visual_description",
+    should_cache=lambda description: bool(description) and description != NO_RESPONSE,
+)
+async def generate_visual_description(visual_configuration):
     """
     Generates a visual description based on the provided visual configuration using OpenAI's API.
 
     :param visual_configuration: A string or JSON representing the visual configuration.
-    :return: Generated visual description as a string.
+    :return: Generated visual description as a list, or NO_RESPONSE.
     """
     try:
-        # Create a new thread for communication with the assistant
-        thread = client.beta.threads.create()
-
         user_input = (
             json.dumps(visual_configuration)
             if not isinstance(visual_configuration, str)
             else visual_configuration
         )
-        client.beta.threads.messages.create(
-            thread_id=thread.id, role="user", content=user_input
-        )
-
-        # Run assistant and wait for completion
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id, assistant_id=assistant_id
-        )
-        loop_counter = 0
 
-        while True:
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread.id, run_id=run.id
+        client = config.openai_client()
+        assistant_id = config.get("VISUAL_ASSISTANT_ID")
+        # Run the assistant in a thread of its own and wait for completion
+        async with sessions.session() as thread_id:
+            await client.beta.threads.messages.create(
+                thread_id=thread_id, role="user", content=user_input
             )
-            if run_status.status == "completed":
-                break
-            if loop_counter % 3 == 0:
-                logging.info("...writing...")
-            loop_counter += 1
-            time.sleep(1)
 
-        # Retrieve the assistant's response
-        messages = client.beta.threads.messages.list(thread_id=thread.id).data
-        logging.info("Raw Visual description messages: %s", messages)
-        post_to_webhook(f"Raw Visual description messages: {messages}")
-        assistant_response = next(
-            (msg.content[0].text.value for msg in messages if msg.role == "assistant"),
-            None,
-        )
-        logging.info("Parsed Visual description response: %s", assistant_response)
-        post_to_webhook(f"Parsed Visual description response: {assistant_response}")
+            run = await run_assistant(client, thread_id, assistant_id)
+            sessions.record_usage(thread_id, run.usage)
 
-        return (
-            assistant_response
-            if assistant_response
-            else "No response from the assistant."
-        )
+            # Retrieve the assistant's response
+            messages = (
+                await client.beta.threads.messages.list(thread_id=thread_id)
+            ).data
+            logging.info("Raw Visual description messages: %s", messages)
+            post_to_webhook(f"Raw Visual description messages: {messages}")
+            assistant_response = next(
+                (
+                    msg.content[0].text.value
+                    for msg in messages
+                    if msg.role == "assistant"
+                ),
+                None,
+            )
+            if not assistant_response:
+                return NO_RESPONSE
+            # Only descriptions of the expected shape are returned, and so cached
+            visual_description = await parse_or_reask(
+                "visual_description",
+                assistant_response,
+                thread_reask(client, thread_id, assistant_id),
+            )
+        logging.info("Parsed Visual description response: %s", visual_description)
+        post_to_webhook(f"Parsed Visual description response: {visual_description}")
+
+        return visual_description
 
     except Exception as e:
         logging.error(f"Error in generating visual description: {e}")
@@ -1,94 +1,115 @@
-"""
-This script is designed to interact with the OpenAI API to generate stories based on a given configuration.
-This also includes functionality to post responses to a webhook for further processing or logging.
-"""
-
-import json
-import logging
-import os
-import time
-
-import dotenv
-import openai
-from openai import OpenAI
-
-from post_to_webhook import post_to_webhook
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-
-
-# Load API key
-dotenv.load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-# Initialize OpenAI client
-client = OpenAI()
-
-assistant_id = os.getenv("IMAGE_PROMPT_ASSISTANT_ID")
-
-
-# Create a new thread for communication with the assistant
-threadResponse = openai.beta.threads.create()
-thread = threadResponse
-
-
-def generate_image_prompts(book_data, visual_description):
-    """
-    Generates image prompts based on the provided book data and visual description using OpenAI's API.
-    """
-    # Convert inputs to JSON strings if they are not already strings
-    if not isinstance(book_data, str):
-        book_data = json.dumps(book_data)
-    if not isinstance(visual_description, str):
-        visual_description = json.dumps(visual_description)
-
-    user_input = (
-        f"{{'book_data': {book_data}, 'visual_description': {visual_description}}}"
-    )
-
-    post_to_webhook(f"Input Book Data for image prompt generation: {book_data}")
-    post_to_webhook(
-        f"Input Updated Visual Description for image prompt generation: {visual_description}"
-    )
-
-    try:
-        # Add user input as a message to the thread
-        client.beta.threads.messages.create(
-            thread_id=thread.id, role="user", content=user_input
-        )
-
-        # Run the assistant and wait for completion
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id, assistant_id=assistant_id
-        )
-        while True:
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread.id, run_id=run.id
-            )
-            if run_status.status == "completed":
-                break
-            time.sleep(1)
-
-        # Retrieve the assistant's response
-        messages = client.beta.threads.messages.list(thread_id=thread.id).data
-        logging.info(f"Image Prompt Generation Response RAW: {messages}")
-        post_to_webhook(f"Assistant Response RAW: {messages}")
-        assistant_response = next(
-            (msg.content[0].text.value for msg in messages if msg.role == "assistant"),
-            None,
-        )
-        logging.info(f"Generated image prompts response: {assistant_response}")
-        post_to_webhook(f"Generated image prompts response: {assistant_response}")
-        if assistant_response:
-
-            return json.loads(assistant_response)
-        else:
-            logging.error("No image prompts response received")
-            post_to_webhook("No image prompts response received")
-            return {}
-
-    except Exception as e:
-        logging.error(f"Error in image prompts generation: {e}")
-        post_to_webhook(f"Error in image prompts generation: {e}")
-        return {}
+"""
+This script is designed to interact with the OpenAI API to generate stories based on a given configuration.
+This also includes functionality to post responses to a webhook for further processing or logging.
+"""
+
+import json
+import logging
+
+import config
+from assistant_output import OutputError, parse_or_reask, thread_reask
+from assistant_runs import run_assistant
+from assistant_sessions import sessions
+from json_stream import JSONMemberStream
+from post_to_webhook import post_to_webhook
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+
+
+async def generate_image_prompts(book_data, visual_description, on_prompt=None):
+    """
+    Generates image prompts based on the provided book data and visual description using OpenAI's API.
+
+    :param on_prompt: Optional callback called with ``(page, prompt)`` for each image
+        prompt, in order. Prompts are parsed from the streamed response, so each one is
+        passed on as soon as the assistant has written it, while the later pages are
+        still being written.
+    """
+    # Convert inputs to JSON strings if they are not already strings
+    if not isinstance(book_data, str):
+        book_data = json.dumps(book_data)
+    if not isinstance(visual_description, str):
+        visual_description = json.dumps(visual_description)
+
+    user_input = (
+        f"{{'book_data': {book_data}, 'visual_description': {visual_description}}}"
+    )
+
+    post_to_webhook(f"Input Book Data for image prompt generation: {book_data}")
+    post_to_webhook(
+        f"Input Updated Visual Description for image prompt generation: {visual_description}"
+    )
+
+    try:
+        client = config.openai_client()
+        assistant_id = config.get("IMAGE_PROMPT_ASSISTANT_ID")
+        # Run the assistant in a thread of its own and wait for completion
+        async with sessions.session() as thread_id:
+            # Add user input as a message to the thread
+            await client.beta.threads.messages.create(
+                thread_id=thread_id, role="user", content=user_input
+            )
+
+            prompt_stream = JSONMemberStream(("image_prompts",))
+            streamed = []
+            stopped = []
+
+            def on_text(text):
+                for page, prompt in prompt_stream.feed(text):
+                    # Streaming stops at the first prompt that is not usable; the rest
+                    # are taken from the validated reply
+                    if stopped or not isinstance(prompt, str) or not prompt.strip():
+                        stopped.append(page)
+                        continue
+                    streamed.append((page, prompt.strip()))
+                    on_prompt(page, prompt.strip())
+
+            run = await run_assistant(
+                client, thread_id, assistant_id, on_text=on_text if on_prompt else None
+            )
+            sessions.record_usage(thread_id, run.usage)
+
+            # Retrieve the assistant's response
+            messages = (
+                await client.beta.threads.messages.list(thread_id=thread_id)
+            ).data
+            logging.info(f"Image Prompt Generation Response RAW: {messages}")
+            post_to_webhook(f"Assistant Response RAW: {messages}")
+            assistant_response = next(
+                (
+                    msg.content[0].text.value
+                    for msg in messages
+                    if msg.role == "assistant"
+                ),
+                None,
+            )
+            logging.info(f"Generated image prompts response: {assistant_response}")
+            post_to_webhook(f"Generated image prompts response: {assistant_response}")
+            if not assistant_response:
+                logging.error("No image prompts response received")
+                post_to_webhook("No image prompts response received")
+                return {}
+            image_prompts = await parse_or_reask(
+                "image_prompts",
+                assistant_response,
+                thread_reask(client, thread_id, assistant_id),
+            )
+        prompt_items = list(image_prompts["image_prompts"].items())
+        if prompt_items[: len(streamed)] != streamed:
+            # A reply asked for again can have other pages; its prompts must not be
+            # mixed with those already passed on from the rejected reply
+            raise OutputError(
+                "image_prompts",
+                "the reply does not start with the prompts already streamed",
+            )
+        if on_prompt:
+            # Prompts the stream did not deliver, e.g. after a fallback to polling
+            for page, prompt in prompt_items[len(streamed) :]:
+                on_prompt(page, prompt)
+        return image_prompts
+
+    except Exception as e:
+        logging.error(f"Error in image prompts generation: {e}")
+        post_to_webhook(f"Error in image prompts generation: {e}")
+        return {}
@@ -0,0 +1,276 @@
+"""
+This module caches assistant outputs by a canonical hash of their inputs.
+
+Inputs are normalized (JSON strings parsed, keys sorted, string values trimmed and
+case-folded) before hashing, so orders with the same configuration share one cache
+entry. Entries live in an in-process LRU tier backed by an on-disk SQLite tier, both
+bounded by TTL and entry count.
+"""
+
+import asyncio
+import functools
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import orjson
+
+import config
+from single_flight import single_flight
+
+
+def normalize(value, ignore_fields=()):
+    """
+    Returns a canonical form of a configuration value for hashing.
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        # Only JSON objects and arrays are decoded, so "1" and 1 keep different keys
+        if value.lstrip()[:1] in ("{", "["):
+            try:
+                value = orjson.loads(value)
+            except orjson.JSONDecodeError:
+                pass
+        if isinstance(value, str):
+            return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {
+            str(key): normalize(item, ignore_fields)
+            for key, item in value.items()
+            if key not in ignore_fields
+        }
+    if isinstance(value, (list, tuple)):
+        return [normalize(item, ignore_fields) for item in value]
+    return value
+
+
+def canonical_key(namespace, value, ignore_fields=()):
+    """
+    Returns the content address of a value within a namespace.
+    """
+    encoded = orjson.dumps(normalize(value, ignore_fields), option=orjson.OPT_SORT_KEYS)
+    return f"{namespace}:{hashlib.sha256(encoded).hexdigest()}"
+
+
+class LRUCacheBackend:
+    name = "memory"
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    name = "disk"
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._writes = 0
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entry ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_cache_entry_accessed_at "
+                "ON cache_entry (accessed_at)"
+            )
+        return self._connection
+
+    def get(self, key):
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT value, expires_at FROM cache_entry WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                connection.execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+                connection.commit()
+                return None
+            connection.execute(
+                "UPDATE cache_entry SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            connection.commit()
+            return row[0]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO cache_entry VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, time.time()),
+            )
+            self._writes += 1
+            # Evict expired entries, then the least recently used, every 100 writes
+            if self._writes % 100 == 0:
+                connection.execute(
+                    "DELETE FROM cache_entry WHERE expires_at < ?", (time.time(),)
+                )
+                evicted = connection.execute(
+                    "DELETE FROM cache_entry WHERE key IN ("
+                    "SELECT key FROM cache_entry ORDER BY accessed_at DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+                self.evictions += max(evicted, 0)
+            connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return (
+                self._connect()
+                .execute("SELECT COUNT(*) FROM cache_entry")
+                .fetchone()[0]
+            )
+
+
+class AssistantCache:
+    def __init__(self, backends, ttl=None, enabled=None, ignore_fields=None):
+        """
+        :param backends: Cache tiers, fastest first. Hits in a slower tier are copied to
+            faster ones.
+        :param ttl: Seconds an entry stays valid.
+        :param enabled: Whether lookups and stores happen at all.
+        :param ignore_fields: Configuration keys left out of cache keys, e.g. names that
+            the assistant output does not depend on.
+        """
+        self.backends = backends
+        self.ttl = ttl or float(config.get("ASSISTANT_CACHE_TTL", str(7 * 24 * 3600)))
+        self.enabled = (
+            config.get("ASSISTANT_CACHE", "1") == "1" if enabled is None else enabled
+        )
+        if ignore_fields is None:
+            ignore_fields = config.get("ASSISTANT_CACHE_IGNORE_FIELDS", "").split(",")
+        self.ignore_fields = frozenset(field for field in ignore_fields if field)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, namespace, name):
+        with self._lock:
+            namespace_stats = self._stats.setdefault(
+                namespace, {"hits": 0, "misses": 0, "stores": 0}
+            )
+            namespace_stats[name] = namespace_stats.get(name, 0) + 1
+
+    def get(self, namespace, key):
+        for position, backend in enumerate(self.backends):
+            try:
+                encoded = backend.get(key)
+            except Exception as e:
+                logging.error(f"Error reading {backend.name} assistant cache: {e}")
+                continue
+            if encoded is None:
+                continue
+            self._count(namespace, "hits")
+            self._count(namespace, f"{backend.name}_hits")
+            for faster_backend in self.backends[:position]:
+                faster_backend.set(key, encoded, time.time() + self.ttl)
+            return orjson.loads(encoded)
+        self._count(namespace, "misses")
+        return None
+
+    def set(self, namespace, key, value):
+        encoded = orjson.dumps(value)
+        expires_at = time.time() + self.ttl
+        for backend in self.backends:
+            try:
+                backend.set(key, encoded, expires_at)
+            except Exception as e:
+                logging.error(f"Error writing {backend.name} assistant cache: {e}")
+        self._count(namespace, "stores")
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                namespace: dict(values) for namespace, values in self._stats.items()
+            }
+        for values in stats.values():
+            lookups = values["hits"] + values["misses"]
+            values["hit_ratio"] = values["hits"] / lookups if lookups else 0.0
+        stats["backends"] = {
+            backend.name: {"evictions": backend.evictions} for backend in self.backends
+        }
+        return stats
+
+    def cached(self, namespace, should_cache=bool):
+        """
+        Decorates a coroutine function taking one configuration argument so that its
+        results are served from the cache. Only results accepted by ``should_cache`` are
+        stored. Concurrent misses for the same configuration share one call.
+        """
+
+        def decorator(func):
+            async def generate(configuration, key):
+                value = await func(configuration)
+                if self.enabled and should_cache(value):
+                    await asyncio.to_thread(self.set, namespace, key, value)
+                return value
+
+            @functools.wraps(func)
+            async def wrapper(configuration):
+                key = canonical_key(namespace, configuration, self.ignore_fields)
+                if self.enabled:
+                    cached_value = await asyncio.to_thread(self.get, namespace, key)
+                    if cached_value is not None:
+                        logging.info("Assistant cache hit for %s", namespace)
+                        return cached_value
+                return await single_flight.run(
+                    namespace, key, lambda: generate(configuration, key)
+                )
+
+            return wrapper
+
+        return decorator
+
+
+# Shared cache used by the assistant modules
+assistant_cache = AssistantCache(
+    [
+        LRUCacheBackend(int(config.get("ASSISTANT_CACHE_MEMORY_ENTRIES", "1024"))),
+        SQLiteCacheBackend(
+            config.get("ASSISTANT_CACHE_PATH", "assistant_cache.db"),
+            int(config.get("ASSISTANT_CACHE_DISK_ENTRIES", "100000")),
+        ),
+    ]
+)
@@ -0,0 +1,282 @@
+"""
+This module decodes and validates the JSON that assistants reply with.
+
+Replies are decoded with orjson as they are, and otherwise from the first JSON value
+found in them, so Markdown code fences, prefixes such as ``book_data =`` and prose after
+the JSON are tolerated. Small slips (trailing commas, Python literals) are repaired.
+Each stage's reply is then checked against the shape the pipeline expects and
+normalized. A reply that still cannot be used is sent back to the assistant once in the
+same thread with the reason, so only that stage is asked again instead of the order
+failing.
+"""
+
+import ast
+import logging
+import re
+import threading
+
+import orjson
+
+import config
+
+REASKS = int(config.get("ASSISTANT_OUTPUT_REASKS", "1"))
+
+REASK_MESSAGE = (
+    "Your previous reply could not be used: {reason}. Reply again with only the JSON, "
+    "without any other text."
+)
+
+FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+
+
+class OutputError(ValueError):
+    def __init__(self, stage, reason):
+        super().__init__(f"Invalid {stage} output: {reason}")
+        self.stage = stage
+        self.reason = reason
+
+
+class OutputStats:
+    """
+    In-process counts of decoded, repaired, re-asked and failed replies, grouped by
+    stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def count(self, stage, name):
+        with self._lock:
+            entry = self._stages.setdefault(
+                stage, {"decoded": 0, "repaired": 0, "reasked": 0, "failed": 0}
+            )
+            entry[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: dict(entry) for stage, entry in self._stages.items()}
+
+
+output_stats = OutputStats()
+
+
+def _value_end(text, start):
+    # Index after the JSON object or array starting at ``start``, or None if it is not
+    # closed
+    depth = 0
+    in_string = False
+    escape = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return None
+
+
+def _strip_trailing_commas(text):
+    result = []
+    in_string = False
+    escape = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == ",":
+            following = text[index + 1 :].lstrip()
+            if following[:1] in ("}", "]"):
+                continue
+        result.append(char)
+    return "".join(result)
+
+
+def _candidates(text):
+    for match in FENCE_PATTERN.finditer(text):
+        yield match.group(1).strip()
+    for opening in "{[":
+        start = text.find(opening)
+        if start != -1:
+            end = _value_end(text, start)
+            # An unclosed value means the reply was cut off, which is not repaired
+            if end is not None:
+                yield text[start:end]
+
+
+def decode_json(text):
+    """
+    Decodes the JSON value in an assistant reply.
+
+    :return: Tuple of the decoded value and whether the reply needed more than a plain
+        decode.
+    :raises ValueError: If no JSON value can be recovered.
+    """
+    try:
+        return orjson.loads(text), False
+    except orjson.JSONDecodeError:
+        pass
+    for candidate in _candidates(text):
+        for repaired in (candidate, _strip_trailing_commas(candidate)):
+            try:
+                return orjson.loads(repaired), True
+            except orjson.JSONDecodeError:
+                pass
+        try:
+            # Python dict and list literals, e.g. single quotes or True/None
+            value = ast.literal_eval(candidate)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+        if isinstance(value, (dict, list)):
+            return value, True
+    raise ValueError("no JSON object found in the reply")
+
+
+def _non_empty_strings(stage, values):
+    for value in values:
+        if not isinstance(value, str) or not value.strip():
+            raise OutputError(stage, f"expected non-empty strings, got {value!r}")
+    return [value.strip() for value in values]
+
+
+def _story(value):
+    if not isinstance(value, dict) or not value:
+        raise OutputError("story", "expected a non-empty object")
+    return value
+
+
+def _visual_description(value):
+    # The third entry is replaced by the child's reference image for the page prompts
+    if not isinstance(value, list) or len(value) < 3:
+        raise OutputError("visual_description", "expected a list of at least 3 entries")
+    return value
+
+
+def _child_image_prompt(value):
+    if not isinstance(value, dict) or not value:
+        raise OutputError("child_image_prompt", "expected a non-empty object")
+    return _non_empty_strings("child_image_prompt", list(value.values()))
+
+
+def _image_prompts(value):
+    prompts = value.get("image_prompts", value) if isinstance(value, dict) else value
+    if isinstance(prompts, list):
+        if all(isinstance(prompt, dict) and len(prompt) == 1 for prompt in prompts):
+            # [{"page_00": "..."}, ...]
+            prompts = {key: item for prompt in prompts for key, item in prompt.items()}
+        else:
+            prompts = {
+                f"page_{index:02d}": prompt for index, prompt in enumerate(prompts)
+            }
+    if not isinstance(prompts, dict) or not prompts:
+        raise OutputError("image_prompts", "expected a non-empty image_prompts object")
+    return {
+        "image_prompts": dict(
+            zip(prompts, _non_empty_strings("image_prompts", list(prompts.values())))
+        )
+    }
+
+
+# Checks and normalizations of each stage's reply
+SCHEMAS = {
+    "story": _story,
+    "visual_description": _visual_description,
+    "child_image_prompt": _child_image_prompt,
+    "image_prompts": _image_prompts,
+}
+
+
+def parse_output(stage, output):
+    """
+    Decodes and validates a stage's reply.
+
+    :param output: Reply text, or an already decoded value, e.g. one served from a
+        cache.
+    :return: The normalized value: the story object, the visual description list, the
+        list of child image prompts, or ``{"image_prompts": {page: prompt}}``.
+    :raises OutputError: If the reply cannot be decoded or does not have the expected
+        shape.
+    """
+    if not output:
+        raise OutputError(stage, "empty reply")
+    repaired = False
+    if isinstance(output, (str, bytes)):
+        try:
+            output, repaired = decode_json(output)
+        except ValueError as e:
+            raise OutputError(stage, str(e)) from None
+    value = SCHEMAS[stage](output)
+    output_stats.count(stage, "repaired" if repaired else "decoded")
+    return value
+
+
+def thread_reask(client, thread_id, assistant_id):
+    """
+    Returns a function that asks the assistant of a thread to reply again, for
+    ``parse_or_reask``.
+    """
+    # Imported here so this module can be used without loading the assistant run
+    # machinery
+    from assistant_runs import run_assistant
+    from assistant_sessions import sessions
+
+    async def reask(reason):
+        await client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=REASK_MESSAGE.format(reason=reason),
+        )
+        run = await run_assistant(client, thread_id, assistant_id)
+        sessions.record_usage(thread_id, run.usage)
+        messages = (await client.beta.threads.messages.list(thread_id=thread_id)).data
+        # Messages are listed newest first
+        return next(
+            (
+                m.content[0].text.value
+                for m in messages
+                if m.role == "assistant" and m.content
+            ),
+            None,
+        )
+
+    return reask
+
+
+async def parse_or_reask(stage, output, reask=None, attempts=None):
+    """
+    Parses a stage's reply, asking the assistant to reply again while it cannot be used.
+
+    :param reask: Optional coroutine function called with the reason a reply was
+        rejected and returning the next reply, e.g. from ``thread_reask``.
+    :param attempts: Replies asked for again at most; defaults to
+        ASSISTANT_OUTPUT_REASKS.
+    :raises OutputError: If no reply could be used.
+    """
+    attempts = REASKS if attempts is None else attempts
+    for attempt in range(attempts + 1):
+        try:
+            return parse_output(stage, output)
+        except OutputError as e:
+            if reask is None or attempt == attempts:
+                output_stats.count(stage, "failed")
+                raise
+            logging.warning(f"{e}; asking the assistant to reply again")
+            output_stats.count(stage, "reasked")
+            output = await reask(e.reason)
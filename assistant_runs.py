@@ -0,0 +1,248 @@
+"""
+This module runs OpenAI assistants to completion for all assistant modules.
+
+Runs are streamed when possible and otherwise polled with jittered exponential backoff
+until a deadline. Terminal failure states raise AssistantRunError, and every run's
+latency is recorded.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import config
+from telemetry import span
+
+TERMINAL_STATUSES = {"completed", "failed", "cancelled", "expired", "incomplete"}
+
+RUN_TIMEOUT = float(config.get("ASSISTANT_RUN_TIMEOUT", "600"))
+RUN_STREAMING = config.get("ASSISTANT_RUN_STREAMING", "1") == "1"
+POLL_INITIAL_INTERVAL = float(config.get("ASSISTANT_POLL_INTERVAL", "0.5"))
+POLL_MAX_INTERVAL = float(config.get("ASSISTANT_POLL_MAX_INTERVAL", "5"))
+POLL_BACKOFF = 1.5
+
+
+class AssistantRunError(Exception):
+    def __init__(self, message, run=None):
+        super().__init__(message)
+        self.run = run
+        self.status = run.status if run else None
+
+
+class RunMetrics:
+    """
+    In-process latency statistics for assistant runs, grouped by assistant id.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = {}
+
+    def record(self, assistant_id, status, mode, seconds, polls=0):
+        with self._lock:
+            entry = self._runs.setdefault(
+                assistant_id,
+                {
+                    "count": 0,
+                    "total_seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "polls": 0,
+                    "statuses": {},
+                },
+            )
+            entry["count"] += 1
+            entry["total_seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["polls"] += polls
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+        logging.info(
+            "Assistant run %s finished with status %s via %s in %.2fs",
+            assistant_id,
+            status,
+            mode,
+            seconds,
+        )
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                assistant_id: {
+                    **entry,
+                    "statuses": dict(entry["statuses"]),
+                    "avg_seconds": entry["total_seconds"] / entry["count"],
+                }
+                for assistant_id, entry in self._runs.items()
+            }
+
+
+run_metrics = RunMetrics()
+
+
+async def _cancel_run(client, run):
+    try:
+        await client.beta.threads.runs.cancel(thread_id=run.thread_id, run_id=run.id)
+    except Exception as e:
+        logging.warning(f"Could not cancel assistant run {run.id}: {e}")
+
+
+async def _active_run(client, thread_id):
+    # The latest run of the thread if it is still active, e.g. one started by a stream
+    # that failed before reporting it
+    runs = await client.beta.threads.runs.list(thread_id=thread_id, limit=1)
+    if runs.data and runs.data[0].status not in TERMINAL_STATUSES:
+        return runs.data[0]
+    return None
+
+
+async def _check_run(client, run):
+    if run.status == "completed":
+        return run
+    if run.status == "requires_action":
+        # None of our assistants define tools, so there is nothing to submit.
+        await _cancel_run(client, run)
+        raise AssistantRunError("Assistant run requires an action we cannot take", run)
+    error = run.last_error.message if run.last_error else run.status
+    raise AssistantRunError(
+        f"Assistant run ended with status {run.status}: {error}", run
+    )
+
+
+async def wait_for_run(client, thread_id, run_id, timeout=None, deadline=None):
+    """
+    Polls a run with jittered exponential backoff until it reaches a terminal state.
+
+    :param timeout: Seconds to wait before the run is cancelled; defaults to
+        ASSISTANT_RUN_TIMEOUT.
+    :param deadline: Absolute ``time.monotonic()`` deadline, overriding ``timeout``.
+    :return: Tuple of the completed run and the number of status checks made.
+    """
+    deadline = deadline or time.monotonic() + (timeout or RUN_TIMEOUT)
+    interval = POLL_INITIAL_INTERVAL
+    polls = 0
+    while True:
+        run = await client.beta.threads.runs.retrieve(
+            thread_id=thread_id, run_id=run_id
+        )
+        polls += 1
+        if run.status in TERMINAL_STATUSES or run.status == "requires_action":
+            return await _check_run(client, run), polls
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            await _cancel_run(client, run)
+            raise AssistantRunError("Timed out waiting for the assistant run", run)
+        await asyncio.sleep(min(remaining, random.uniform(interval / 2, interval)))
+        interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+
+async def _consume_stream(client, thread_id, assistant_id, handler):
+    async with client.beta.threads.runs.stream(
+        thread_id=thread_id, assistant_id=assistant_id, event_handler=handler
+    ) as stream:
+        await stream.until_done()
+
+
+async def _stream_run(client, thread_id, assistant_id, deadline, on_text=None):
+    # The openai package is slow to import, so it is only loaded once a run needs it
+    from openai import AsyncAssistantEventHandler
+
+    class TextHandler(AsyncAssistantEventHandler):
+        async def on_text_delta(self, delta, snapshot):
+            if delta.value:
+                on_text(delta.value)
+
+    handler = TextHandler() if on_text else AsyncAssistantEventHandler()
+    try:
+        await asyncio.wait_for(
+            _consume_stream(client, thread_id, assistant_id, handler),
+            timeout=max(deadline - time.monotonic(), 0),
+        )
+    except Exception as e:
+        run = handler.current_run
+        if run is None:
+            if isinstance(e, TimeoutError):
+                # A run may have been started without being reported; it is cancelled
+                # like a run that times out while polled
+                run = await _active_run(client, thread_id)
+                if run is not None:
+                    await _cancel_run(client, run)
+            raise
+        # The run exists server-side, so finish waiting for it by polling.
+        logging.warning(f"Assistant run stream interrupted, polling instead: {e}")
+        return await wait_for_run(client, thread_id, run.id, deadline=deadline)
+
+    run = handler.current_run
+    if run is None:
+        raise AssistantRunError("Assistant run stream ended without a run")
+    if run.status not in TERMINAL_STATUSES and run.status != "requires_action":
+        return await wait_for_run(client, thread_id, run.id, deadline=deadline)
+    return await _check_run(client, run), 0
+
+
+async def run_assistant(
+    client, thread_id, assistant_id, timeout=None, stream=None, on_text=None
+):
+    """
+    Runs an assistant on a thread and waits for the run to complete.
+
+    :param stream: Whether to stream run events; defaults to ASSISTANT_RUN_STREAMING.
+        Falls back to polling if streaming cannot be started.
+    :param on_text: Optional callback called with each piece of the response text as it
+        is streamed. Text written after a fallback to polling is not passed to it, so
+        callers still read the complete message once the run is done.
+    :return: The completed run.
+    :raises AssistantRunError: If the run fails, expires, needs an action or times out.
+    :raises TimeoutError: If the deadline passes before a streamed run is reported as
+        started.
+    """
+    stream = RUN_STREAMING if stream is None else stream
+    deadline = time.monotonic() + (timeout or RUN_TIMEOUT)
+    started_at = time.monotonic()
+    mode = "poll"
+    status = "error"
+    polls = 0
+    with span("assistant_run", assistant_id=assistant_id) as run_span:
+        try:
+            if stream:
+                try:
+                    mode = "stream"
+                    run, polls = await _stream_run(
+                        client, thread_id, assistant_id, deadline, on_text
+                    )
+                    status = run.status
+                    return run
+                except (AssistantRunError, TimeoutError):
+                    raise
+                except Exception as e:
+                    logging.warning(
+                        f"Assistant run streaming unavailable, polling instead: {e}"
+                    )
+                    mode = "poll"
+                    # The stream may have started a run before failing; a second run
+                    # would be billed too, or be refused while the first is active
+                    run = await _active_run(client, thread_id)
+                    if run is not None:
+                        run, polls = await wait_for_run(
+                            client, thread_id, run.id, deadline=deadline
+                        )
+                        status = run.status
+                        return run
+
+            run = await client.beta.threads.runs.create(
+                thread_id=thread_id, assistant_id=assistant_id
+            )
+            run, polls = await wait_for_run(
+                client, thread_id, run.id, deadline=deadline
+            )
+            status = run.status
+            return run
+        except AssistantRunError as e:
+            status = e.status or status
+            raise
+        finally:
+            run_span.set(run_status=status, mode=mode, polls=polls)
+            run_metrics.record(
+                assistant_id, status, mode, time.monotonic() - started_at, polls
+            )
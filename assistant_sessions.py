@@ -0,0 +1,212 @@
+"""
+This module manages OpenAI Assistants threads so that every request runs in its own
+isolated thread.
+
+Threads are handed out by a session manager that keeps a small pool of clean, recycled
+threads, retires used threads after each request and deletes them in bounded batches in
+the background.
+"""
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+
+import config
+import rate_limiter
+
+
+class AssistantSessionManager:
+    def __init__(
+        self,
+        client=None,
+        max_spare_threads=None,
+        max_thread_tokens=None,
+        cleanup_batch_size=None,
+        cleanup_interval=None,
+    ):
+        """
+        :param client: OpenAI client to use; the shared client when not provided.
+        :param max_spare_threads: Number of clean threads kept for reuse.
+        :param max_thread_tokens: Prompt tokens after which a thread is deleted instead
+            of recycled.
+        :param cleanup_batch_size: Maximum threads recycled or deleted at a time.
+        :param cleanup_interval: Seconds between cleanup passes while no threads are
+            retired.
+        """
+        self._client = client
+        self.max_spare_threads = max_spare_threads or int(
+            config.get("ASSISTANT_MAX_SPARE_THREADS", "4")
+        )
+        self.max_thread_tokens = max_thread_tokens or int(
+            config.get("ASSISTANT_MAX_THREAD_TOKENS", "32000")
+        )
+        self.cleanup_batch_size = cleanup_batch_size or int(
+            config.get("ASSISTANT_CLEANUP_BATCH_SIZE", "10")
+        )
+        self.cleanup_interval = cleanup_interval or float(
+            config.get("ASSISTANT_CLEANUP_INTERVAL", "30")
+        )
+
+        self._lock = threading.Lock()
+        self._spare_threads = deque()
+        self._retired_threads = deque()
+        self._thread_tokens = {}
+        self._cleanup_task = None
+        self._stats = {"created": 0, "reused": 0, "recycled": 0, "deleted": 0}
+
+    @property
+    def client(self):
+        return self._client or config.openai_client()
+
+    async def acquire(self):
+        """
+        Returns the id of a thread with no messages, reusing a recycled thread when one
+        is available.
+        """
+        with self._lock:
+            if self._spare_threads:
+                thread_id = self._spare_threads.popleft()
+                self._stats["reused"] += 1
+                self._thread_tokens[thread_id] = 0
+                return thread_id
+
+        thread_id = (await self.client.beta.threads.create()).id
+        with self._lock:
+            self._stats["created"] += 1
+            self._thread_tokens[thread_id] = 0
+        return thread_id
+
+    def release(self, thread_id, reusable=True):
+        """
+        Retires a thread once its request is finished. It is recycled or deleted by the
+        cleanup pass.
+
+        :param reusable: False when the request failed, e.g. because a run failed or
+            timed out. The thread may still have an active run then, so it is deleted
+            instead of recycled.
+        """
+        with self._lock:
+            self._retired_threads.append((thread_id, reusable))
+        self._ensure_cleanup_task()
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        Async context manager yielding an isolated thread id for the duration of one
+        request.
+        """
+        thread_id = await self.acquire()
+        try:
+            yield thread_id
+        except BaseException:
+            self.release(thread_id, reusable=False)
+            raise
+        self.release(thread_id)
+
+    def record_usage(self, thread_id, usage):
+        """
+        Tracks the token growth of a thread from the usage reported by a completed run.
+        """
+        if not usage:
+            return
+        with self._lock:
+            if thread_id in self._thread_tokens:
+                self._thread_tokens[thread_id] += usage.prompt_tokens or 0
+                thread_tokens = self._thread_tokens[thread_id]
+            else:
+                return
+        if thread_tokens > self.max_thread_tokens:
+            logging.warning(
+                "Assistant thread %s grew to %d prompt tokens", thread_id, thread_tokens
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "active": len(self._thread_tokens) - len(self._retired_threads),
+                "spare": len(self._spare_threads),
+                "retired": len(self._retired_threads),
+                "max_active_thread_tokens": max(
+                    self._thread_tokens.values(), default=0
+                ),
+            }
+
+    async def cleanup(self):
+        """
+        Recycles or deletes retired threads until none are left, ``cleanup_batch_size``
+        at a time.
+
+        A retired thread is recycled (its messages are deleted and it joins the spare
+        pool) while the pool has room, the thread stayed under ``max_thread_tokens`` and
+        its request succeeded; otherwise it is deleted. The pace is set by the shared
+        rate limits, so the backlog keeps draining however many threads are retired.
+        """
+        while True:
+            with self._lock:
+                batch = [
+                    self._retired_threads.popleft()
+                    for _ in range(
+                        min(self.cleanup_batch_size, len(self._retired_threads))
+                    )
+                ]
+                if not batch:
+                    return
+                spare_room = self.max_spare_threads - len(self._spare_threads)
+                work = []
+                for thread_id, reusable in batch:
+                    thread_tokens = self._thread_tokens.pop(thread_id, 0)
+                    recycle = (
+                        reusable
+                        and spare_room > 0
+                        and thread_tokens <= self.max_thread_tokens
+                    )
+                    if recycle:
+                        spare_room -= 1
+                    work.append(self._cleanup_thread(thread_id, recycle))
+            await asyncio.gather(*work)
+
+    async def _cleanup_thread(self, thread_id, recycle):
+        try:
+            if recycle and await self._clear_thread(thread_id):
+                with self._lock:
+                    self._spare_threads.append(thread_id)
+                    self._stats["recycled"] += 1
+                return
+            await self.client.beta.threads.delete(thread_id)
+            with self._lock:
+                self._stats["deleted"] += 1
+        except Exception as e:
+            logging.error(f"Error cleaning up assistant thread {thread_id}: {e}")
+
+    async def _clear_thread(self, thread_id):
+        messages = await self.client.beta.threads.messages.list(
+            thread_id=thread_id, limit=100
+        )
+        if messages.has_more:
+            return False
+        for message in messages.data:
+            await self.client.beta.threads.messages.delete(
+                message_id=message.id, thread_id=thread_id
+            )
+        return True
+
+    def _ensure_cleanup_task(self):
+        if self._cleanup_task and not self._cleanup_task.done():
+            return
+        self._cleanup_task = asyncio.get_running_loop().create_task(
+            self._cleanup_loop()
+        )
+
+    async def _cleanup_loop(self):
+        # Thread cleanup yields to order traffic under the shared rate limits
+        with rate_limiter.priority(order=rate_limiter.ORDER_BACKGROUND):
+            while True:
+                await asyncio.sleep(self.cleanup_interval)
+                await self.cleanup()
+
+
+# Shared session manager used by all assistant modules
+sessions = AssistantSessionManager()
@@ -0,0 +1,95 @@
+"""
+This module runs the pipeline's coroutines on a single long-lived event loop.
+
+The loop lives in a daemon thread, so synchronous callers such as the Flask views can
+hand it work without starting an OS thread and a fresh event loop for every order.
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+_loop = None
+_lock = threading.Lock()
+# Keep references to scheduled work so it is not garbage collected while pending
+_pending = set()
+_shutdown_callbacks = []
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_loop():
+    """
+    Returns the shared event loop, starting it in a background thread on first use.
+    """
+    global _loop
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+            threading.Thread(
+                target=_run_loop, args=(_loop,), name="pipeline-event-loop", daemon=True
+            ).start()
+            logging.info("Started pipeline event loop")
+        return _loop
+
+
+def submit(coro):
+    """
+    Schedules a coroutine on the shared loop without waiting for it.
+
+    :return: A concurrent.futures.Future for the coroutine's result.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    _pending.add(future)
+    future.add_done_callback(_pending.discard)
+    return future
+
+
+def run(coro, timeout=None):
+    """
+    Runs a coroutine on the shared loop and blocks the calling thread until it finishes.
+    """
+    return submit(coro).result(timeout)
+
+
+def on_shutdown(callback):
+    """
+    Registers a coroutine function to run on the shared loop when the process exits.
+    """
+    _shutdown_callbacks.append(callback)
+    return callback
+
+
+async def _cancel_pending_tasks():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.wait(tasks, timeout=5)
+
+
+@atexit.register
+def _shutdown():
+    if _loop is None or _loop.is_closed() or not _loop.is_running():
+        return
+    for callback in reversed(_shutdown_callbacks):
+        try:
+            run(callback(), timeout=5)
+        except Exception as e:
+            logging.warning(f"Error during event loop shutdown: {e}")
+    # Let background tasks unwind before the loop stops, rather than being destroyed
+    # pending
+    try:
+        run(_cancel_pending_tasks(), timeout=10)
+    except Exception as e:
+        logging.warning(f"Error cancelling pending tasks: {e}")
+    _loop.call_soon_threadsafe(_loop.stop)
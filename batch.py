@@ -0,0 +1,323 @@
+"""
+This module runs bulk orders, e.g. seasonal campaigns and backfills, from a JSON-lines
+file of Tripetto payloads.
+
+Orders are read one line at a time and queued as background jobs, so they go through the
+same stages, checkpoints and retries as orders accepted by /process-story. At most
+``concurrency`` orders of a batch are in flight at once, which keeps live orders from
+queueing behind a whole campaign. Each result is appended to the output file as soon as
+its order finishes. Orders already in the output file are skipped, so an interrupted run
+resumes by running it again; orders that were in flight are picked up again from their
+jobs instead of being queued twice.
+
+Usage:
+    python batch.py orders.jsonl --output results.jsonl --concurrency 20
+    python batch.py orders.jsonl --output results.jsonl --retry-failed
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+import orjson
+
+import config
+
+# Statuses that end an order in a batch
+FINAL_STATUSES = ("completed", "failed", "exists", "invalid")
+
+
+def _result_key(line_number, tripetto_id):
+    # Lines without a tripettoId are told apart by their position in the input file
+    return tripetto_id or f"line:{line_number}"
+
+
+def read_results(output_path):
+    """
+    Returns the last recorded result of every order in an output file, keyed by
+    tripettoId.
+    """
+    results = {}
+    if not os.path.exists(output_path):
+        return results
+    with open(output_path, "rb") as output_file:
+        for line in output_file:
+            try:
+                result = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # A run killed mid-write leaves a partial last line
+                continue
+            results[_result_key(result.get("line"), result.get("tripettoId"))] = result
+    return results
+
+
+def read_orders(input_path):
+    """
+    Yields ``(line number, payload)`` for every non-empty line of an input file, with
+    None as the payload of lines that are not JSON objects.
+    """
+    with open(input_path, "rb") as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                payload = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                payload = None
+            yield line_number, payload if isinstance(payload, dict) else None
+
+
+def count_lines(input_path):
+    with open(input_path, "rb") as input_file:
+        return sum(1 for line in input_file if line.strip())
+
+
+class BatchRun:
+    def __init__(
+        self,
+        batch_id,
+        input_path,
+        output_path,
+        submit,
+        poll,
+        concurrency=None,
+        poll_interval=None,
+        retry_failed=False,
+    ):
+        """
+        :param batch_id: Name of the run, used in logs and in job payloads.
+        :param input_path: JSON-lines file of Tripetto payloads.
+        :param output_path: JSON-lines file that results are appended to.
+        :param submit: Function called in a thread as ``submit(payload, batch_id,
+            retry)``. Returns ``(tripetto_id, job_id, status)``, where status is
+            "queued" for an order whose job is to be waited on, or a final status.
+            Raises ValueError for an invalid payload.
+        :param poll: Function called in a thread with a list of job ids. Returns
+            ``{job_id: (status, error)}``.
+        :param concurrency: Orders of this batch in flight at once.
+        :param poll_interval: Seconds between checks of the jobs in flight.
+        :param retry_failed: Whether orders recorded as failed are run again.
+        """
+        self.batch_id = batch_id
+        self.input_path = input_path
+        self.output_path = output_path
+        self.submit = submit
+        self.poll = poll
+        self.concurrency = concurrency or int(config.get("BATCH_CONCURRENCY", "10"))
+        self.poll_interval = poll_interval or float(
+            config.get("BATCH_POLL_INTERVAL", "5")
+        )
+        self.retry_failed = retry_failed
+        self.status = "pending"
+        self.error = None
+        self.total = None
+        self.counts = {status: 0 for status in ("skipped", *FINAL_STATUSES)}
+        self.started_at = None
+        self.finished_at = None
+        self._in_flight = {}
+
+    @property
+    def active(self):
+        return self.status in ("pending", "running")
+
+    def progress(self):
+        done = sum(self.counts.values())
+        elapsed = (
+            (self.finished_at or time.time()) - self.started_at
+            if self.started_at
+            else 0
+        )
+        # Skipped orders finish instantly, so they are left out of the rate
+        processed = done - self.counts["skipped"]
+        rate = processed / elapsed if elapsed else 0.0
+        remaining = self.total - done if self.total is not None else None
+        return {
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "done": done,
+            "in_flight": len(self._in_flight),
+            **self.counts,
+            "orders_per_second": round(rate, 3),
+            "eta_seconds": (
+                round(remaining / rate) if rate and remaining is not None else None
+            ),
+            "output": self.output_path,
+        }
+
+    async def _record(self, line_number, tripetto_id, status, job_id=None, error=None):
+        result = {
+            "line": line_number,
+            "tripettoId": tripetto_id,
+            "status": status,
+            "job_id": job_id,
+            "error": error,
+            "finished_at": datetime.utcnow().isoformat(),
+        }
+        await asyncio.to_thread(self._append, orjson.dumps(result) + b"\n")
+        self.counts[status] += 1
+
+    def _append(self, line):
+        with open(self.output_path, "ab") as output_file:
+            output_file.write(line)
+
+    async def run(self):
+        """
+        Runs every order of the input file that has no result yet and returns the
+        progress.
+        """
+        self.status = "running"
+        self.started_at = time.time()
+        try:
+            previous_results = await asyncio.to_thread(read_results, self.output_path)
+            self.total = await asyncio.to_thread(count_lines, self.input_path)
+            poller = asyncio.create_task(self._poll_in_flight())
+            try:
+                for line_number, payload in read_orders(self.input_path):
+                    tripetto_id = (payload or {}).get("tripettoId")
+                    previous = previous_results.get(
+                        _result_key(line_number, tripetto_id)
+                    )
+                    retry = bool(
+                        previous
+                        and previous["status"] == "failed"
+                        and self.retry_failed
+                    )
+                    if previous and not retry:
+                        self.counts["skipped"] += 1
+                        continue
+                    while len(self._in_flight) >= self.concurrency:
+                        await asyncio.sleep(min(self.poll_interval, 0.5))
+                    await self._submit(line_number, payload, retry)
+                while self._in_flight:
+                    await asyncio.sleep(min(self.poll_interval, 0.5))
+            finally:
+                poller.cancel()
+            self.status = "completed"
+        except Exception as e:
+            logging.error(f"Batch {self.batch_id} stopped: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        self.finished_at = time.time()
+        self._log_progress()
+        return self.progress()
+
+    async def _submit(self, line_number, payload, retry):
+        if payload is None:
+            await self._record(line_number, None, "invalid", error="Not a JSON object")
+            return
+        try:
+            tripetto_id, job_id, status = await asyncio.to_thread(
+                self.submit, payload, self.batch_id, retry
+            )
+        except ValueError as e:
+            await self._record(
+                line_number, payload.get("tripettoId"), "invalid", error=str(e)
+            )
+            return
+        if status == "queued":
+            self._in_flight[job_id] = (line_number, tripetto_id)
+        else:
+            await self._record(line_number, tripetto_id, status, job_id)
+
+    async def _poll_in_flight(self):
+        last_logged = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self._in_flight:
+                try:
+                    states = await asyncio.to_thread(self.poll, list(self._in_flight))
+                except Exception as e:
+                    logging.error(f"Error checking batch {self.batch_id} jobs: {e}")
+                    states = {}
+                for job_id, (status, error) in states.items():
+                    if (
+                        status not in ("completed", "failed")
+                        or job_id not in self._in_flight
+                    ):
+                        continue
+                    line_number, tripetto_id = self._in_flight.pop(job_id)
+                    await self._record(line_number, tripetto_id, status, job_id, error)
+            if time.monotonic() - last_logged >= 30:
+                self._log_progress()
+                last_logged = time.monotonic()
+
+    def _log_progress(self):
+        progress = self.progress()
+        logging.info(
+            "Batch %s %s: %d/%s done (%d completed, %d failed, %d skipped), %d in flight, "
+            "%.2f orders/s",
+            self.batch_id,
+            progress["status"],
+            progress["done"],
+            progress["total"],
+            progress["completed"],
+            progress["failed"],
+            progress["skipped"],
+            progress["in_flight"],
+            progress["orders_per_second"],
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run bulk orders from a JSON-lines file."
+    )
+    parser.add_argument(
+        "input", help="JSON-lines file with one Tripetto payload per line"
+    )
+    parser.add_argument(
+        "--output", help="JSON-lines file for results (default: <input>.results.jsonl)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=None, help="orders in flight at once"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="job workers in this process (default: JOB_WORKERS)",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="run orders recorded as failed in the output file again",
+    )
+    parser.add_argument("--batch-id", help="name of the run (default: input file name)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if args.workers:
+        os.environ["JOB_WORKERS"] = str(args.workers)
+
+    import async_runtime
+    import main as service
+
+    with service.app.app_context():
+        service.migrate()
+    service.job_queue.start()
+
+    batch_id = args.batch_id or os.path.splitext(os.path.basename(args.input))[0]
+    run = service.create_batch_run(
+        batch_id,
+        args.input,
+        args.output or f"{os.path.splitext(args.input)[0]}.results.jsonl",
+        concurrency=args.concurrency,
+        retry_failed=args.retry_failed,
+    )
+    progress = async_runtime.run(run.run())
+    print(orjson.dumps(progress, option=orjson.OPT_INDENT_2).decode())
+    return 0 if progress["status"] == "completed" else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,875 @@
+"""
+This script load-tests the service offline, against simulated OpenAI, ImaginePro and
+littlestorywriter.com backends, so no API credits are spent.
+
+The simulated backends run in a separate process with configurable latency
+distributions, error rates and rate limits. The service runs in this process behind a
+local HTTP server and is driven with synthetic Tripetto payloads at a target rate. The
+report covers throughput, response and end-to-end latency percentiles, per-stage
+latencies, thread and task counts, and memory. It is saved as JSON, named after the
+current commit, so runs can be compared across commits.
+
+Usage: python benchmark.py --rps 0.5 --duration 60 --pages 12 python benchmark.py
+    --openai-latency 2:0.4 --mid-latency 20:0.3 --mid-error-rate 0.05 python
+    benchmark.py --compare benchmark_results/<earlier run>.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+
+RESULTS_DIR = "benchmark_results"
+
+ASSISTANT_IDS = {
+    "STORY_ASSISTANT_ID": "bench-story",
+    "VISUAL_ASSISTANT_ID": "bench-visual",
+    "CHILD_ASSISTANT_ID": "bench-child",
+    "IMAGE_PROMPT_ASSISTANT_ID": "bench-prompts",
+}
+
+CHILD_NAMES = ["Ava", "Noah", "Mia", "Liam", "Zoe", "Omar", "Lena", "Kai"]
+HAIR_COLORS = ["brown", "black", "blonde", "red"]
+STYLES = ["watercolor", "cartoon", "pencil", "pixar"]
+THEMES = ["friendship", "courage", "kindness", "curiosity"]
+
+
+class Latency:
+    """
+    Log-normal latency distribution given as "median" or "median:sigma" seconds.
+    """
+
+    def __init__(self, spec):
+        median, _, sigma = str(spec).partition(":")
+        self.median = float(median)
+        self.sigma = float(sigma or 0)
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(random.gauss(0, self.sigma))
+
+    def __str__(self):
+        return f"{self.median}:{self.sigma}"
+
+
+class _Bucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+
+    def allow(self):
+        """
+        :return: None if the request is allowed, otherwise the seconds until it would
+            be.
+        """
+        if not self.rate:
+            return None
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) / self.rate
+
+
+class SimulatedBackends:
+    """
+    Stand-ins for the Assistants API (/v1), ImaginePro (/mid) and littlestorywriter.com
+    (/site).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.openai_latency = Latency(config["openai_latency"])
+        self.mid_latency = Latency(config["mid_latency"])
+        self.mid_upscale_latency = Latency(config["mid_upscale_latency"])
+        self.openai_bucket = _Bucket(config["openai_rate_limit"])
+        self.mid_buckets = {}
+        self.ids = itertools.count()
+        self.threads = {}
+        self.runs = {}
+        self.messages = {}
+        self.uploads = {}
+        self.first_pages = {}
+        self.stats = {
+            "openai_requests": 0,
+            "openai_rate_limited": 0,
+            "openai_failed_runs": 0,
+            "mid_requests": 0,
+            "mid_rate_limited": 0,
+            "mid_failed_images": 0,
+            "site_requests": 0,
+        }
+
+    def _new_id(self, prefix):
+        return f"{prefix}_{next(self.ids)}"
+
+    # OpenAI Assistants API
+
+    def _replies(self):
+        pages = self.config["pages"]
+        return {
+            "bench-story": "book_data = "
+            + json.dumps(
+                {
+                    "title": "A Benchmark Adventure",
+                    "pages": [f"Page {index} of the story." for index in range(pages)],
+                }
+            ),
+            "bench-visual": "```json\n"
+            + json.dumps(
+                [
+                    {"child": "A cheerful child with curly hair"},
+                    {"companion": "A small friendly dragon"},
+                    {"illustration_style": "soft watercolor"},
+                ]
+            )
+            + "\n```",
+            "bench-child": json.dumps({"prompt": "A cheerful child, soft watercolor"}),
+            "bench-prompts": json.dumps(
+                {
+                    "image_prompts": {
+                        f"page_{index:02d}": f"Illustration of page {index}, watercolor"
+                        for index in range(pages)
+                    }
+                }
+            ),
+        }
+
+    @web.middleware
+    async def _openai_limits(self, request, handler):
+        if request.path.startswith("/v1/"):
+            self.stats["openai_requests"] += 1
+            retry_after = self.openai_bucket.allow()
+            if retry_after is not None:
+                self.stats["openai_rate_limited"] += 1
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "requests"}},
+                    status=429,
+                    headers={"Retry-After": f"{retry_after:.2f}"},
+                )
+        return await handler(request)
+
+    def _run_object(self, run):
+        elapsed = time.monotonic() - run["started_at"]
+        if elapsed < run["latency"]:
+            status = "in_progress"
+        else:
+            status = "failed" if run["fail"] else "completed"
+            if not run["finished"]:
+                run["finished"] = True
+                if not run["fail"]:
+                    self._add_message(run["thread_id"], "assistant", run["reply"])
+        return {
+            "id": run["id"],
+            "object": "thread.run",
+            "thread_id": run["thread_id"],
+            "assistant_id": run["assistant_id"],
+            "status": status,
+            "created_at": int(time.time()),
+            "instructions": "",
+            "model": "simulated",
+            "tools": [],
+            "last_error": (
+                {"code": "server_error", "message": "Simulated failure"}
+                if status == "failed"
+                else None
+            ),
+            "usage": (
+                {"prompt_tokens": 800, "completion_tokens": 400, "total_tokens": 1200}
+                if status == "completed"
+                else None
+            ),
+        }
+
+    def _add_message(self, thread_id, role, text):
+        message = {
+            "id": self._new_id("msg"),
+            "object": "thread.message",
+            "thread_id": thread_id,
+            "role": role,
+            "created_at": int(time.time()),
+            "status": "completed",
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+        }
+        self.threads.setdefault(thread_id, []).append(message)
+        return message
+
+    async def create_thread(self, request):
+        thread_id = self._new_id("thread")
+        self.threads[thread_id] = []
+        return web.json_response({"id": thread_id, "object": "thread", "created_at": 0})
+
+    async def delete_thread(self, request):
+        thread_id = request.match_info["thread_id"]
+        self.threads.pop(thread_id, None)
+        return web.json_response(
+            {"id": thread_id, "object": "thread.deleted", "deleted": True}
+        )
+
+    async def create_message(self, request):
+        body = await request.json()
+        message = self._add_message(
+            request.match_info["thread_id"], "user", body["content"]
+        )
+        return web.json_response(message)
+
+    async def list_messages(self, request):
+        messages = list(reversed(self.threads.get(request.match_info["thread_id"], [])))
+        return web.json_response(
+            {"object": "list", "data": messages, "has_more": False}
+        )
+
+    async def delete_message(self, request):
+        thread_id = request.match_info["thread_id"]
+        message_id = request.match_info["message_id"]
+        self.threads[thread_id] = [
+            message
+            for message in self.threads.get(thread_id, [])
+            if message["id"] != message_id
+        ]
+        return web.json_response(
+            {"id": message_id, "object": "thread.message.deleted", "deleted": True}
+        )
+
+    async def create_run(self, request):
+        body = await request.json()
+        fail = random.random() < self.config["openai_error_rate"]
+        if fail:
+            self.stats["openai_failed_runs"] += 1
+        run = {
+            "id": self._new_id("run"),
+            "thread_id": request.match_info["thread_id"],
+            "assistant_id": body["assistant_id"],
+            "started_at": time.monotonic(),
+            "latency": self.openai_latency.sample(),
+            "fail": fail,
+            "finished": False,
+            "reply": self._replies().get(body["assistant_id"], "{}"),
+        }
+        self.runs[run["id"]] = run
+        if not body.get("stream"):
+            return web.json_response(self._run_object(run))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(event, data):
+            await response.write(
+                f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+            )
+
+        await send("thread.run.created", self._run_object(run))
+        await asyncio.sleep(run["latency"])
+        final = self._run_object(run)
+        await send(f"thread.run.{final['status']}", final)
+        await response.write(b"event: done\ndata: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def get_run(self, request):
+        return web.json_response(
+            self._run_object(self.runs[request.match_info["run_id"]])
+        )
+
+    async def cancel_run(self, request):
+        run = self.runs[request.match_info["run_id"]]
+        run["fail"] = True
+        run["latency"] = 0
+        return web.json_response(self._run_object(run))
+
+    # ImaginePro
+
+    @web.middleware
+    async def _mid_limits(self, request, handler):
+        if request.path.startswith("/mid/"):
+            self.stats["mid_requests"] += 1
+            key = request.headers.get("Authorization", "")
+            bucket = self.mid_buckets.setdefault(
+                key, _Bucket(self.config["mid_rate_limit"])
+            )
+            retry_after = bucket.allow()
+            if retry_after is not None:
+                self.stats["mid_rate_limited"] += 1
+                return web.json_response(
+                    {"error": "Too many requests"},
+                    status=429,
+                    headers={"Retry-After": f"{retry_after:.2f}"},
+                )
+        return await handler(request)
+
+    def _start_message(self, latency):
+        message_id = self._new_id("mid")
+        fail = random.random() < self.config["mid_error_rate"]
+        if fail:
+            self.stats["mid_failed_images"] += 1
+        self.messages[message_id] = {
+            "started_at": time.monotonic(),
+            "latency": latency,
+            "fail": fail,
+        }
+        return message_id
+
+    async def imagine(self, request):
+        await request.json()
+        message_id = self._start_message(self.mid_latency.sample())
+        return web.json_response({"success": True, "messageId": message_id})
+
+    async def button(self, request):
+        body = await request.json()
+        if body.get("messageId") not in self.messages:
+            return web.json_response({"error": "Unknown messageId"}, status=404)
+        message_id = self._start_message(self.mid_upscale_latency.sample())
+        return web.json_response({"success": True, "messageId": message_id})
+
+    async def message(self, request):
+        message_id = request.match_info["message_id"]
+        message = self.messages.get(message_id)
+        if message is None:
+            return web.json_response({"error": "Unknown messageId"}, status=404)
+        elapsed = time.monotonic() - message["started_at"]
+        progress = 100
+        if message["latency"]:
+            progress = min(int(100 * elapsed / message["latency"]), 100)
+        if message["fail"] and progress >= 50:
+            return web.json_response(
+                {
+                    "messageId": message_id,
+                    "status": "FAIL",
+                    "progress": progress,
+                    "error": "Simulated failure",
+                }
+            )
+        result = {
+            "messageId": message_id,
+            "status": "DONE" if progress == 100 else "PROCESSING",
+            "progress": progress,
+        }
+        if progress == 100:
+            result["uri"] = f"https://cdn.example.invalid/{message_id}.png"
+        return web.json_response(result)
+
+    # littlestorywriter.com
+
+    async def site_story(self, request):
+        self.stats["site_requests"] += 1
+        await request.read()
+        return web.Response(text="OK")
+
+    async def site_upload(self, request):
+        self.stats["site_requests"] += 1
+        body = await request.json()
+        self.first_pages.setdefault(body["tripettoId"], time.time())
+        # Incremental page posts carry "complete": false; the book upload or manifest
+        # completes it
+        if body.get("complete", True):
+            self.uploads.setdefault(body["tripettoId"], time.time())
+        return web.Response(text="OK")
+
+    async def site_stats(self, request):
+        return web.json_response(
+            {
+                "uploads": self.uploads,
+                "first_pages": self.first_pages,
+                "stats": self.stats,
+            }
+        )
+
+    def make_app(self):
+        app = web.Application(middlewares=[self._openai_limits, self._mid_limits])
+        routes = [
+            ("POST", "/v1/threads", self.create_thread),
+            ("DELETE", "/v1/threads/{thread_id}", self.delete_thread),
+            ("POST", "/v1/threads/{thread_id}/messages", self.create_message),
+            ("GET", "/v1/threads/{thread_id}/messages", self.list_messages),
+            (
+                "DELETE",
+                "/v1/threads/{thread_id}/messages/{message_id}",
+                self.delete_message,
+            ),
+            ("POST", "/v1/threads/{thread_id}/runs", self.create_run),
+            ("GET", "/v1/threads/{thread_id}/runs/{run_id}", self.get_run),
+            ("POST", "/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run),
+            ("POST", "/mid/imagine", self.imagine),
+            ("POST", "/mid/button", self.button),
+            ("GET", "/mid/message/{message_id}", self.message),
+            ("POST", "/site/process-story", self.site_story),
+            ("POST", "/site/img-upload", self.site_upload),
+            ("GET", "/site/_stats", self.site_stats),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(method, path, handler)
+        return app
+
+
+def serve_backends(config, port):
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    web.run_app(
+        SimulatedBackends(config).make_app(), host="127.0.0.1", port=port, print=None
+    )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def synthetic_payload(run_id, index):
+    name = random.choice(CHILD_NAMES)
+    return {
+        "tripettoId": f"bench-{run_id}-{index}",
+        "userid": f"user-{index}",
+        "tripettoCreateDate": datetime.utcnow().isoformat(),
+        "child_name": name,
+        "child_age": str(random.randint(3, 9)),
+        "child_gender": random.choice(["girl", "boy"]),
+        "child_hair_color": random.choice(HAIR_COLORS),
+        "child_hair_length": random.choice(["short", "long"]),
+        "companion_name": "Sparky",
+        "companion_type": "dragon",
+        "story_theme": random.choice(THEMES),
+        "illustration_style": random.choice(STYLES),
+        "language": "English",
+    }
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(int(q * len(values)), len(values) - 1)], 3)
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": pick(0.5),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(values[-1], 3),
+    }
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return None
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def configure_service(args, backend_url, work_dir):
+    """
+    Points the service at the simulated backends. Variables already set in the
+    environment win, so worker counts, limits and intervals can be tuned per run.
+    """
+    defaults = {
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{backend_url}/v1",
+        "MID_API_KEY": "bench",
+        "MID_API_BASE_URL": f"{backend_url}/mid",
+        "LSW_SITE_URL": f"{backend_url}/site",
+        "WEBHOOK_URL": "",
+        "MID_WEBHOOK_URL": "",
+        "DATABASE_URL": f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+        "ASSISTANT_CACHE": "1" if args.cache else "0",
+        "ASSISTANT_CACHE_PATH": os.path.join(work_dir, "assistant_cache.db"),
+        "REFERENCE_IMAGE_REUSE": "1" if args.cache else "0",
+        "REFERENCE_IMAGE_STORE_PATH": os.path.join(work_dir, "reference_images.db"),
+        "TRACE_EXPORT_PATH": "",
+        "PAGE_DELIVERY": "incremental" if args.incremental else "book",
+        **ASSISTANT_IDS,
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+def start_service(port):
+    from werkzeug.serving import make_server
+
+    import main
+
+    with main.app.app_context():
+        main.migrate()
+    main.job_queue.start()
+    server = make_server("127.0.0.1", port, main.app, threaded=True)
+    threading.Thread(
+        target=server.serve_forever, name="bench-server", daemon=True
+    ).start()
+    return server
+
+
+def sample_runtime(samples, stop):
+    import async_runtime
+
+    async def count_tasks():
+        return len(asyncio.all_tasks())
+
+    while not stop.is_set():
+        try:
+            tasks = async_runtime.run(count_tasks(), timeout=5)
+        except Exception:
+            tasks = None
+        samples.append(
+            {
+                "time": time.time(),
+                "threads": threading.active_count(),
+                "tasks": tasks,
+                "rss_mb": current_rss_mb(),
+            }
+        )
+        stop.wait(1)
+
+
+async def drive(args, service_url, backend_url, run_id):
+    """
+    Sends orders at the target rate, then waits for their books to be uploaded.
+    """
+    total = max(int(args.rps * args.duration), 1)
+    sent = {}
+    responses = []
+    errors = []
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    path = "/process-story?async=1" if args.async_mode else "/process-story"
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+
+        async def send(index):
+            payload = synthetic_payload(run_id, index)
+            started_at = time.time()
+            sent[payload["tripettoId"]] = started_at
+            try:
+                async with session.post(service_url + path, json=payload) as response:
+                    await response.read()
+                    if response.status not in (200, 202):
+                        errors.append(f"HTTP {response.status}")
+            except Exception as e:
+                errors.append(type(e).__name__)
+            responses.append(time.time() - started_at)
+
+        started_at = time.monotonic()
+        tasks = []
+        for index in range(total):
+            # Open-loop arrivals: the schedule does not wait for earlier responses
+            if args.poisson:
+                await asyncio.sleep(random.expovariate(args.rps))
+            else:
+                await asyncio.sleep(
+                    max(started_at + index / args.rps - time.monotonic(), 0)
+                )
+            tasks.append(asyncio.create_task(send(index)))
+        await asyncio.gather(*tasks)
+        send_seconds = time.monotonic() - started_at
+
+        deadline = time.monotonic() + args.drain_timeout
+        while True:
+            async with session.get(f"{backend_url}/site/_stats") as response:
+                site = await response.json()
+            done = [
+                tripetto_id for tripetto_id in sent if tripetto_id in site["uploads"]
+            ]
+            if len(done) == len(sent) or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(1)
+
+    completions = [
+        site["uploads"][tripetto_id] - sent[tripetto_id] for tripetto_id in done
+    ]
+    first_pages = [
+        site["first_pages"][tripetto_id] - sent[tripetto_id]
+        for tripetto_id in sent
+        if tripetto_id in site["first_pages"]
+    ]
+    finished_at = max(
+        (site["uploads"][tripetto_id] for tripetto_id in done), default=None
+    )
+    first_sent = min(sent.values())
+    return {
+        "orders": total,
+        "send_seconds": round(send_seconds, 2),
+        "request_errors": len(errors),
+        "request_error_kinds": sorted(set(errors)),
+        "response_latency": percentiles(responses),
+        "books_completed": len(done),
+        "books_missing": total - len(done),
+        "completion_latency": percentiles(completions),
+        "first_page_latency": percentiles(first_pages),
+        "throughput_books_per_minute": (
+            round(60 * len(done) / (finished_at - first_sent), 3)
+            if finished_at
+            else 0.0
+        ),
+        "backends": site["stats"],
+    }
+
+
+def run_benchmark(args):
+    import telemetry
+
+    results = {
+        "commit": current_commit(),
+        "started_at": datetime.utcnow().isoformat(),
+        "config": {
+            name: str(value) if isinstance(value, Latency) else value
+            for name, value in vars(args).items()
+            if name not in ("compare", "output")
+        },
+    }
+    samples = []
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_runtime, args=(samples, stop), daemon=True)
+    sampler.start()
+
+    run_id = datetime.utcnow().strftime("%H%M%S")
+    results.update(asyncio.run(drive(args, args.service_url, args.backend_url, run_id)))
+    stop.set()
+    sampler.join(timeout=5)
+
+    results["threads"] = percentiles([sample["threads"] for sample in samples])
+    results["event_loop_tasks"] = percentiles(
+        [sample["tasks"] for sample in samples if sample["tasks"] is not None]
+    )
+    results["rss_mb"] = percentiles(
+        [sample["rss_mb"] for sample in samples if sample["rss_mb"] is not None]
+    )
+    results["peak_rss_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+    )
+    results["stages"] = telemetry.stage_summary()
+    return results
+
+
+def save_results(results, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(output_dir, f"{stamp}-{results['commit']}.json")
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    return path
+
+
+COMPARED_METRICS = [
+    ("throughput_books_per_minute",),
+    ("response_latency", "p50"),
+    ("response_latency", "p95"),
+    ("completion_latency", "p50"),
+    ("completion_latency", "p95"),
+    ("completion_latency", "p99"),
+    ("first_page_latency", "p50"),
+    ("first_page_latency", "p95"),
+    ("books_missing",),
+    ("request_errors",),
+    ("threads", "max"),
+    ("event_loop_tasks", "max"),
+    ("peak_rss_mb",),
+]
+
+
+def compare_results(baseline, results):
+    lines = [
+        f"{'metric':<32}{baseline['commit']:>12}{results['commit']:>12}{'change':>10}"
+    ]
+    for path in COMPARED_METRICS:
+        before, after = baseline, results
+        for key in path:
+            before = (before or {}).get(key)
+            after = (after or {}).get(key)
+        change = ""
+        if (
+            isinstance(before, (int, float))
+            and isinstance(after, (int, float))
+            and before
+        ):
+            change = f"{100 * (after - before) / before:+.1f}%"
+        lines.append(
+            f"{'.'.join(path):<32}{str(before):>12}{str(after):>12}{change:>10}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of /process-story.")
+    parser.add_argument(
+        "--rps",
+        type=float,
+        default=0.2,
+        help="Orders sent per second.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=30,
+        help="Seconds to send orders for.",
+    )
+    parser.add_argument("--poisson", action="store_true", help="Use Poisson arrivals.")
+    parser.add_argument(
+        "--async-mode",
+        action="store_true",
+        help="Use ?async=1 orders.",
+    )
+    parser.add_argument(
+        "--pages",
+        type=int,
+        default=12,
+        help="Pages per simulated book.",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Keep the assistant and reference image caches on.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Post each page as soon as it is ready (PAGE_DELIVERY=incremental).",
+    )
+    parser.add_argument(
+        "--openai-latency",
+        default="1.5:0.3",
+        help="Assistant run median[:sigma] seconds.",
+    )
+    parser.add_argument(
+        "--openai-error-rate",
+        type=float,
+        default=0.0,
+        help="Share of failed runs.",
+    )
+    parser.add_argument(
+        "--openai-rate-limit",
+        type=float,
+        default=0,
+        help="OpenAI requests per second before 429s (0 is unlimited).",
+    )
+    parser.add_argument(
+        "--mid-latency",
+        default="6:0.3",
+        help="ImaginePro render median[:sigma] seconds.",
+    )
+    parser.add_argument(
+        "--mid-upscale-latency",
+        default="2:0.3",
+        help="ImaginePro upscale median[:sigma] seconds.",
+    )
+    parser.add_argument(
+        "--mid-error-rate",
+        type=float,
+        default=0.0,
+        help="Share of failed renders.",
+    )
+    parser.add_argument(
+        "--mid-rate-limit",
+        type=float,
+        default=0,
+        help="ImaginePro requests per second per key before 429s (0 is unlimited).",
+    )
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        default=300,
+        help="Seconds before an order request is abandoned.",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=600,
+        help="Seconds to wait for books after the last order.",
+    )
+    parser.add_argument(
+        "--output",
+        default=RESULTS_DIR,
+        help="Directory the results are saved to.",
+    )
+    parser.add_argument(
+        "--compare",
+        help="Earlier results file to compare this run with.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    backend_config = {
+        "pages": args.pages,
+        "openai_latency": args.openai_latency,
+        "openai_error_rate": args.openai_error_rate,
+        "openai_rate_limit": args.openai_rate_limit,
+        "mid_latency": args.mid_latency,
+        "mid_upscale_latency": args.mid_upscale_latency,
+        "mid_error_rate": args.mid_error_rate,
+        "mid_rate_limit": args.mid_rate_limit,
+    }
+    backend_port = free_port()
+    backends = multiprocessing.get_context("spawn").Process(
+        target=serve_backends, args=(backend_config, backend_port), daemon=True
+    )
+    backends.start()
+    try:
+        wait_for_port(backend_port)
+        args.backend_url = f"http://127.0.0.1:{backend_port}"
+        with tempfile.TemporaryDirectory(prefix="lsw-bench-") as work_dir:
+            configure_service(args, args.backend_url, work_dir)
+            service_port = free_port()
+            server = start_service(service_port)
+            args.service_url = f"http://127.0.0.1:{service_port}"
+            try:
+                results = run_benchmark(args)
+            finally:
+                server.shutdown()
+    finally:
+        backends.terminate()
+
+    path = save_results(results, args.output)
+    report = {name: value for name, value in results.items() if name != "config"}
+    print(json.dumps(report, indent=2))
+    print(f"Saved results to {path}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print(compare_results(json.load(baseline_file), results))
+
+
+if __name__ == "__main__":
+    main()
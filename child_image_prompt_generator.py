@@ -4,29 +4,19 @@ This module contains a function to generate a child image prompt based on the pr
 
 import json
 import logging
-import os
-import time
 
-import dotenv
-import openai
+import config
+from assistant_cache import assistant_cache
+from assistant_output import parse_or_reask, thread_reask
+from assistant_runs import run_assistant
+from assistant_sessions import sessions
 
 # Configure basic logging
 logging.basicConfig(level=logging.INFO)
 
-# Load API key
-dotenv.load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Initialize OpenAI client
-client = openai.OpenAI()
-
-assistant_id = os.getenv("CHILD_ASSISTANT_ID")
-# Create a new thread for communication with the assistant
-thread_response = client.beta.threads.create()
-thread = thread_response
-
-
-def generate_child_image_prompt(story_configuration):
+@assistant_cache.cached("child_image_prompt")
+async def generate_child_image_prompt(story_configuration):
     """
     Generates a child image prompt based on the provided story configuration using OpenAI's API.
 
@@ -40,42 +30,40 @@ def generate_child_image_prompt(story_configuration):
     )
 
     try:
-        # Add user input as a message to the thread
-        client.beta.threads.messages.create(
-            thread_id=thread.id, role="user", content=user_input
-        )
-
-        # Run the assistant and wait for completion
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id, assistant_id=assistant_id
-        )
-        while True:
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread.id, run_id=run.id
+        client = config.openai_client()
+        assistant_id = config.get("CHILD_ASSISTANT_ID")
+        # Run the assistant in a thread of its own and wait for completion
+        async with sessions.session() as thread_id:
+            # Add user input as a message to the thread
+            await client.beta.threads.messages.create(
+                thread_id=thread_id, role="user", content=user_input
             )
-            if run_status.status == "completed":
-                break
-            time.sleep(1)
 
-        # Retrieve the assistant's response
-        messages = client.beta.threads.messages.list(thread_id=thread.id).data
-        story_response = next(
-            (
-                m.content[0].text.value
-                for m in messages
-                if m.role == "assistant" and m.content
-            ),
-            None,
-        )
+            run = await run_assistant(client, thread_id, assistant_id)
+            sessions.record_usage(thread_id, run.usage)
 
-        if story_response:
-            # Remove 'book_data = ' from the beginning of the response
-            formatted_response = story_response.replace("book_data = ", "", 1).strip()
-            story_data = json.loads(formatted_response)
-            return list(story_data.values())
-        else:
-            logging.error("No story response received")
-            return []
+            # Retrieve the assistant's response
+            messages = (
+                await client.beta.threads.messages.list(thread_id=thread_id)
+            ).data
+            story_response = next(
+                (
+                    m.content[0].text.value
+                    for m in messages
+                    if m.role == "assistant" and m.content
+                ),
+                None,
+            )
+
+            if not story_response:
+                logging.error("No story response received")
+                return []
+            # The values of the reply's object are the prompts
+            return await parse_or_reask(
+                "child_image_prompt",
+                story_response,
+                thread_reask(client, thread_id, assistant_id),
+            )
 
     except Exception as e:
         logging.error(f"Error in story generation: {e}")
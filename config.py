@@ -0,0 +1,62 @@
+"""
+This module is the registry of settings and API clients shared by all modules.
+
+Nothing happens at import. The .env file is loaded into the environment on the first
+settings lookup, and the OpenAI client is created on first use, so importing the app
+makes no network calls and needs no credentials. A missing API key only fails the first
+call that needs it.
+"""
+
+import os
+import threading
+
+import dotenv
+
+_lock = threading.RLock()
+_env_loaded = False
+_openai_client = None
+
+
+def load_env():
+    """
+    Loads the .env file once per process. Variables already set in the environment take
+    precedence.
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _lock:
+        if not _env_loaded:
+            dotenv.load_dotenv()
+            _env_loaded = True
+
+
+def get(name, default=None):
+    """
+    Returns a setting from the environment or the .env file.
+    """
+    load_env()
+    return os.environ.get(name, default)
+
+
+def openai_client():
+    """
+    Returns the OpenAI client shared by the assistant modules, creating it on first use.
+    Its requests go through the rate limiter.
+    """
+    global _openai_client
+    if _openai_client is None:
+        with _lock:
+            if _openai_client is None:
+                # Imported here so importing the app does not load the openai package,
+                # and because the rate limiter reads its own settings from this module
+                import openai
+
+                import rate_limiter
+
+                _openai_client = openai.AsyncOpenAI(
+                    api_key=get("OPENAI_API_KEY"),
+                    base_url=get("OPENAI_BASE_URL") or None,
+                    http_client=rate_limiter.openai_http_client(),
+                )
+    return _openai_client
@@ -1,21 +1,12 @@
-import json
+from assistant_output import parse_output
 
 
 def extract_output_image_prompts(input_data):
     """
     Extracts image prompts from the provided dictionary.
 
-    :param input_data: Dictionary containing image prompts.
+    :param input_data: Dictionary or JSON reply containing image prompts, either as an
+        object of pages or as a list of single-page objects.
     :return: List of extracted image prompts.
     """
-    # Ensure input_data is a dictionary
-    if isinstance(input_data, str):
-        input_data = json.loads(input_data)
-
-    # Extract image prompts from the dictionary
-    image_prompts = input_data.get("image_prompts", [])
-
-    # Create a list of prompt values
-    output_image_prompts = [list(prompt.values())[0] for prompt in image_prompts]
-
-    return output_image_prompts
+    return list(parse_output("image_prompts", input_data)["image_prompts"].values())
@@ -0,0 +1,168 @@
+"""
+This module provides the process-wide pooled HTTP clients used for all outbound calls.
+
+Coroutines share one aiohttp session per event loop and synchronous code shares one
+requests session. Both keep connections alive, cap connections per host and apply
+explicit connect and read timeouts. The async pool also caches DNS lookups and counts
+its own utilization.
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+import async_runtime
+import config
+import traffic
+
+POOL_LIMIT = int(config.get("HTTP_POOL_LIMIT", "100"))
+POOL_LIMIT_PER_HOST = int(config.get("HTTP_POOL_LIMIT_PER_HOST", "20"))
+DNS_CACHE_TTL = int(config.get("HTTP_DNS_CACHE_TTL", "300"))
+KEEPALIVE_TIMEOUT = float(config.get("HTTP_KEEPALIVE_TIMEOUT", "30"))
+CONNECT_TIMEOUT = float(config.get("HTTP_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(config.get("HTTP_READ_TIMEOUT", "60"))
+
+# Timeout tuple for requests calls made with the synchronous session
+SYNC_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+_lock = threading.Lock()
+_sessions = weakref.WeakKeyDictionary()
+_sync_session = None
+_sync_session_pid = None
+_stats = {
+    "requests": 0,
+    "in_flight": 0,
+    "max_in_flight": 0,
+    "connections_created": 0,
+    "connections_reused": 0,
+    "connections_queued": 0,
+    "dns_cache_hits": 0,
+    "dns_cache_misses": 0,
+}
+
+
+def _count(name, delta=1):
+    with _lock:
+        _stats[name] += delta
+        if name == "in_flight":
+            _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+
+
+def _trace_config():
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        _count("requests")
+        _count("in_flight")
+
+    async def on_request_done(session, context, params):
+        _count("in_flight", -1)
+
+    def counter(name):
+        async def on_event(session, context, params):
+            _count(name)
+
+        return on_event
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_done)
+    trace_config.on_request_exception.append(on_request_done)
+    trace_config.on_connection_create_end.append(counter("connections_created"))
+    trace_config.on_connection_reuseconn.append(counter("connections_reused"))
+    trace_config.on_connection_queued_start.append(counter("connections_queued"))
+    trace_config.on_dns_cache_hit.append(counter("dns_cache_hits"))
+    trace_config.on_dns_cache_miss.append(counter("dns_cache_misses"))
+    return trace_config
+
+
+def get_session():
+    """
+    Returns the pooled aiohttp session of the running event loop, creating it on first
+    use. With TRAFFIC_MODE set, its requests are recorded or replayed.
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            ),
+            trace_configs=[_trace_config()],
+        )
+        _sessions[loop] = session
+    return traffic.wrap_session(session)
+
+
+@async_runtime.on_shutdown
+async def close():
+    """
+    Closes the pooled aiohttp session of the running event loop.
+    """
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def get_requests_session():
+    """
+    Returns the pooled requests session of this process. Pass SYNC_TIMEOUT to each call.
+    """
+    global _sync_session, _sync_session_pid
+    with _lock:
+        if _sync_session is None or _sync_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_LIMIT, pool_maxsize=POOL_LIMIT_PER_HOST
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sync_session = session
+            _sync_session_pid = os.getpid()
+        return _sync_session
+
+
+def stats():
+    """
+    Returns utilization counters of the async pool and the open connections of both
+    pools.
+    """
+    with _lock:
+        pool_stats = dict(_stats)
+
+    open_connections = 0
+    idle_connections = 0
+    for session in list(_sessions.values()):
+        connector = session.connector
+        if connector is None or session.closed:
+            continue
+        # aiohttp does not expose these counts publicly
+        open_connections += len(getattr(connector, "_acquired", ()))
+        idle_connections += sum(
+            len(connections)
+            for connections in getattr(connector, "_conns", {}).values()
+        )
+    pool_stats["async_connections_in_use"] = open_connections
+    pool_stats["async_connections_idle"] = idle_connections
+    pool_stats["async_pool_limit"] = POOL_LIMIT
+    pool_stats["async_pool_utilization"] = open_connections / POOL_LIMIT
+
+    sync_connections = 0
+    if _sync_session is not None and _sync_session_pid == os.getpid():
+        for adapter in set(_sync_session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                sync_connections += pool.num_connections
+    pool_stats["sync_connections_created"] = sync_connections
+    return pool_stats
@@ -2,90 +2,184 @@
 """
 This module contains the ImageGenerator class, which is used to generate images using the ImaginePro API.
 """
+
 import asyncio
 import logging
 import random
-import time
+import weakref
+
+import config
+import http_pool
+from image_status import status_tracker
+from rate_limiter import (
+    MAX_RATE_LIMIT_RETRIES,
+    ORDER_RETRY,
+    priority,
+    rate_limiter,
+    retry_after_seconds,
+)
+from single_flight import single_flight
+from telemetry import span
+
+DEFAULT_BASE_URL = "https://api.imaginepro.ai/api/v1/midjourney"
+UPSCALE_BUTTONS = ["U1", "U2", "U3", "U4"]
 
-import aiohttp
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when ImaginePro keeps answering 429 after every retry.
+    """
 
 
 class ImageGenerator:
-    def __init__(self, api_key):
+    # Concurrency limiters are bound to an event loop, so they are kept per loop:
+    # {loop: {"__global__": Semaphore, (api_key, max_concurrency): Semaphore, ...}}
+    # Generators of one key with different limits each get their own semaphore.
+    _limiters = weakref.WeakKeyDictionary()
+
+    def __init__(self, api_key, base_url=None, max_concurrency=None):
         self.api_key = api_key
+        self.base_url = (
+            base_url or config.get("MID_API_BASE_URL") or DEFAULT_BASE_URL
+        ).rstrip("/")
+        self.max_concurrency = max_concurrency or int(
+            config.get("MID_MAX_CONCURRENCY", "4")
+        )
+        self.global_max_concurrency = int(
+            config.get("MID_GLOBAL_MAX_CONCURRENCY", "16")
+        )
+        self.page_max_attempts = int(config.get("MID_PAGE_MAX_ATTEMPTS", "3"))
+        self.page_retry_backoff = float(config.get("MID_PAGE_RETRY_BACKOFF", "10"))
+        self.webhook_url = config.get("MID_WEBHOOK_URL")
         logging.basicConfig(
             level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
         )
 
+    def _with_webhook(self, data):
+        # Ask ImaginePro to push status updates to our callback endpoint when configured
+        if self.webhook_url:
+            data["webhookOverride"] = self.webhook_url
+        return data
+
+    async def _request(self, session, method, path, data=None):
+        # Every ImaginePro call is scheduled by the shared rate limiter, and a 429
+        # pauses this key's bucket for the Retry-After period before the call is retried
+        url = f"{self.base_url}/{path}"
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        for _ in range(MAX_RATE_LIMIT_RETRIES + 1):
+            await rate_limiter.acquire("imaginepro", self.api_key)
+            async with session.request(
+                method, url, headers=headers, json=data
+            ) as response:
+                if response.status != 429:
+                    return await response.json()
+                rate_limiter.pause(
+                    "imaginepro", self.api_key, retry_after_seconds(response.headers)
+                )
+        raise RateLimitExceeded(f"ImaginePro rate limit exceeded for {path}")
+
     async def mymidjourney_imagine(self, prompt, session):
         try:
-            url = "https://api.imaginepro.ai/api/v1/midjourney/imagine"
-            headers = {"Authorization": f"Bearer {self.api_key}"}
-            data = {"prompt": prompt}
-
-            async with session.post(url, headers=headers, json=data) as response:
-                logging.info("Image generation request sent.")
-                return await response.json()
+            data = self._with_webhook({"prompt": prompt})
+            result = await self._request(session, "POST", "imagine", data)
+            logging.info("Image generation request sent.")
+            return result
         except Exception as e:
             logging.error(f"Error in image generation: {e}")
             return None
 
     async def check_image_status(self, message_id, session):
         try:
-            url = f"https://api.imaginepro.ai/api/v1/midjourney/message/{message_id}"
-            headers = {"Authorization": f"Bearer {self.api_key}"}
-
-            async with session.get(url, headers=headers) as response:
-                logging.info("Image status check request sent.")
-                return await response.json()
+            result = await self._request(session, "GET", f"message/{message_id}")
+            logging.info("Image status check request sent.")
+            return result
         except Exception as e:
             logging.error(f"Error checking image status: {e}")
             return None
 
-    async def perform_button_action(self, message_id, session):
+    async def perform_button_action(self, message_id, session, buttons=None):
         try:
-            buttons = ["U1", "U2", "U3", "U4"]
-            selected_button = random.choice(buttons)
-            url = "https://api.imaginepro.ai/api/v1/midjourney/button"
-            headers = {"Authorization": f"Bearer {self.api_key}"}
-            data = {"messageId": message_id, "button": selected_button}
-
-            async with session.post(url, headers=headers, json=data) as response:
-                logging.info(f"Button action '{selected_button}' applied.")
-                resp_json = await response.json()
-                new_message_id = resp_json.get("messageId", message_id)
-                return new_message_id
+            selected_button = random.choice(buttons or UPSCALE_BUTTONS)
+            data = self._with_webhook(
+                {"messageId": message_id, "button": selected_button}
+            )
+
+            resp_json = await self._request(session, "POST", "button", data)
+            logging.info(f"Button action '{selected_button}' applied.")
+            new_message_id = resp_json.get("messageId", message_id)
+            return new_message_id, selected_button
         except Exception as e:
             logging.error(f"Error in button action: {e}")
-            return None
+            return None, None
 
-    async def wait_for_image_ready(self, message_id, session, timeout=200, interval=10):
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            status_result = await self.check_image_status(message_id, session)
-            if status_result and status_result.get("progress") == 100:
-                return status_result
-            logging.info("Image not ready yet, waiting for more time.")
-            await asyncio.sleep(interval)
-        logging.error("Timed out waiting for the image to be ready.")
-        return None
+    async def wait_for_image_ready(self, message_id, session, timeout=200):
+        async def fetch_status(message_id):
+            return await self.check_image_status(message_id, session)
 
-    async def generate_and_select_image(self, prompt, session):
-        print("Generating image...")
-        result = await self.mymidjourney_imagine(prompt, session)
-        if not result or "messageId" not in result:
-            logging.error("No messageId in the response from mymidjourney_imagine")
-            return None
+        return await status_tracker.wait(message_id, fetch_status, timeout)
+
+    async def generate_and_select_image(self, prompt, session, render=None):
+        """
+        Renders a prompt and upscales one of the four images of the grid. A first
+        attempt at a prompt that is already being rendered, e.g. the same child image
+        prompt of another order, shares that render.
+
+        :param render: Optional dict carried across attempts at the same prompt. It
+            remembers the finished grid and the upscale buttons already tried, so a
+            retry upscales a different image of that grid instead of rendering the
+            prompt again.
+        :return: The URI of the upscaled image, or None on failure.
+        """
+        render = {} if render is None else render
+        if render.get("grid_message_id") or render.get("tried_buttons"):
+            # A retry continues with its own grid
+            return await self._generate_and_select_image(prompt, session, render)
+        return await single_flight.run(
+            "image",
+            (self.base_url, prompt),
+            lambda: self._generate_and_select_image(prompt, session, render),
+        )
+
+    async def _generate_and_select_image(self, prompt, session, render):
+        tried_buttons = render.setdefault("tried_buttons", [])
+        buttons = [button for button in UPSCALE_BUTTONS if button not in tried_buttons]
+        if not buttons:
+            render.pop("grid_message_id", None)
+            tried_buttons.clear()
+            buttons = list(UPSCALE_BUTTONS)
+
+        if render.get("grid_message_id"):
+            result = {"messageId": render["grid_message_id"]}
+            status_result = {"progress": 100}
+        else:
+            logging.info(f"Generating image for prompt: {prompt}")
+            with span("image_imagine"):
+                result = await self.mymidjourney_imagine(prompt, session)
+            if not result or "messageId" not in result:
+                logging.error("No messageId in the response from mymidjourney_imagine")
+                return None
+            status_result = None
 
         if result:
             message_id = result["messageId"]
-            status_result = await self.wait_for_image_ready(message_id, session)
+            if status_result is None:
+                with span("image_poll"):
+                    status_result = await self.wait_for_image_ready(message_id, session)
             if status_result and status_result["progress"] == 100:
-                new_message_id = await self.perform_button_action(message_id, session)
-                if new_message_id:
-                    updated_status = await self.wait_for_image_ready(
-                        new_message_id, session
+                render["grid_message_id"] = message_id
+                with span("image_upscale") as upscale_span:
+                    new_message_id, selected_button = await self.perform_button_action(
+                        message_id, session, buttons
                     )
+                    upscale_span.set(button=selected_button)
+                    updated_status = None
+                    if new_message_id:
+                        updated_status = await self.wait_for_image_ready(
+                            new_message_id, session
+                        )
+                if selected_button:
+                    tried_buttons.append(selected_button)
+                if new_message_id:
                     if updated_status and updated_status["progress"] == 100:
                         image_uri = updated_status["uri"]
                         logging.info(f"Image uri: {image_uri}")
@@ -100,13 +194,124 @@ class ImageGenerator:
             logging.error("Initial image generation failed.")
         return None
 
-    async def generate_images(self, prompts):
+    def _get_limiters(self):
+        loop_limiters = self._limiters.setdefault(asyncio.get_running_loop(), {})
+        if "__global__" not in loop_limiters:
+            loop_limiters["__global__"] = asyncio.Semaphore(self.global_max_concurrency)
+        key = (self.api_key, self.max_concurrency)
+        if key not in loop_limiters:
+            loop_limiters[key] = asyncio.Semaphore(self.max_concurrency)
+        return loop_limiters["__global__"], loop_limiters[key]
+
+    async def _generate_indexed_image(self, index, prompt, session):
+        global_limiter, key_limiter = self._get_limiters()
+        render = {}
+        for attempt in range(1, self.page_max_attempts + 1):
+            image_uri = None
+            async with global_limiter, key_limiter:
+                with span("image", index=index, attempt=attempt) as image_span:
+                    try:
+                        with priority(order=None if attempt == 1 else ORDER_RETRY):
+                            image_uri = await self.generate_and_select_image(
+                                prompt, session, render
+                            )
+                    except Exception as e:
+                        logging.error(f"Error in generating image {index}: {e}")
+                    if not image_uri:
+                        image_span.status = "error"
+            if image_uri:
+                return index, image_uri
+            if attempt < self.page_max_attempts:
+                # Back off outside the concurrency limits so other prompts can use the
+                # slot
+                delay = (
+                    self.page_retry_backoff
+                    * 2 ** (attempt - 1)
+                    * random.uniform(0.5, 1.5)
+                )
+                logging.warning(
+                    "Image %d failed on attempt %d, retrying in %.1fs",
+                    index,
+                    attempt,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+        return index, None
+
+    async def generate_images(self, prompts, on_result=None):
+        """
+        Generates one image per prompt, rendering several prompts at a time.
+
+        At most ``max_concurrency`` prompts are in flight per API key, and at most
+        ``MID_GLOBAL_MAX_CONCURRENCY`` across all generators in the process. A failed
+        prompt is retried up to ``MID_PAGE_MAX_ATTEMPTS`` times with exponential
+        backoff.
+
+        :param prompts: List of image prompts.
+        :param on_result: Optional callback (or coroutine function) called with
+            ``(index, image_uri)`` as soon as each prompt finishes.
+        :return: List of image URIs in prompt order, with None for failed prompts.
+        """
+        image_uris = [None] * len(prompts)
+        session = http_pool.get_session()
+        tasks = [
+            asyncio.create_task(self._generate_indexed_image(index, prompt, session))
+            for index, prompt in enumerate(prompts)
+        ]
+        for next_done in asyncio.as_completed(tasks):
+            index, image_uri = await next_done
+            image_uris[index] = image_uri
+            await self._report(on_result, index, image_uri)
+        return image_uris
+
+    async def generate_image_stream(self, prompts, on_result=None):
+        """
+        Generates one image per prompt of an async iterable, starting each prompt as
+        soon as it arrives, so rendering overlaps whatever is still producing the later
+        prompts. Concurrency limits and retries are the same as for ``generate_images``.
+
+        :param prompts: Async iterable of image prompts.
+        :param on_result: Optional callback (or coroutine function) called with
+            ``(index, image_uri)`` as soon as each prompt finishes, indexed in arrival
+            order.
+        :return: List of image URIs in arrival order, with None for failed prompts.
+        """
         image_uris = []
-        async with aiohttp.ClientSession() as session:
-            for prompt in prompts:
-                try:
-                    image_uri = await self.generate_and_select_image(prompt, session)
-                    image_uris.append(image_uri)
-                except Exception as e:
-                    logging.error(f"Error in generating image: {e}")
+        session = http_pool.get_session()
+        results = asyncio.Queue()
+
+        async def render(index, prompt):
+            results.put_nowait(
+                await self._generate_indexed_image(index, prompt, session)
+            )
+
+        async def report():
+            while True:
+                index, image_uri = await results.get()
+                image_uris[index] = image_uri
+                await self._report(on_result, index, image_uri)
+                results.task_done()
+
+        reporter = asyncio.create_task(report())
+        tasks = []
+        try:
+            async for prompt in prompts:
+                image_uris.append(None)
+                tasks.append(asyncio.create_task(render(len(image_uris) - 1, prompt)))
+            await asyncio.gather(*tasks)
+            await results.join()
+        finally:
+            reporter.cancel()
+            for task in tasks:
+                task.cancel()
         return image_uris
+
+    async def _report(self, on_result, index, image_uri):
+        if not on_result:
+            return
+        try:
+            callback_result = on_result(index, image_uri)
+            if asyncio.iscoroutine(callback_result):
+                await callback_result
+        except Exception as e:
+            logging.error(f"Error in image result callback: {e}")
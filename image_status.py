@@ -0,0 +1,205 @@
+"""
+This module tracks the status of in-flight ImaginePro messages.
+
+A single polling loop per event loop checks every tracked message that is due, with an
+interval that adapts to each message's reported progress. Status updates pushed by the
+provider's webhook resolve waiting messages immediately, with polling kept as a slower
+fallback.
+"""
+
+import asyncio
+import logging
+import threading
+
+import config
+
+FAILED_STATUSES = {"FAIL", "FAILED", "ERROR"}
+
+
+class _TrackedMessage:
+    def __init__(self, message_id, fetch_status, future, next_check, interval):
+        self.message_id = message_id
+        self.fetch_status = fetch_status
+        self.future = future
+        self.next_check = next_check
+        self.interval = interval
+        self.checking = False
+        self.last_progress = None
+        self.last_progress_at = None
+
+
+class ImageStatusTracker:
+    def __init__(self, initial_interval=None, min_interval=None, max_interval=None):
+        """
+        :param initial_interval: Seconds before the first status check of a message.
+        :param min_interval: Shortest interval between checks of one message.
+        :param max_interval: Longest interval between checks of one message.
+        """
+        self.initial_interval = initial_interval or float(
+            config.get("MID_STATUS_INITIAL_INTERVAL", "5")
+        )
+        self.min_interval = min_interval or float(
+            config.get("MID_STATUS_MIN_INTERVAL", "2")
+        )
+        self.max_interval = max_interval or float(
+            config.get("MID_STATUS_MAX_INTERVAL", "15")
+        )
+        # With webhooks delivering updates, polling only needs to catch missed pushes
+        self.push_enabled = bool(config.get("MID_WEBHOOK_URL"))
+        self.stats = {
+            "checks": 0,
+            "pushes": 0,
+            "completed": 0,
+            "failed": 0,
+            "timeouts": 0,
+        }
+
+        self._lock = threading.Lock()
+        self._loop = None
+        self._entries = {}
+        self._wakeup = None
+        self._task = None
+        self._checks = set()
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._loop is not loop or self._task is None or self._task.done():
+                self._loop = loop
+                self._entries = {}
+                self._wakeup = asyncio.Event()
+                self._task = loop.create_task(self._run())
+
+    async def wait(self, message_id, fetch_status, timeout=200):
+        """
+        Waits until a message reaches 100% progress with an image uri.
+
+        :param fetch_status: Coroutine function returning the status dict of a message
+            id.
+        :return: The final status dict, or None if the message failed or timed out.
+        """
+        self._ensure_running()
+        interval = self.initial_interval
+        entry = _TrackedMessage(
+            message_id,
+            fetch_status,
+            self._loop.create_future(),
+            self._loop.time() + interval,
+            interval,
+        )
+        self._entries[message_id] = entry
+        self._wakeup.set()
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry.future), timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            logging.error("Timed out waiting for the image to be ready.")
+            return None
+        finally:
+            self._entries.pop(message_id, None)
+
+    def push(self, status_result):
+        """
+        Accepts a status update pushed by the provider. Safe to call from any thread.
+
+        :return: False if no event loop is tracking messages yet.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return False
+        loop.call_soon_threadsafe(self._apply, status_result, True)
+        return True
+
+    def _apply(self, status_result, pushed=False):
+        entry = self._entries.get(status_result.get("messageId"))
+        if entry is None or entry.future.done():
+            return
+        if pushed:
+            self.stats["pushes"] += 1
+
+        progress = status_result.get("progress")
+        # Failed messages can be reported at 100% progress too
+        if str(status_result.get("status", "")).upper() in FAILED_STATUSES:
+            self.stats["failed"] += 1
+            logging.error(
+                "Image %s failed: %s", entry.message_id, status_result.get("error")
+            )
+            entry.future.set_result(None)
+        elif progress == 100 and status_result.get("uri"):
+            self.stats["completed"] += 1
+            entry.future.set_result(status_result)
+        else:
+            self._schedule(entry, progress)
+
+    def _schedule(self, entry, progress):
+        now = self._loop.time()
+        if not isinstance(progress, (int, float)):
+            interval = entry.interval * 1.5
+        elif (
+            entry.last_progress is not None
+            and progress > entry.last_progress
+            and now > entry.last_progress_at
+        ):
+            # Check again about halfway to the completion time predicted from the
+            # progress rate
+            rate = (progress - entry.last_progress) / (now - entry.last_progress_at)
+            interval = (100 - progress) / rate / 2
+        else:
+            interval = entry.interval * 1.5
+        if isinstance(progress, (int, float)) and progress != entry.last_progress:
+            entry.last_progress = progress
+            entry.last_progress_at = now
+
+        max_interval = self.max_interval
+        if self.push_enabled:
+            interval *= 3
+            max_interval *= 3
+        entry.interval = min(max(interval, self.min_interval), max_interval)
+        entry.next_check = now + entry.interval
+
+    async def _check(self, entry):
+        try:
+            status_result = await entry.fetch_status(entry.message_id)
+        except Exception as e:
+            logging.error(f"Error checking image status: {e}")
+            status_result = None
+        finally:
+            entry.checking = False
+        self.stats["checks"] += 1
+        if status_result:
+            self._apply(status_result)
+        else:
+            self._schedule(entry, None)
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = self._loop.time()
+            for entry in list(self._entries.values()):
+                if (
+                    not entry.checking
+                    and not entry.future.done()
+                    and entry.next_check <= now
+                ):
+                    entry.checking = True
+                    check = self._loop.create_task(self._check(entry))
+                    self._checks.add(check)
+                    check.add_done_callback(self._checks.discard)
+
+            pending = [
+                entry.next_check
+                for entry in self._entries.values()
+                if not entry.checking and not entry.future.done()
+            ]
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(),
+                    max(min(pending) - now, 0) if pending else None,
+                )
+            except asyncio.TimeoutError:
+                pass
+
+
+# Shared tracker used by all ImageGenerator instances
+status_tracker = ImageStatusTracker()
@@ -0,0 +1,375 @@
+"""
+This module contains a persistent job queue for background image generation.
+
+Jobs and the output of each completed stage are stored in the application database.
+Workers hold a lease on the job they run, so jobs left behind by a crashed or restarted
+process are picked up again and resume from their last checkpoint instead of starting
+over.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, update
+
+import async_runtime
+import config
+from models import ImageJob, JobCheckpoint, db
+from rate_limiter import ORDER_BACKGROUND, ORDER_NEW, ORDER_RETRY, priority
+from telemetry import span
+
+
+class Checkpoints:
+    """
+    Stage outputs of one pipeline run, kept in memory.
+    """
+
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+
+    def get(self, name, default=None):
+        return self._values.get(name, default)
+
+    async def save(self, name, value):
+        self._values[name] = value
+
+
+class JobCheckpoints(Checkpoints):
+    """
+    Stage outputs of a queued job, persisted as soon as each stage completes.
+    """
+
+    def __init__(self, queue, job_id, values=None):
+        super().__init__(values)
+        self._queue = queue
+        self._job_id = job_id
+
+    async def save(self, name, value):
+        await super().save(name, value)
+        await asyncio.to_thread(self._queue._save_checkpoint, self._job_id, name, value)
+
+
+class JobQueue:
+    def __init__(
+        self,
+        app,
+        handler,
+        workers=None,
+        poll_interval=None,
+        lease_seconds=None,
+        max_attempts=None,
+        on_finished=None,
+    ):
+        """
+        :param app: Flask app whose database stores the jobs.
+        :param handler: Coroutine function called as ``handler(tripetto_id, payload,
+            checkpoints)``.
+        :param workers: Number of jobs run at once by this process.
+        :param poll_interval: Seconds an idle worker waits before checking the database
+            again.
+        :param lease_seconds: Seconds without a heartbeat after which a running job is
+            reclaimed.
+        :param max_attempts: Attempts before a job is marked as failed.
+        :param on_finished: Optional coroutine function called as
+            ``on_finished(tripetto_id, payload, status, error)`` once a job completes or
+            finally fails.
+        """
+        self.app = app
+        self.handler = handler
+        self.on_finished = on_finished
+        self.workers = workers or int(config.get("JOB_WORKERS", "4"))
+        self.poll_interval = poll_interval or float(
+            config.get("JOB_POLL_INTERVAL", "2")
+        )
+        self.lease_seconds = lease_seconds or float(
+            config.get("JOB_LEASE_SECONDS", "120")
+        )
+        self.max_attempts = max_attempts or int(config.get("JOB_MAX_ATTEMPTS", "3"))
+        self.worker_name = None
+
+        self._lock = threading.Lock()
+        self._started = False
+        self._wakeup = None
+        self._tasks = []
+
+    def start(self):
+        """
+        Starts the worker pool on the shared event loop. Safe to call more than once.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self.worker_name = f"{socket.gethostname()}:{os.getpid()}"
+        async_runtime.submit(self._start_workers())
+        logging.info("Started %d image job workers", self.workers)
+
+    def enqueue(self, tripetto_id, payload):
+        """
+        Stores a new job and wakes an idle worker. Must be called within an app context.
+
+        :return: The id of the new job.
+        """
+        job = ImageJob(tripettoId=tripetto_id, payload=json.dumps(payload))
+        db.session.add(job)
+        db.session.commit()
+        self.start()
+        if self._wakeup is not None:
+            async_runtime.get_loop().call_soon_threadsafe(self._wakeup.set)
+        return job.id
+
+    def repair(self, tripetto_id, pages=None):
+        """
+        Queues the latest job of an order again. Its checkpoints are kept, so only
+        missing pages are rendered before the book is uploaded again. Must be called
+        within an app context.
+
+        :param pages: Optional page labels, e.g. ["page_03"], to discard and render
+            again.
+        :return: The id of the requeued job, or None if there is no job.
+        """
+        job = (
+            ImageJob.query.filter_by(tripettoId=tripetto_id)
+            .order_by(ImageJob.id.desc())
+            .first()
+        )
+        if job is None:
+            return None
+        if pages:
+            JobCheckpoint.query.filter(
+                JobCheckpoint.job_id == job.id,
+                JobCheckpoint.name.in_(
+                    [page for page in pages if page.startswith("page_")]
+                ),
+            ).delete(synchronize_session=False)
+        job.status = "queued"
+        job.attempts = 0
+        job.error = None
+        job.available_at = datetime.utcnow()
+        db.session.commit()
+        logging.info("Image job %d queued for repair", job.id)
+        self.start()
+        if self._wakeup is not None:
+            async_runtime.get_loop().call_soon_threadsafe(self._wakeup.set)
+        return job.id
+
+    def status(self, tripetto_id):
+        """
+        Returns the state of the latest job for an order, or None if there is no job.
+        Must be called within an app context.
+        """
+        job = (
+            ImageJob.query.filter_by(tripettoId=tripetto_id)
+            .order_by(ImageJob.id.desc())
+            .first()
+        )
+        if job is None:
+            return None
+        stages = [
+            name
+            for (name,) in db.session.query(JobCheckpoint.name)
+            .filter_by(job_id=job.id)
+            .order_by(JobCheckpoint.id)
+        ]
+        return {
+            "job_id": job.id,
+            "tripettoId": job.tripettoId,
+            "status": job.status,
+            "attempts": job.attempts,
+            "error": job.error,
+            "stages": [name for name in stages if not name.startswith("page_")],
+            # Each page is saved with the prompt it was rendered from, as
+            # "page_NN_prompt"
+            "pages_completed": sum(
+                1
+                for name in stages
+                if name.startswith("page_") and not name.endswith("_prompt")
+            ),
+            "created_at": job.created_at.isoformat(),
+            "updated_at": job.updated_at.isoformat(),
+        }
+
+    def states(self, job_ids):
+        """
+        Returns ``{job_id: (status, error)}`` for the given jobs. Must be called within
+        an app context.
+        """
+        return {
+            job_id: (status, error)
+            for job_id, status, error in db.session.query(
+                ImageJob.id, ImageJob.status, ImageJob.error
+            ).filter(ImageJob.id.in_(job_ids))
+        }
+
+    async def _start_workers(self):
+        self._wakeup = asyncio.Event()
+        # Workers start from an empty context so they do not inherit the span or rate
+        # limit priority of whichever request happened to start the queue
+        self._tasks = [
+            contextvars.Context().run(asyncio.create_task, self._worker())
+            for _ in range(self.workers)
+        ]
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self._claim_job)
+            except Exception as e:
+                logging.error(f"Error claiming image job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run_job(job)
+
+    async def _run_job(self, job):
+        logging.info(
+            "Running image job %d for %s (attempt %d)",
+            job["id"],
+            job["tripettoId"],
+            job["attempts"],
+        )
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"]))
+        error = None
+        try:
+            checkpoints = JobCheckpoints(self, job["id"], job["checkpoints"])
+            # Retried jobs queue behind first attempts for the shared API rate limits,
+            # and bulk orders behind both
+            if job["payload"].get("background"):
+                order = ORDER_BACKGROUND
+            else:
+                order = ORDER_RETRY if job["attempts"] > 1 else ORDER_NEW
+            with priority(order=order), span(
+                "image_job",
+                tripettoId=job["tripettoId"],
+                job_id=job["id"],
+                attempt=job["attempts"],
+            ):
+                await self.handler(job["tripettoId"], job["payload"], checkpoints)
+        except Exception as e:
+            error = str(e)
+            status = await asyncio.to_thread(self._fail_job, job, e)
+        else:
+            status = await asyncio.to_thread(self._finish_job, job["id"])
+        finally:
+            heartbeat.cancel()
+
+        if self.on_finished and status in ("completed", "failed"):
+            try:
+                await self.on_finished(job["tripettoId"], job["payload"], status, error)
+            except Exception as e:
+                logging.error(f"Error in image job {job['id']} finished callback: {e}")
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self._touch_job, job_id)
+            except Exception as e:
+                logging.error(f"Error updating heartbeat of image job {job_id}: {e}")
+
+    def _claim_job(self):
+        with self.app.app_context():
+            now = datetime.utcnow()
+            candidates = (
+                ImageJob.query.filter(
+                    or_(
+                        and_(ImageJob.status == "queued", ImageJob.available_at <= now),
+                        and_(
+                            ImageJob.status == "running",
+                            ImageJob.heartbeat_at
+                            < now - timedelta(seconds=self.lease_seconds),
+                        ),
+                    )
+                )
+                .order_by(ImageJob.id)
+                .limit(self.workers)
+                .all()
+            )
+            for job in candidates:
+                # Another worker may claim the same job; only one update can match.
+                claimed = db.session.execute(
+                    update(ImageJob)
+                    .where(
+                        ImageJob.id == job.id,
+                        ImageJob.status == job.status,
+                        ImageJob.attempts == job.attempts,
+                    )
+                    .values(
+                        status="running",
+                        attempts=job.attempts + 1,
+                        worker=self.worker_name,
+                        heartbeat_at=now,
+                        updated_at=now,
+                    )
+                )
+                db.session.commit()
+                if claimed.rowcount != 1:
+                    continue
+                checkpoints = JobCheckpoint.query.filter_by(job_id=job.id).all()
+                return {
+                    "id": job.id,
+                    "tripettoId": job.tripettoId,
+                    "payload": json.loads(job.payload),
+                    "attempts": job.attempts + 1,
+                    "checkpoints": {
+                        checkpoint.name: json.loads(checkpoint.value)
+                        for checkpoint in checkpoints
+                    },
+                }
+            return None
+
+    def _touch_job(self, job_id):
+        with self.app.app_context():
+            db.session.execute(
+                update(ImageJob)
+                .where(ImageJob.id == job_id, ImageJob.worker == self.worker_name)
+                .values(heartbeat_at=datetime.utcnow())
+            )
+            db.session.commit()
+
+    def _finish_job(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(ImageJob, job_id)
+            job.status = "completed"
+            job.error = None
+            db.session.commit()
+        logging.info("Image job %d completed", job_id)
+        return "completed"
+
+    def _fail_job(self, job, error):
+        with self.app.app_context():
+            stored_job = db.session.get(ImageJob, job["id"])
+            stored_job.error = str(error)
+            if job["attempts"] >= self.max_attempts:
+                stored_job.status = "failed"
+                logging.error("Image job %d failed: %s", job["id"], error)
+            else:
+                stored_job.status = "queued"
+                stored_job.available_at = datetime.utcnow() + timedelta(
+                    seconds=30 * 2 ** (job["attempts"] - 1)
+                )
+                logging.warning("Image job %d failed, will retry: %s", job["id"], error)
+            db.session.commit()
+            return stored_job.status
+
+    def _save_checkpoint(self, job_id, name, value):
+        with self.app.app_context():
+            checkpoint = JobCheckpoint.query.filter_by(
+                job_id=job_id, name=name
+            ).first() or JobCheckpoint(job_id=job_id, name=name)
+            checkpoint.value = json.dumps(value)
+            db.session.add(checkpoint)
+            db.session.commit()
@@ -0,0 +1,115 @@
+"""
+This module parses JSON documents that arrive in pieces, e.g. assistant responses being
+streamed.
+
+``JSONMemberStream`` watches one object of the document, such as ``{"image_prompts":
+{...}}``'s inner object, and returns each of its members as soon as the member's value
+is complete, while the rest of the document is still being written. Text around the
+document, such as Markdown code fences or a ``book_data =`` prefix, is ignored.
+"""
+
+import json
+
+
+class JSONMemberStream:
+    def __init__(self, path=()):
+        """
+        :param path: Keys leading from the top-level object to the object whose members
+            are returned, e.g. ("image_prompts",). The default is the top-level object
+            itself.
+        """
+        self.path = tuple(path)
+        self.text = ""
+        self.emitted = 0
+        self._position = 0
+        # Open containers as [bracket, key of the member being parsed, expecting a key]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._string_is_key = False
+        self._scalar_start = None
+        # (key, start, depth) of the watched member being parsed
+        self._member = None
+        self._finished = False
+
+    def feed(self, chunk):
+        """
+        Adds the next piece of the document.
+
+        :return: List of ``(key, value)`` of the watched members completed by this
+            piece.
+        """
+        self.text += chunk
+        members = []
+        text = self.text
+        for index in range(self._position, len(text)):
+            char = text[index]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._stack[-1][1] = json.loads(
+                            text[self._string_start : index + 1]
+                        )
+                    else:
+                        self._end_value(index + 1, members)
+                continue
+            if self._finished:
+                break
+            if self._scalar_start is not None and (char in ",}]" or char.isspace()):
+                self._end_value(index, members)
+            if not self._stack:
+                if char == "{":
+                    self._stack.append(["{", None, True])
+                continue
+
+            frame = self._stack[-1]
+            if char == '"':
+                self._in_string = True
+                self._string_start = index
+                self._string_is_key = frame[0] == "{" and frame[2]
+                if not self._string_is_key:
+                    self._begin_value(index)
+            elif char in "{[":
+                self._begin_value(index)
+                self._stack.append([char, None, char == "{"])
+            elif char in "}]":
+                self._stack.pop()
+                if self._stack:
+                    self._end_value(index + 1, members)
+                else:
+                    self._finished = True
+            elif char == ":":
+                frame[2] = False
+            elif char == ",":
+                if frame[0] == "{":
+                    frame[2] = True
+            elif not char.isspace() and self._scalar_start is None:
+                self._begin_value(index)
+                self._scalar_start = index
+        self._position = len(text)
+        return members
+
+    def _begin_value(self, start):
+        if self._member is not None or self._stack[-1][0] != "{":
+            return
+        if tuple(frame[1] for frame in self._stack[:-1]) == self.path:
+            self._member = (self._stack[-1][1], start, len(self._stack))
+
+    def _end_value(self, end, members):
+        self._scalar_start = None
+        if self._member is None or len(self._stack) != self._member[2]:
+            return
+        key, start, _ = self._member
+        self._member = None
+        try:
+            value = json.loads(self.text[start:end])
+        except ValueError:
+            return
+        members.append((key, value))
+        self.emitted += 1
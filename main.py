@@ -2,170 +2,493 @@ import asyncio
 import json
 import logging
 import os
+import shutil
+import threading
+import time
 import traceback
-from threading import Thread
-
-import dotenv
-import requests
-from flask import Flask, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
-
+import uuid
+from collections import OrderedDict
+
+from flask import Flask, Response, jsonify, request, send_file, url_for
+from werkzeug.utils import secure_filename
+
+import async_runtime
+import batch
+import config
+import http_pool
+import telemetry
+import traffic
+from assistant_cache import assistant_cache
+from assistant_output import output_stats, parse_output
+from assistant_runs import run_metrics
+from assistant_sessions import sessions
 from child_image_prompt_generator import generate_child_image_prompt
 from extract_images import extract_output_image_prompts
 
 # Import custom modules
 from image_generator import ImageGenerator
+from image_status import status_tracker
+from job_queue import Checkpoints, JobQueue
 from LSW_00_Tripetto_to_List import convert_tripetto_json_to_lists
 from LSW_01_story_generation import generate_story
 from LSW_02_visual_generation import generate_visual_description
 from LSW_03_image_prompt_generation import generate_image_prompts
+from models import db
+from page_delivery import PageDelivery
 from post_to_webhook import post_to_webhook
-
-# Initialize Flask app and load environment variables
-dotenv.load_dotenv()
+from rate_limiter import STAGE_REFERENCE, priority, rate_limiter
+from reference_images import reference_images, trait_key
+from response_cache import response_cache
+from single_flight import single_flight
+from stage_graph import Feed, Stage, StageGraph
+from storage import StoryStore, engine_options, migrate
+from telemetry import span
+
+# Initialize Flask app; settings, including those in .env, are read through config
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
 # Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = config.get(
+    "DATABASE_URL", "sqlite:///database.db"
+)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
-
-
-# Database model for story data
-class StoryData(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    tripettoId = db.Column(db.String(100), unique=True, nullable=False)
-    order = db.Column(db.Text)
-    story_configuration = db.Column(db.Text)
-    visual_configuration = db.Column(db.Text)
-    story = db.Column(db.Text)
-    image_urls = db.Column(db.Text)
-
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+    app.config["SQLALCHEMY_DATABASE_URI"]
+)
+db.init_app(app)
+story_store = StoryStore(app, response_cache)
+
+# Site receiving generated stories and page images
+SITE_URL = config.get("LSW_SITE_URL", "https://littlestorywriter.com").rstrip("/")
+
+# Whether pages start rendering while the image prompt assistant is still writing later
+# prompts
+IMAGE_PROMPT_STREAMING = config.get("IMAGE_PROMPT_STREAMING", "1") == "1"
+
+
+async def post_json(url, payload, headers=None):
+    """
+    POSTs a JSON payload over the pooled HTTP session without blocking the event loop.
+
+    :return: Tuple of the response status code and body text.
+    """
+    session = http_pool.get_session()
+    async with session.post(url, json=payload, headers=headers) as response:
+        return response.status, await response.text()
+
+
+page_delivery = PageDelivery(post_json, f"{SITE_URL}/img-upload")
+
+
+def image_generator():
+    mid_api_key = config.get("MID_API_KEY")
+    if not mid_api_key:
+        raise EnvironmentError("MID_API_KEY environment variable not found.")
+    return ImageGenerator(mid_api_key)
+
+
+def build_story_response(
+    tripetto_id, order, story_configuration, visual_configuration, book_data
+):
+    return {
+        "tripettoId": tripetto_id,
+        "order": order,
+        "story_configuration": story_configuration,
+        "visual_configuration": visual_configuration,
+        "story": book_data,
+    }
+
+
+async def generate_and_post_story(
+    tripetto_id, order, story_configuration, visual_configuration
+):
+    """
+    Generates the story for an accepted order, stores it and posts it to
+    littlestorywriter.com.
+    """
+    book_data = await generate_story(story_configuration)
+    logging.info(f"Book data generated: {book_data}")
+    post_to_webhook(f"Book data generated: {book_data}")
+    if not book_data:
+        raise RuntimeError("No story generated.")
+    await asyncio.to_thread(
+        story_store.update, tripetto_id, story=book_data, status="story_ready"
+    )
+
+    response_data = build_story_response(
+        tripetto_id, order, story_configuration, visual_configuration, book_data
+    )
+    endpoint_url = f"{SITE_URL}/process-story"
+    status_code, response_text = await post_json(endpoint_url, response_data)
+    logging.info(f"Response from webhook: {response_text}")
+    if status_code != 200:
+        raise RuntimeError(f"Failed to post story. Status: {status_code}")
+    return book_data
+
+
+async def generate_visual_stage(visual_configuration):
+    visual_descriptions = await generate_visual_description(visual_configuration)
+    # Cached descriptions of earlier versions are still the raw reply text
+    updated_visual_description = parse_output("visual_description", visual_descriptions)
+    logging.info(
+        "Visual description Jsonified successfully: %s", updated_visual_description
+    )
+    post_to_webhook(
+        f"Visual description Jsonified successfully: {updated_visual_description}"
+    )
+    return updated_visual_description
+
+
+async def generate_child_image_stage(
+    visual_configuration, visual_description, checkpoints
+):
+    # Reuse a child image rendered for an earlier order with the same traits and style
+    reference_key = trait_key(visual_configuration)
+    child_image_uri = await asyncio.to_thread(reference_images.pick, reference_key)
+    if child_image_uri:
+        post_to_webhook("Reusing child image URI: %s" % child_image_uri)
+        return child_image_uri
+
+    generator = image_generator()
+    # Every page waits on the reference image, so it goes ahead of other page renders
+    with priority(stage=STAGE_REFERENCE):
+        # Generate the child image prompts
+        child_prompt = checkpoints.get("child_prompt")
+        if child_prompt is None:
+            with span("child_prompt"):
+                child_prompt = await generate_child_image_prompt(
+                    json.dumps(visual_description)
+                )
+                logging.info(
+                    "Child image prompt generated successfully: %s", child_prompt
+                )
+                if not child_prompt:
+                    raise RuntimeError("No valid child image prompt found.")
+                post_to_webhook("Child image prompt: %s" % child_prompt)
+                await checkpoints.save("child_prompt", child_prompt)
+
+        child_image_uris = await generator.generate_images(child_prompt)
+        logging.info("Child image generation complete")
+        if not (child_image_uris and child_image_uris[0]):
+            raise RuntimeError("No valid child image URI generated.")
+
+    child_image_uri = child_image_uris[0]
+    post_to_webhook("Child image URI generated: %s" % child_image_uri)
+    logging.info("Posted child image to webhook: %s", child_image_uri)
+    await asyncio.to_thread(reference_images.add, reference_key, child_image_uri)
+    return child_image_uri
+
+
+async def generate_image_prompts_stage(
+    story, visual_description, child_image, prompt_feed
+):
+    # The page prompts get the child's reference image in place of its description. The
+    # list is copied, since the visual description may be shared with another run of the
+    # order.
+    updated_visual_descriptions = list(visual_description)
+    updated_visual_descriptions[2] = {"child_image_uri": child_image}
+    logging.info("Updated visual descriptions: %s", updated_visual_descriptions)
+    post_to_webhook("Updated visual descriptions: %s" % updated_visual_descriptions)
 
-def generate_and_post_images(tripetto_id, story, visual_configuration):
     try:
-        visual_descriptions = generate_visual_description(visual_configuration)
-        cleaned_str = (
-            visual_descriptions.replace("```json", "").replace("```", "").strip()
-        )
-        updated_visual_description = json.loads(cleaned_str)
-        logging.info(
-            "Visual description Jsonified successfully: %s", updated_visual_description
-        )
-        post_to_webhook(
-            f"Visual description Jsonified successfully: {updated_visual_description}"
+        generated_response = await generate_image_prompts(
+            story,
+            updated_visual_descriptions,
+            on_prompt=(
+                (lambda page, prompt: prompt_feed.put(prompt))
+                if IMAGE_PROMPT_STREAMING
+                else None
+            ),
         )
 
-        # Generate the child image prompts
-        child_prompt = generate_child_image_prompt(
-            json.dumps(updated_visual_description)
+        # logging.info("Image prompts RAW: %s", image_prompts)
+        post_to_webhook("Image prompts RAW: %s" % generated_response)
+        if not generated_response:
+            raise RuntimeError("No image prompts generated.")
+
+        image_prompts = list(generated_response["image_prompts"].values())
+    except BaseException as e:
+        # The pages stage stops rendering along with this stage
+        prompt_feed.fail(e)
+        raise
+    if not IMAGE_PROMPT_STREAMING:
+        for prompt in image_prompts:
+            prompt_feed.put(prompt)
+    prompt_feed.close()
+
+    logging.info("Image prompts list: %s", image_prompts)
+    post_to_webhook("Image prompts list: %s" % image_prompts)
+    return image_prompts
+
+
+async def generate_pages_stage(tripetto_id, prompt_feed, checkpoints):
+    generator = image_generator()
+
+    page_prompts = {}
+    pending_labels = []
+    deliveries = []
+
+    def rendered(label):
+        # A page only counts as rendered from its current prompt. Pages of an earlier
+        # attempt whose prompts were streamed before that attempt's prompt stage failed
+        # are rendered again.
+        return (
+            checkpoints.get(label)
+            and checkpoints.get(f"{label}_prompt") == page_prompts[label]
         )
-        logging.info("Child image prompt generated successfully: %s", child_prompt)
 
-        if child_prompt:
-            post_to_webhook("Child image prompt: %s" % child_prompt)
-            mid_api_key = os.getenv("MID_API_KEY")
-            if not mid_api_key:
-                raise EnvironmentError("MID_API_KEY environment variable not found.")
-
-            generator = ImageGenerator(mid_api_key)
-
-            async def generate_and_post_child_image():
-                try:
-                    child_image_uris = await generator.generate_images(child_prompt)
-                    logging.info("Child image generation complete")
-
-                    if child_image_uris and child_image_uris[0]:
-                        child_image_uri = child_image_uris[0]
-                        post_to_webhook(
-                            "Child image URI generated: %s" % child_image_uri
-                        )
-                        logging.info(
-                            "Posted child image to webhook: %s", child_image_uri
-                        )
-
-                        # Assuming the updated_visual_descriptions dict is updated later
-                        updated_visual_descriptions = updated_visual_description
-                        updated_visual_descriptions[2] = {
-                            "child_image_uri": child_image_uri
-                        }
-                        logging.info(
-                            "Updated visual descriptions: %s",
-                            updated_visual_descriptions,
-                        )
-                        post_to_webhook(
-                            "Updated visual descriptions: %s"
-                            % updated_visual_descriptions
+    async def pending_prompts():
+        # Only render the pages that have not been checkpointed by an earlier attempt
+        async for prompt in prompt_feed:
+            label = f"page_{len(page_prompts):02d}"
+            page_prompts[label] = prompt
+            if not rendered(label):
+                pending_labels.append(label)
+                yield prompt
+
+    async def save_page(position, image_uri):
+        if image_uri:
+            label = pending_labels[position]
+            # The prompt is saved last, so an interrupted save leaves the page to be
+            # rendered again
+            await checkpoints.save(label, image_uri)
+            await checkpoints.save(f"{label}_prompt", page_prompts[label])
+            await asyncio.to_thread(
+                story_store.save_page, tripetto_id, label, image_uri
+            )
+            if page_delivery.incremental:
+                # Posted in the background so the next finished page is not held up. The
+                # page count is not known yet while prompts are still being written.
+                page_count = len(prompt_feed.items) if prompt_feed.closed else None
+                deliveries.append(
+                    asyncio.create_task(
+                        page_delivery.deliver_page(
+                            tripetto_id, label, image_uri, page_count
                         )
-
-                        generated_response = generate_image_prompts(
-                            story, updated_visual_descriptions
-                        )
-
-                        # logging.info("Image prompts RAW: %s", image_prompts)
-                        post_to_webhook("Image prompts RAW: %s" % generated_response)
-
-                        image_prompts = list(
-                            generated_response["image_prompts"].values()
-                        )
-
-                        logging.info("Image prompts list: %s", image_prompts)
-                        post_to_webhook("Image prompts list: %s" % image_prompts)
-                        image_uris = await generator.generate_images(image_prompts)
-                        page_labels_with_uris = {
-                            f"page_{idx:02d}": image_uri
-                            for idx, image_uri in enumerate(image_uris)
-                            if image_uri
-                        }
-
-                        logging.info("Image generation complete")
-                        post_to_webhook(
-                            "Image URIs generated: %s" % page_labels_with_uris
-                        )
-                        post_payload = {
-                            "image_urls": page_labels_with_uris,
-                            "tripettoId": tripetto_id,
-                        }
-                        headers = {
-                            "Content-Type": "application/json",
-                            "User-Agent": "Mozilla/5.0",
-                        }
-                        url = "https://littlestorywriter.com/img-upload"
-                        response = requests.post(
-                            url, json=post_payload, headers=headers
-                        )
-                        if response.status_code == 200:
-                            logging.info("Image posting complete")
-                            post_to_webhook("Image posting complete")
-                        else:
-                            logging.error(
-                                "Failed to post image URIs. Status: %d, Response: %s",
-                                response.status_code,
-                                response.content,
-                            )
-
-                    else:
-                        logging.warning("No valid child image URI generated.")
-                        post_to_webhook("No valid child image URI generated.")
-
-                except Exception as e:
-                    logging.error(
-                        "An error occurred during image generation and posting: %s", e
                     )
-                    post_to_webhook("An error occurred: %s" % e)
-
-            asyncio.run(generate_and_post_child_image())
-
-        else:
-            logging.warning("No valid child image prompt found.")
-            post_to_webhook("No valid child image prompt found.")
-    except Exception as e:
-        logging.error("An error occurred during image generation and posting: %s", e)
-        logging.error("Traceback: %s", traceback.format_exc())
-        post_to_webhook(
-            "An error occurred: %s\nTraceback: %s" % (e, traceback.format_exc())
+                )
+
+    # Pages are rendered as their prompts arrive from the image prompts stage
+    await generator.generate_image_stream(pending_prompts(), on_result=save_page)
+    telemetry.current_span().set(count=len(pending_labels))
+    await asyncio.gather(*deliveries)
+    missing_pages = [label for label in page_prompts if not rendered(label)]
+    if missing_pages:
+        # Hold the upload back until every page exists; the job retries only these pages
+        raise RuntimeError("Missing page images: %s" % ", ".join(missing_pages))
+    return {label: checkpoints.get(label) for label in page_prompts}
+
+
+async def upload_pages_stage(tripetto_id, pages):
+    logging.info("Image generation complete")
+    post_to_webhook("Image URIs generated: %s" % pages)
+    telemetry.current_span().set(pages=len(pages))
+    status_code, response_text = await page_delivery.deliver_manifest(
+        tripetto_id, pages
+    )
+    if status_code != 200:
+        logging.error(
+            "Failed to post image URIs. Status: %d, Response: %s",
+            status_code,
+            response_text,
         )
+        raise RuntimeError(f"Failed to post image URIs. Status: {status_code}")
+    logging.info("Image posting complete")
+    post_to_webhook("Image posting complete")
+    await asyncio.to_thread(story_store.update, tripetto_id, status="completed")
+
+
+# Stages of an order's job. The child image branch (visual description, child prompt and
+# reference render) does not depend on the story, so it runs while the story is written.
+image_pipeline = StageGraph(
+    [
+        Stage(
+            "story",
+            generate_and_post_story,
+            ("tripetto_id", "order", "story_configuration", "visual_configuration"),
+            checkpoint="story",
+        ),
+        Stage(
+            "visual_description",
+            generate_visual_stage,
+            ("visual_configuration",),
+            checkpoint="visual_description",
+        ),
+        Stage(
+            "child_image",
+            generate_child_image_stage,
+            ("visual_configuration", "visual_description", "checkpoints"),
+            checkpoint="child_image_uri",
+        ),
+        Stage(
+            "image_prompts",
+            generate_image_prompts_stage,
+            ("story", "visual_description", "child_image", "prompt_feed"),
+            checkpoint="image_prompts",
+        ),
+        Stage(
+            "pages",
+            generate_pages_stage,
+            ("tripetto_id", "prompt_feed", "checkpoints"),
+            overlaps=("image_prompts",),
+        ),
+        Stage("upload", upload_pages_stage, ("tripetto_id", "pages")),
+    ]
+)
+
+# Stages of a synchronous /process-story. The request waits only for the story; the
+# child image branch keeps running and is taken over by the order's job.
+story_pipeline = StageGraph(
+    [
+        Stage("story", generate_story, ("story_configuration",)),
+        image_pipeline.stages["visual_description"],
+        image_pipeline.stages["child_image"],
+    ]
+)
+
+# Runs started by synchronous requests, by tripettoId, until their job picks them up
+MAX_PREFETCHED_RUNS = 256
+prefetched_runs = OrderedDict()
+
+
+async def prefetch_story(tripetto_id, story_configuration, visual_configuration):
+    """
+    Generates the story of a synchronous order and starts its child image branch, which
+    the order's job takes over.
+
+    :return: The generated story.
+    """
+    run = story_pipeline.start(
+        {
+            "story_configuration": story_configuration,
+            "visual_configuration": visual_configuration,
+            "checkpoints": Checkpoints(),
+        },
+        Checkpoints(),
+    )
+    try:
+        book_data = await run.result("story")
+    except BaseException:
+        run.cancel()
+        raise
+    prefetched_runs[tripetto_id] = run
+    while len(prefetched_runs) > MAX_PREFETCHED_RUNS:
+        _, dropped = prefetched_runs.popitem(last=False)
+        dropped.cancel()
+    return book_data
+
+
+def format_critical_path(critical_path):
+    return " -> ".join(
+        f"{name} {seconds:.2f}s" + ("" if source == "run" else f" ({source})")
+        for name, seconds, source in critical_path
+    )
+
+
+async def run_image_job(tripetto_id, payload, checkpoints):
+    inputs = {
+        "tripetto_id": tripetto_id,
+        "checkpoints": checkpoints,
+        "order": payload.get("order"),
+        "story_configuration": payload.get("story_configuration"),
+        "visual_configuration": payload["visual_configuration"],
+        # Image prompts of an earlier attempt are passed to the pages stage as they are
+        "prompt_feed": Feed(checkpoints.get("image_prompts")),
+    }
+    # Accepted orders generate their story as a stage of the job
+    if payload["story"] is not None:
+        inputs["story"] = payload["story"]
+
+    with span("pipeline") as pipeline_span:
+        run = image_pipeline.start(
+            inputs, checkpoints, previous=prefetched_runs.pop(tripetto_id, None)
+        )
+        try:
+            await run.wait()
+        except Exception as e:
+            logging.error(
+                "An error occurred during image generation and posting: %s", e
+            )
+            logging.error("Traceback: %s", traceback.format_exc())
+            post_to_webhook(
+                "An error occurred: %s\nTraceback: %s" % (e, traceback.format_exc())
+            )
+            raise
+        finally:
+            critical_path = run.critical_path()
+            pipeline_span.set(critical_path=format_critical_path(critical_path))
+            logging.info(
+                "Critical path of %s: %s",
+                tripetto_id,
+                format_critical_path(critical_path),
+            )
+
+
+async def notify_job_finished(tripetto_id, payload, status, error):
+    if status == "failed":
+        await asyncio.to_thread(story_store.update, tripetto_id, status="failed")
+    callback_url = payload.get("callback_url")
+    if not callback_url:
+        return
+    status_code, _ = await post_json(
+        callback_url, {"tripettoId": tripetto_id, "status": status, "error": error}
+    )
+    logging.info("Completion callback for %s returned %d", tripetto_id, status_code)
+
+
+job_queue = JobQueue(app, run_image_job, on_finished=notify_job_finished)
+
+# Counters of the pipeline's components, exposed next to the stage histograms on
+# /metrics
+telemetry.register_collector(
+    "assistant_runs", run_metrics.snapshot, label="assistant_id"
+)
+telemetry.register_collector(
+    "assistant_cache", assistant_cache.stats, label="namespace"
+)
+telemetry.register_collector("assistant_output", output_stats.snapshot, label="stage")
+telemetry.register_collector("assistant_sessions", sessions.stats)
+telemetry.register_collector("http_pool", http_pool.stats)
+telemetry.register_collector("image_status", lambda: status_tracker.stats)
+telemetry.register_collector("page_delivery", lambda: page_delivery.stats)
+telemetry.register_collector("rate_limiter", rate_limiter.stats, label="bucket")
+telemetry.register_collector("reference_images", lambda: reference_images.stats)
+telemetry.register_collector("response_cache", response_cache.stats)
+telemetry.register_collector("single_flight", single_flight.stats, label="namespace")
+telemetry.register_collector("traffic", traffic.stats)
+
+
+_migrate_lock = threading.Lock()
+_migrated = False
+
+
+def migrate_database():
+    """
+    Creates and migrates the database tables once per process.
+    """
+    global _migrated
+    if _migrated:
+        return
+    with _migrate_lock:
+        if not _migrated:
+            with app.app_context():
+                migrate()
+            _migrated = True
+
+
+# Migrate the database and start the background image job workers with the first
+# request, so servers such as gunicorn or flask run need no separate setup step
+@app.before_request
+def start_job_queue():
+    migrate_database()
+    job_queue.start()
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Create missing tables, columns and indexes."""
+    migrate_database()
 
 
 # Global exception handler for the Flask app
@@ -179,89 +502,433 @@ def handle_exception(e):
 @app.route("/process-story", methods=["POST"])
 def process_story():
     try:
-        post_to_webhook("===========================================================")
-        post_to_webhook(
-            f"Logs for the new entry with id: {request.json.get('tripettoId')}"
-        )
-        post_to_webhook("===========================================================")
-        data = request.json
-        tripetto_id = data.get("tripettoId")
-        if not tripetto_id:
-            return jsonify({"error": "tripettoId is required"}), 400
-
-        if StoryData.query.filter_by(tripettoId=tripetto_id).first():
-            return jsonify({"error": "tripettoId already exists"}), 400
-
-        order, story_configuration, visual_configuration = (
-            convert_tripetto_json_to_lists(data)
-        )
-        book_data = generate_story(story_configuration)
-        logging.info("==============================================")
-        logging.info(f"Book data generated: {book_data}")
-        post_to_webhook(f"Book data generated: {book_data}")
-        logging.info("==============================================")
-
-        new_story_data = StoryData(
-            tripettoId=tripetto_id,
-            order=json.dumps(order),
-            story_configuration=json.dumps(story_configuration),
-            visual_configuration=json.dumps(visual_configuration),
-            story=json.dumps(book_data),
-            image_urls=json.dumps([]),
-        )
-        db.session.add(new_story_data)
-        db.session.commit()
+        with span("process_story", tripettoId=request.json.get("tripettoId")):
+            post_to_webhook(
+                "==========================================================="
+            )
+            post_to_webhook(
+                f"Logs for the new entry with id: {request.json.get('tripettoId')}"
+            )
+            post_to_webhook(
+                "==========================================================="
+            )
+            data = request.json
+            tripetto_id = data.get("tripettoId")
+            if not tripetto_id:
+                return jsonify({"error": "tripettoId is required"}), 400
+
+            if story_store.exists(tripetto_id):
+                return jsonify({"error": "tripettoId already exists"}), 400
+
+            order, story_configuration, visual_configuration = (
+                convert_tripetto_json_to_lists(data)
+            )
+            if wants_async_response():
+                return accept_story(
+                    tripetto_id, data, order, story_configuration, visual_configuration
+                )
+
+            book_data = async_runtime.run(
+                prefetch_story(tripetto_id, story_configuration, visual_configuration)
+            )
+            logging.info("==============================================")
+            logging.info(f"Book data generated: {book_data}")
+            post_to_webhook(f"Book data generated: {book_data}")
+            logging.info("==============================================")
+
+            story_store.create(
+                tripetto_id,
+                order,
+                story_configuration,
+                visual_configuration,
+                book_data,
+                status="story_ready",
+            )
+
+            job_queue.enqueue(
+                tripetto_id,
+                {
+                    "story": book_data,
+                    "visual_configuration": visual_configuration,
+                    "callback_url": data.get("callbackUrl"),
+                },
+            )
+
+            response_data = build_story_response(
+                tripetto_id, order, story_configuration, visual_configuration, book_data
+            )
+
+            # logging.info(jsonify(response_data))
+
+            # Post the story to the webhook endpoint before returning
+            endpoint_url = f"{SITE_URL}/process-story"
+            status_code, response_text = async_runtime.run(
+                post_json(endpoint_url, response_data)
+            )
+            logging.info(f"Response from webhook: {response_text}")
+            if status_code != 200:
+                return jsonify({"error": "Failed to post to webhook"}), 500
+
+            return jsonify(
+                {
+                    "tripettoId": tripetto_id,
+                    "story": book_data,
+                }
+            )
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        post_to_webhook(f"An error occurred: {e}")
+        return jsonify({"error": "An internal error occurred"}), 500
 
-        thread = Thread(
-            target=generate_and_post_images,
-            args=(tripetto_id, book_data, visual_configuration),
-        )
-        thread.start()
 
-        response_data = {
-            "tripettoId": tripetto_id,
+def wants_async_response():
+    return request.args.get("async") in ("1", "true") or "respond-async" in (
+        request.headers.get("Prefer", "")
+    )
+
+
+def queue_order(
+    tripetto_id, data, order, story_configuration, visual_configuration, **job
+):
+    """
+    Stores an order and queues a job generating its story and images. Must be called
+    within an app context.
+
+    :param job: Extra job payload fields, e.g. ``background=True`` for bulk orders.
+    :return: The id of the job.
+    """
+    story_store.create(
+        tripetto_id,
+        order,
+        story_configuration,
+        visual_configuration,
+        None,
+        status="queued",
+    )
+    return job_queue.enqueue(
+        tripetto_id,
+        {
+            "story": None,
             "order": order,
             "story_configuration": story_configuration,
             "visual_configuration": visual_configuration,
-            "story": book_data,
+            "callback_url": data.get("callbackUrl"),
+            **job,
+        },
+    )
+
+
+def accept_story(tripetto_id, data, order, story_configuration, visual_configuration):
+    """
+    Stores an order and queues its story and image generation, responding right away.
+    """
+    job_id = queue_order(
+        tripetto_id, data, order, story_configuration, visual_configuration
+    )
+    return (
+        jsonify(
+            {
+                "tripettoId": tripetto_id,
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": url_for("get_job_status", tripetto_id=tripetto_id),
+                "events_url": url_for("stream_job_events", tripetto_id=tripetto_id),
+            }
+        ),
+        202,
+    )
+
+
+# Endpoint to retrieve the status of an order's background job
+@app.route("/jobs/<tripetto_id>", methods=["GET"])
+def get_job_status(tripetto_id):
+    status = job_queue.status(tripetto_id)
+    if status is None:
+        return jsonify({"error": "No job found for tripettoId"}), 404
+    return jsonify(status)
+
+
+# Endpoint re-rendering the missing pages of an order and uploading the merged book
+@app.route("/jobs/<tripetto_id>/repair", methods=["POST"])
+def repair_job(tripetto_id):
+    pages = (request.get_json(silent=True) or {}).get("pages")
+    status = job_queue.status(tripetto_id)
+    if status is None:
+        return jsonify({"error": "No job found for tripettoId"}), 404
+    if status["status"] not in ("completed", "failed"):
+        return jsonify({"error": "Job is still %s" % status["status"]}), 409
+
+    job_id = job_queue.repair(tripetto_id, pages)
+    return (
+        jsonify(
+            {
+                "tripettoId": tripetto_id,
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": url_for("get_job_status", tripetto_id=tripetto_id),
+            }
+        ),
+        202,
+    )
+
+
+# Endpoint posting the pages and manifest of an order to littlestorywriter.com again
+@app.route("/jobs/<tripetto_id>/redeliver", methods=["POST"])
+def redeliver_pages(tripetto_id):
+    image_urls = story_store.pages(tripetto_id)
+    if not image_urls:
+        return jsonify({"error": "No pages found for tripettoId"}), 404
+    status_code, _ = async_runtime.run(page_delivery.replay(tripetto_id, image_urls))
+    if status_code != 200:
+        return (
+            jsonify({"error": f"Failed to post image URIs. Status: {status_code}"}),
+            502,
+        )
+    return jsonify(
+        {
+            "tripettoId": tripetto_id,
+            "pages": len(image_urls),
+            "mode": page_delivery.mode,
         }
+    )
+
+
+# Directory holding the input and results files of batches started over the API
+BATCH_DIR = config.get("BATCH_DIR", "batches")
+
+# Batches started by this process, by batch id
+batch_runs = {}
+
 
-        # logging.info(jsonify(response_data))
+def submit_batch_order(data, batch_id, retry=False):
+    """
+    Queues one order of a batch. An order that already exists is not queued again: its
+    job is waited on if it is still queued or running, and requeued if it failed and
+    ``retry`` is set.
+
+    :return: Tuple of the tripettoId, job id and status, as expected by batch.BatchRun.
+    """
+    tripetto_id = data.get("tripettoId")
+    if not tripetto_id:
+        raise ValueError("tripettoId is required")
+    with app.app_context():
+        if story_store.exists(tripetto_id):
+            status = job_queue.status(tripetto_id)
+            if status is None:
+                return tripetto_id, None, "exists"
+            if status["status"] == "failed":
+                if retry:
+                    return tripetto_id, job_queue.repair(tripetto_id), "queued"
+                return tripetto_id, status["job_id"], "failed"
+            if status["status"] == "completed":
+                return tripetto_id, status["job_id"], "exists"
+            return tripetto_id, status["job_id"], "queued"
+
+        order, story_configuration, visual_configuration = (
+            convert_tripetto_json_to_lists(data)
+        )
+        if not order:
+            raise ValueError("Invalid Tripetto payload")
+        job_id = queue_order(
+            tripetto_id,
+            data,
+            order,
+            story_configuration,
+            visual_configuration,
+            background=True,
+            batch_id=batch_id,
+        )
+        return tripetto_id, job_id, "queued"
 
-        # Post the story to the webhook endpoint before returning
-        endpoint_url = "https://littlestorywriter.com/process-story"
-        response = requests.post(endpoint_url, json=response_data)
-        logging.info(f"Response from webhook: {response.text}")
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to post to webhook"}), 500
 
-        return jsonify(
+def poll_batch_jobs(job_ids):
+    with app.app_context():
+        return job_queue.states(job_ids)
+
+
+def create_batch_run(batch_id, input_path, output_path, **options):
+    """
+    Returns a batch.BatchRun queueing its orders through this app's job queue.
+    """
+    return batch.BatchRun(
+        batch_id,
+        input_path,
+        output_path,
+        submit_batch_order,
+        poll_batch_jobs,
+        **options,
+    )
+
+
+def batch_paths(batch_id):
+    return (
+        os.path.join(BATCH_DIR, f"{batch_id}.jsonl"),
+        os.path.join(BATCH_DIR, f"{batch_id}.results.jsonl"),
+    )
+
+
+def start_batch(batch_id, retry_failed=False):
+    input_path, output_path = batch_paths(batch_id)
+    run = create_batch_run(
+        batch_id,
+        input_path,
+        output_path,
+        concurrency=request.args.get("concurrency", type=int),
+        retry_failed=retry_failed,
+    )
+    batch_runs[batch_id] = run
+    job_queue.start()
+    async_runtime.submit(run.run())
+    return (
+        jsonify(
             {
-                "tripettoId": tripetto_id,
-                "story": book_data,
+                "batch_id": batch_id,
+                "status": "running",
+                "status_url": url_for("get_batch_status", batch_id=batch_id),
+                "results_url": url_for("get_batch_results", batch_id=batch_id),
             }
-        )
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        post_to_webhook(f"An error occurred: {e}")
-        return jsonify({"error": "An internal error occurred"}), 500
+        ),
+        202,
+    )
+
+
+# Endpoint starting a batch from a JSON-lines body or file upload of Tripetto payloads
+@app.route("/batches", methods=["POST"])
+def create_batch():
+    batch_id = (
+        secure_filename(request.args.get("batch_id", "")) or uuid.uuid4().hex[:12]
+    )
+    run = batch_runs.get(batch_id)
+    if run is not None and run.active:
+        return jsonify({"error": "Batch is still running"}), 409
+
+    input_path, _ = batch_paths(batch_id)
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    # Copied in chunks, so large campaigns are never held in memory
+    source = request.files["file"].stream if "file" in request.files else request.stream
+    with open(input_path, "wb") as input_file:
+        shutil.copyfileobj(source, input_file)
+    return start_batch(batch_id)
+
+
+# Endpoint resuming a batch, skipping the orders that already have a result
+@app.route("/batches/<batch_id>/resume", methods=["POST"])
+def resume_batch(batch_id):
+    batch_id = secure_filename(batch_id)
+    run = batch_runs.get(batch_id)
+    if run is not None and run.active:
+        return jsonify({"error": "Batch is still running"}), 409
+    if not os.path.exists(batch_paths(batch_id)[0]):
+        return jsonify({"error": "No batch found"}), 404
+    retry_failed = bool((request.get_json(silent=True) or {}).get("retry_failed"))
+    return start_batch(batch_id, retry_failed)
+
+
+# Endpoint returning the progress of a batch
+@app.route("/batches/<batch_id>", methods=["GET"])
+def get_batch_status(batch_id):
+    batch_id = secure_filename(batch_id)
+    run = batch_runs.get(batch_id)
+    if run is not None:
+        return jsonify(run.progress())
+
+    # Batches run by the CLI or an earlier process only have their results file
+    _, output_path = batch_paths(batch_id)
+    if not os.path.exists(output_path):
+        return jsonify({"error": "No batch found"}), 404
+    counts = {status: 0 for status in batch.FINAL_STATUSES}
+    for result in batch.read_results(output_path).values():
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return jsonify({"batch_id": batch_id, "status": "stopped", **counts})
+
+
+# Endpoint downloading the results of a batch recorded so far
+@app.route("/batches/<batch_id>/results", methods=["GET"])
+def get_batch_results(batch_id):
+    _, output_path = batch_paths(secure_filename(batch_id))
+    if not os.path.exists(output_path):
+        return jsonify({"error": "No results found"}), 404
+    return send_file(os.path.abspath(output_path), mimetype="application/x-ndjson")
+
+
+# Endpoint streaming job status changes as server-sent events
+@app.route("/jobs/<tripetto_id>/events", methods=["GET"])
+def stream_job_events(tripetto_id):
+    if job_queue.status(tripetto_id) is None:
+        return jsonify({"error": "No job found for tripettoId"}), 404
+
+    def events():
+        last_status = None
+        while True:
+            with app.app_context():
+                status = job_queue.status(tripetto_id)
+            if status is None:
+                # The job was removed while the stream was open
+                removed = {"tripettoId": tripetto_id, "status": "removed"}
+                yield f"data: {json.dumps(removed)}\n\n"
+                return
+            if status != last_status:
+                yield f"data: {json.dumps(status)}\n\n"
+                last_status = status
+            if status["status"] in ("completed", "failed"):
+                return
+            time.sleep(1)
+
+    return Response(
+        events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+# Endpoint exposing stage latency histograms and component counters to Prometheus
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(
+        telemetry.render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# Endpoint returning the recent spans of an order with p50/p95 per stage
+@app.route("/traces/<tripetto_id>", methods=["GET"])
+def get_traces(tripetto_id):
+    spans = telemetry.exporter.spans(tripetto_id=tripetto_id)
+    if not spans:
+        return jsonify({"error": "No spans found for tripettoId"}), 404
+    return jsonify(
+        {"tripettoId": tripetto_id, "spans": spans, "stages": telemetry.stage_summary()}
+    )
+
+
+# Endpoint receiving image status updates pushed by ImaginePro
+@app.route("/imaginepro/callback", methods=["POST"])
+def imaginepro_callback():
+    secret = config.get("MID_WEBHOOK_SECRET")
+    if secret and request.args.get("token") != secret:
+        return jsonify({"error": "Invalid token"}), 403
+    status_result = request.get_json(silent=True) or {}
+    if not status_result.get("messageId"):
+        return jsonify({"error": "messageId is required"}), 400
+    status_tracker.push(status_result)
+    return jsonify({"received": True})
 
 
 # Endpoint to retrieve story data
 @app.route("/get-story-data/<tripetto_id>", methods=["GET"])
 def get_story_data(tripetto_id):
     try:
-        story_data = StoryData.query.filter_by(tripettoId=tripetto_id).first_or_404()
-        return jsonify(
-            {
-                "tripettoId": tripetto_id,
-                "order": json.loads(story_data.order),
-                "story_configuration": json.loads(story_data.story_configuration),
-                "visual_configuration": json.loads(story_data.visual_configuration),
-                "story": json.loads(story_data.story),
-                "image_urls": json.loads(story_data.image_urls),
-            }
+        cached = response_cache.get(
+            tripetto_id, lambda: story_store.response(tripetto_id)
         )
+        if cached is None:
+            return jsonify({"error": "Story not found"}), 404
+        etag, body = cached
+        # Pollers revalidate on every request and get a 304 until the order changes
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
@@ -270,6 +937,6 @@ def get_story_data(tripetto_id):
 
 
 if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
+    migrate_database()
+    job_queue.start()
     app.run(debug=False)
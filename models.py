@@ -0,0 +1,78 @@
+"""
+This module contains the database models shared by the Flask app and the background job
+queue.
+"""
+
+from datetime import datetime
+
+from flask_sqlalchemy import SQLAlchemy
+
+db = SQLAlchemy()
+
+
+# Database model for story data
+class StoryData(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    tripettoId = db.Column(db.String(100), unique=True, nullable=False)
+    order = db.Column(db.JSON)
+    story_configuration = db.Column(db.JSON)
+    visual_configuration = db.Column(db.JSON)
+    story = db.Column(db.JSON)
+    # Page URIs of books from before pages were stored in StoryPage
+    image_urls = db.Column(db.JSON)
+    status = db.Column(db.String(20), index=True)
+    # Serialized /get-story-data response, cleared whenever the story or its pages
+    # change
+    response_json = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True
+    )
+
+
+# Database model for the image URI of one page of a story
+class StoryPage(db.Model):
+    __table_args__ = (db.UniqueConstraint("tripettoId", "label"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    tripettoId = db.Column(db.String(100), nullable=False)
+    label = db.Column(db.String(20), nullable=False)
+    uri = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
+# Database model for a queued background image generation job
+class ImageJob(db.Model):
+    # Workers claim jobs by status and availability
+    __table_args__ = (
+        db.Index("ix_image_job_status_available_at", "status", "available_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tripettoId = db.Column(db.String(100), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default="queued", index=True)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(100))
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
+# Database model for the output of one completed stage of an image job
+class JobCheckpoint(db.Model):
+    __table_args__ = (db.UniqueConstraint("job_id", "name"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey("image_job.id"), nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    value = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
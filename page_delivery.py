@@ -0,0 +1,147 @@
+"""
+This module delivers page images to littlestorywriter.com.
+
+In "book" mode, all page URIs are posted to /img-upload in one request once every page
+exists. In "incremental" mode, each page is posted as soon as it is upscaled, and the
+book ends with a manifest holding every page and ``"complete": true``. The customer sees
+the first page after one page cycle instead of after the slowest page.
+
+Every message carries a ``delivery_id`` derived from its content, which is also sent as
+the Idempotency-Key header. Posting the same page or manifest twice, e.g. when a job is
+retried or its deliveries are replayed, sends the same key, so the receiver can drop the
+duplicate. Page messages use the same ``image_urls`` shape as the manifest, so a
+receiver that only merges what it gets ends up with the whole book either way.
+"""
+
+import asyncio
+import hashlib
+import logging
+
+import config
+from telemetry import span
+
+DELIVERY_MODES = ("book", "incremental")
+
+HEADERS = {
+    "Content-Type": "application/json",
+    "User-Agent": "Mozilla/5.0",
+}
+
+
+def delivery_id(tripetto_id, image_urls, complete):
+    """
+    Returns the idempotency key of a message, the same for every post of the same
+    content.
+    """
+    digest = hashlib.sha256()
+    for label, uri in sorted(image_urls.items()):
+        digest.update(f"{label}={uri}\n".encode())
+    kind = "manifest" if complete else "page"
+    return f"{tripetto_id}:{kind}:{digest.hexdigest()[:16]}"
+
+
+class PageDelivery:
+    def __init__(self, post, url, mode=None):
+        """
+        :param post: Coroutine function called as ``post(url, payload, headers)`` that
+            returns the response status code and text.
+        :param url: Upload endpoint, e.g. https://littlestorywriter.com/img-upload.
+        :param mode: "book" or "incremental"; defaults to PAGE_DELIVERY.
+        """
+        self.post = post
+        self.url = url
+        self.mode = mode or config.get("PAGE_DELIVERY", "book")
+        if self.mode not in DELIVERY_MODES:
+            raise ValueError(f"Unknown page delivery mode: {self.mode}")
+        self.stats = {"pages_posted": 0, "page_failures": 0, "manifests_posted": 0}
+
+    @property
+    def incremental(self):
+        return self.mode == "incremental"
+
+    def page_message(self, tripetto_id, label, uri, page_count):
+        image_urls = {label: uri}
+        return {
+            "tripettoId": tripetto_id,
+            "image_urls": image_urls,
+            "page": label,
+            "pages": page_count,
+            "complete": False,
+            "delivery_id": delivery_id(tripetto_id, image_urls, False),
+        }
+
+    def manifest_message(self, tripetto_id, image_urls):
+        if not self.incremental:
+            # The book upload the site has always received
+            return {"image_urls": image_urls, "tripettoId": tripetto_id}
+        return {
+            "tripettoId": tripetto_id,
+            "image_urls": image_urls,
+            "pages": len(image_urls),
+            "complete": True,
+            "delivery_id": delivery_id(tripetto_id, image_urls, True),
+        }
+
+    def _headers(self, message):
+        if "delivery_id" not in message:
+            return HEADERS
+        return {**HEADERS, "Idempotency-Key": message["delivery_id"]}
+
+    async def deliver_page(self, tripetto_id, label, uri, page_count):
+        """
+        Posts one page in incremental mode. Failures are logged and not raised, since
+        the manifest carries the page again.
+
+        :return: True if the page was accepted.
+        """
+        if not self.incremental:
+            return False
+        message = self.page_message(tripetto_id, label, uri, page_count)
+        with span("page_delivery", page=label):
+            try:
+                status_code, response_text = await self.post(
+                    self.url, message, self._headers(message)
+                )
+            except Exception as e:
+                status_code, response_text = None, str(e)
+        if status_code == 200:
+            self.stats["pages_posted"] += 1
+            return True
+        self.stats["page_failures"] += 1
+        logging.warning(
+            "Failed to post %s of %s. Status: %s, Response: %s",
+            label,
+            tripetto_id,
+            status_code,
+            response_text,
+        )
+        return False
+
+    async def deliver_manifest(self, tripetto_id, image_urls):
+        """
+        Posts every page of a finished book.
+
+        :return: Tuple of the response status code and text.
+        """
+        message = self.manifest_message(tripetto_id, image_urls)
+        status_code, response_text = await self.post(
+            self.url, message, self._headers(message)
+        )
+        if status_code == 200:
+            self.stats["manifests_posted"] += 1
+        return status_code, response_text
+
+    async def replay(self, tripetto_id, image_urls):
+        """
+        Posts the pages and manifest of a book again with their original delivery ids.
+
+        :return: Tuple of the manifest's response status code and text.
+        """
+        page_count = len(image_urls)
+        await asyncio.gather(
+            *(
+                self.deliver_page(tripetto_id, label, uri, page_count)
+                for label, uri in sorted(image_urls.items())
+            )
+        )
+        return await self.deliver_manifest(tripetto_id, image_urls)
@@ -1,5 +1,172 @@
+"""
+This module ships log messages to the logging webhook without blocking the caller.
+
+Messages are put on a bounded in-memory queue and posted in batches by a background
+thread over the pooled requests session. When the queue is full the drop policy decides
+which message is lost, and anything still queued is flushed when the process exits.
+"""
+
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
 import requests
 
+import config
+import http_pool
+
+WEBHOOK_URL = config.get("WEBHOOK_URL", "https://webhook.site/LSW-process-logging")
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class WebhookLogShipper:
+    def __init__(
+        self,
+        url,
+        max_queue_size=None,
+        batch_size=None,
+        flush_interval=None,
+        drop_policy=None,
+    ):
+        """
+        :param url: Webhook URL; when empty, messages are discarded.
+        :param max_queue_size: Maximum number of messages waiting to be sent.
+        :param batch_size: Maximum number of messages sent in one request.
+        :param flush_interval: Seconds to wait for more messages before sending a
+            partial batch.
+        :param drop_policy: "drop_oldest", "drop_newest" or "block" (wait up to one
+            second). Callers on an event loop never block; "drop_oldest" applies to them
+            instead.
+        """
+        self.url = url
+        self.max_queue_size = max_queue_size or int(
+            config.get("WEBHOOK_QUEUE_SIZE", "1000")
+        )
+        self.batch_size = batch_size or int(config.get("WEBHOOK_BATCH_SIZE", "50"))
+        self.flush_interval = flush_interval or float(
+            config.get("WEBHOOK_FLUSH_INTERVAL", "1")
+        )
+        self.drop_policy = drop_policy or config.get(
+            "WEBHOOK_DROP_POLICY", "drop_oldest"
+        )
+        self.stats = {"queued": 0, "sent": 0, "dropped": 0, "failed": 0, "batches": 0}
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._closed = False
+
+    def _ensure_started(self):
+        # A forked worker inherits the queue but not the thread, so start over per
+        # process.
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.max_queue_size)
+            self._thread = threading.Thread(
+                target=self._run, name="webhook-log-shipper", daemon=True
+            )
+            self._thread.start()
+
+    def _count(self, name, amount=1):
+        # Counted from the submitting threads and the shipping thread
+        with self._lock:
+            self.stats[name] += amount
+
+    def submit(self, text):
+        """
+        Queues a message for delivery and returns immediately.
+        """
+        if not self.url or self._closed:
+            return
+        self._ensure_started()
+        drop_policy = self.drop_policy
+        if drop_policy == "block" and _on_event_loop():
+            # Waiting would stall every coroutine on the loop, i.e. every order in
+            # flight
+            drop_policy = "drop_oldest"
+        try:
+            if drop_policy == "block":
+                self._queue.put(text, timeout=1)
+            else:
+                self._queue.put_nowait(text)
+        except queue.Full:
+            if drop_policy == "drop_oldest":
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self._queue.put_nowait(text)
+                except (queue.Empty, queue.Full):
+                    pass
+            self._count("dropped")
+            return
+        self._count("queued")
+
+    def flush(self, timeout=5):
+        """
+        Waits until every queued message has been handled or ``timeout`` seconds have
+        passed.
+        """
+        if self._queue is None or self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def close(self, timeout=5):
+        self.flush(timeout)
+        self._closed = True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._send(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send(self, batch):
+        payload = {"response": "\n".join(batch), "records": batch}
+        try:
+            response = http_pool.get_requests_session().post(
+                self.url, json=payload, timeout=http_pool.SYNC_TIMEOUT
+            )
+            response.raise_for_status()
+            self._count("sent", len(batch))
+            self._count("batches")
+        except Exception as e:
+            self._count("failed", len(batch))
+            logging.warning(f"Failed to post {len(batch)} log messages to webhook: {e}")
+
+
+_shipper = WebhookLogShipper(WEBHOOK_URL)
+atexit.register(_shipper.close)
+
 
 # Function to post to a webhook
 def post_to_webhook(response):
@@ -14,8 +181,5 @@ def post_to_webhook(response):
         # For other types, convert to string
         text_content = str(response)
 
-    # Prepare the payload
-    payload = {"response": text_content}
-
-    # Post the payload to the webhook
-    requests.post("https://webhook.site/LSW-process-logging", json=payload)
+    # Queue the message; it is posted to the webhook in the background
+    _shipper.submit(text_content)
@@ -0,0 +1,250 @@
+"""
+This module schedules outbound API calls against per-provider and per-key rate limits.
+
+Each limit is a token bucket. Callers waiting on a bucket are served in priority order:
+child reference images before pages, and new orders before retries and background work.
+A 429 response pauses the bucket for the Retry-After period before the call is retried.
+
+OpenAI clients use RateLimitedTransport so that every request they make is scheduled.
+Other callers use ``rate_limiter.acquire`` and ``rate_limiter.pause`` directly.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+import config
+import traffic
+
+# Order classes, served in this order
+ORDER_NEW = 0
+ORDER_RETRY = 1
+ORDER_BACKGROUND = 2
+
+# Stage classes within an order class, served in this order
+STAGE_REFERENCE = 0
+STAGE_DEFAULT = 1
+
+MAX_RATE_LIMIT_RETRIES = int(config.get("RATE_LIMIT_MAX_RETRIES", "5"))
+
+DEFAULT_LIMITS = {
+    # provider: (requests per second, burst, per-key requests per second, per-key burst)
+    "openai": (8.0, 16, 8.0, 16),
+    "imaginepro": (20.0, 20, 5.0, 10),
+}
+
+_priority = contextvars.ContextVar(
+    "rate_limit_priority", default=(ORDER_NEW, STAGE_DEFAULT)
+)
+
+
+@contextmanager
+def priority(order=None, stage=None):
+    """
+    Sets the priority of API calls made in this context, including by tasks it starts.
+    """
+    current_order, current_stage = _priority.get()
+    token = _priority.set(
+        (
+            current_order if order is None else order,
+            current_stage if stage is None else stage,
+        )
+    )
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def retry_after_seconds(headers, default=5.0):
+    """
+    Returns the delay requested by a Retry-After header, in seconds.
+    """
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class _TokenBucket:
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.waiters = []
+        self.dispatcher = None
+        self.stats = {"granted": 0, "waited": 0, "wait_seconds": 0.0, "pauses": 0}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, priority_key, sequence):
+        now = time.monotonic()
+        self._refill(now)
+        if not self.waiters and self.tokens >= 1 and now >= self.paused_until:
+            self.tokens -= 1
+            self.stats["granted"] += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority_key, sequence, future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        await future
+        self.stats["granted"] += 1
+        self.stats["waited"] += 1
+        self.stats["wait_seconds"] += time.monotonic() - now
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.stats["pauses"] += 1
+
+    async def _dispatch(self):
+        while self.waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+
+class RateLimitScheduler:
+    def __init__(self, limits=None):
+        """
+        :param limits: Mapping of provider to (rate, burst, per-key rate, per-key
+            burst). Each value can be overridden with RATE_LIMIT_<PROVIDER>_RPS, _BURST,
+            _KEY_RPS and _KEY_BURST.
+        """
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        # Buckets hold futures, so they are kept per event loop
+        self._buckets = weakref.WeakKeyDictionary()
+
+    def _limit(self, provider, name, index):
+        default = self.limits.get(provider, (10.0, 10, 10.0, 10))[index]
+        value = config.get(f"RATE_LIMIT_{provider.upper()}_{name}")
+        return type(default)(value) if value else default
+
+    def _bucket_pair(self, provider, key):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            buckets = self._buckets.setdefault(loop, {})
+            if provider not in buckets:
+                buckets[provider] = _TokenBucket(
+                    provider,
+                    self._limit(provider, "RPS", 0),
+                    self._limit(provider, "BURST", 1),
+                )
+            if key is None:
+                return buckets[provider], None
+            bucket_name = f"{provider}:{key[-6:]}"
+            if (provider, key) not in buckets:
+                buckets[(provider, key)] = _TokenBucket(
+                    bucket_name,
+                    self._limit(provider, "KEY_RPS", 2),
+                    self._limit(provider, "KEY_BURST", 3),
+                )
+            return buckets[provider], buckets[(provider, key)]
+
+    async def acquire(self, provider, key=None):
+        """
+        Waits until a call to a provider (and API key, if given) is allowed by its rate
+        limits.
+        """
+        provider_bucket, key_bucket = self._bucket_pair(provider, key)
+        priority_key = _priority.get()
+        if key_bucket is not None:
+            await key_bucket.acquire(priority_key, next(self._sequence))
+        await provider_bucket.acquire(priority_key, next(self._sequence))
+
+    def pause(self, provider, key=None, seconds=5.0):
+        """
+        Stops granting calls to a provider (or one of its keys) for ``seconds``, e.g.
+        after a 429.
+        """
+        provider_bucket, key_bucket = self._bucket_pair(provider, key)
+        (key_bucket or provider_bucket).pause(seconds)
+        logging.warning("Rate limited by %s, pausing for %.1fs", provider, seconds)
+
+    def stats(self):
+        buckets = {}
+        with self._lock:
+            for loop_buckets in list(self._buckets.values()):
+                for bucket in loop_buckets.values():
+                    buckets[bucket.name] = {
+                        **bucket.stats,
+                        "waiting": len(bucket.waiters),
+                        "tokens": round(bucket.tokens, 2),
+                    }
+        return buckets
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport that schedules every request through the rate limiter and retries
+    429s.
+    """
+
+    def __init__(self, provider, key=None, transport=None):
+        self.provider = provider
+        self.key = key
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            await rate_limiter.acquire(self.provider, self.key)
+            response = await self._transport.handle_async_request(request)
+            if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                return response
+            await response.aclose()
+            rate_limiter.pause(
+                self.provider, self.key, retry_after_seconds(response.headers)
+            )
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def openai_http_client():
+    """
+    Returns an httpx client for AsyncOpenAI whose requests go through the rate limiter.
+    """
+    return httpx.AsyncClient(
+        transport=RateLimitedTransport("openai", transport=traffic.transport()),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+        follow_redirects=True,
+    )
+
+
+# Shared scheduler for all outbound API calls
+rate_limiter = RateLimitScheduler()
@@ -0,0 +1,163 @@
+"""
+This module stores upscaled child reference images so orders with the same child traits
+and illustration style can reuse one instead of rendering a new one.
+
+Images are kept in a local SQLite database in a pool of up to ``pool_size`` images per
+trait combination. Pools and the store as a whole are bounded, with the least recently
+used images evicted first.
+"""
+
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+import config
+
+CHILD_TRAITS = (
+    "child_gender",
+    "child_age",
+    "child_ethnic",
+    "child_skin_tone",
+    "child_hair_color",
+    "child_hair_length",
+)
+
+
+def trait_key(visual_configuration):
+    """
+    Returns the key of the child traits and illustration style in a visual
+    configuration, as produced by convert_tripetto_json_to_lists, or None if the child
+    traits are missing.
+    """
+    sections = {}
+    for section in visual_configuration or []:
+        if isinstance(section, dict):
+            sections.update(section)
+    child = sections.get("child")
+    if not child:
+        return None
+    styles = sections.get("illustration_style") or [{}]
+    values = [child.get(trait, "") for trait in CHILD_TRAITS] + [
+        styles[0].get("style", "")
+    ]
+    return "|".join(" ".join(str(value).split()).casefold() for value in values)
+
+
+class ReferenceImageStore:
+    def __init__(
+        self,
+        path,
+        pool_size=None,
+        min_pool_size=None,
+        max_images=None,
+        ttl=None,
+        enabled=None,
+    ):
+        """
+        :param path: Path of the SQLite database.
+        :param pool_size: Maximum images kept per trait key.
+        :param min_pool_size: Images a key needs before they are reused; until then new
+            images are rendered to grow the pool.
+        :param max_images: Maximum images kept in total.
+        :param ttl: Seconds an image can be reused after it was rendered.
+        :param enabled: Whether images are reused at all.
+        """
+        self.path = path
+        self.pool_size = pool_size or int(config.get("REFERENCE_IMAGE_POOL_SIZE", "3"))
+        self.min_pool_size = min_pool_size or int(
+            config.get("REFERENCE_IMAGE_MIN_POOL_SIZE", "1")
+        )
+        self.max_images = max_images or int(
+            config.get("REFERENCE_IMAGE_MAX_IMAGES", "10000")
+        )
+        self.ttl = ttl or float(config.get("REFERENCE_IMAGE_TTL", str(30 * 24 * 3600)))
+        self.enabled = (
+            config.get("REFERENCE_IMAGE_REUSE", "1") == "1"
+            if enabled is None
+            else enabled
+        )
+        self.stats = {"hits": 0, "misses": 0, "added": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS reference_image ("
+                "id INTEGER PRIMARY KEY, trait_key TEXT NOT NULL, uri TEXT NOT NULL, "
+                "created_at REAL NOT NULL, last_used_at REAL NOT NULL, "
+                "use_count INTEGER NOT NULL DEFAULT 0, UNIQUE (trait_key, uri))"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_reference_image_last_used_at "
+                "ON reference_image (last_used_at)"
+            )
+        return self._connection
+
+    def pick(self, key):
+        """
+        Returns a stored image URI for a trait key, or None if the key's pool is too
+        small.
+        """
+        if not self.enabled or not key:
+            return None
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute(
+                "SELECT id, uri FROM reference_image WHERE trait_key = ? AND created_at > ?",
+                (key, time.time() - self.ttl),
+            ).fetchall()
+            if len(rows) < self.min_pool_size:
+                self.stats["misses"] += 1
+                return None
+            image_id, uri = random.choice(rows)
+            connection.execute(
+                "UPDATE reference_image SET last_used_at = ?, use_count = use_count + 1 "
+                "WHERE id = ?",
+                (time.time(), image_id),
+            )
+            connection.commit()
+            self.stats["hits"] += 1
+        logging.info("Reusing child reference image %s", uri)
+        return uri
+
+    def add(self, key, uri):
+        """
+        Stores a newly rendered image and evicts the least recently used images over
+        capacity.
+        """
+        if not self.enabled or not key or not uri:
+            return
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR IGNORE INTO reference_image "
+                "(trait_key, uri, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (key, uri, now, now),
+            )
+            evicted = connection.execute(
+                "DELETE FROM reference_image WHERE created_at <= ? OR id IN ("
+                "SELECT id FROM reference_image WHERE trait_key = ? "
+                "ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (now - self.ttl, key, self.pool_size),
+            ).rowcount
+            evicted += connection.execute(
+                "DELETE FROM reference_image WHERE id IN ("
+                "SELECT id FROM reference_image ORDER BY last_used_at DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_images,),
+            ).rowcount
+            connection.commit()
+            self.stats["added"] += 1
+            self.stats["evicted"] += max(evicted, 0)
+
+
+# Shared store used by the image pipeline
+reference_images = ReferenceImageStore(
+    config.get("REFERENCE_IMAGE_STORE_PATH", "reference_images.db")
+)
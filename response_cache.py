@@ -0,0 +1,289 @@
+"""
+This module caches serialized /get-story-data responses per order, with an ETag for
+each.
+
+Polls of an order served from the cache do not touch the database, and a poll whose
+If-None-Match still matches is answered with 304. Every write to an order through the
+story store invalidates its entry. Fills are tagged with a generation taken before the
+database read, so a response read before an invalidation is never stored after it.
+
+Entries live in memory by default. An invalidation only reaches the process that made
+the write, so memory entries expire after RESPONSE_CACHE_TTL seconds; another process
+serving the same order shows its changes within that time. When several processes serve
+the app, set RESPONSE_CACHE_PATH to share one SQLite cache file between them instead, so
+an invalidation reaches all of them.
+"""
+
+import hashlib
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+
+def make_etag(body):
+    """
+    Returns the (unquoted) strong ETag of a response body.
+    """
+    return hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+class MemoryResponseBackend:
+    name = "memory"
+
+    def __init__(self, max_entries=2048, max_bytes=64 * 1024 * 1024, ttl=5.0):
+        """
+        :param ttl: Seconds an entry is served for, or 0 to keep it until it is
+            invalidated.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = itertools.count(1)
+        self._current_generation = 0
+        # Generation of the latest invalidation per order, pruned to a bounded size.
+        # Orders pruned from it fall back to the newest pruned generation.
+        self._invalidated = OrderedDict()
+        self._pruned_generation = 0
+
+    def lookup(self, tripetto_id):
+        with self._lock:
+            entry = self._entries.get(tripetto_id)
+            if entry is None:
+                return self._current_generation, None
+            etag, body, stored_at = entry
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._entries[tripetto_id]
+                self._size -= len(body)
+                return self._current_generation, None
+            self._entries.move_to_end(tripetto_id)
+            return self._current_generation, (etag, body)
+
+    def store(self, tripetto_id, generation, etag, body):
+        with self._lock:
+            invalidated = self._invalidated.get(tripetto_id, self._pruned_generation)
+            if invalidated > generation:
+                return False
+            previous = self._entries.pop(tripetto_id, None)
+            if previous is not None:
+                self._size -= len(previous[1])
+            self._entries[tripetto_id] = (etag, body, time.monotonic())
+            self._size += len(body)
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._size > self.max_bytes
+            ):
+                _, (_, evicted_body, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted_body)
+                self.evictions += 1
+            return tripetto_id in self._entries
+
+    def invalidate(self, tripetto_id):
+        with self._lock:
+            self._current_generation = next(self._generation)
+            self._invalidated[tripetto_id] = self._current_generation
+            self._invalidated.move_to_end(tripetto_id)
+            while len(self._invalidated) > 4 * self.max_entries:
+                _, pruned = self._invalidated.popitem(last=False)
+                self._pruned_generation = max(self._pruned_generation, pruned)
+            previous = self._entries.pop(tripetto_id, None)
+            if previous is not None:
+                self._size -= len(previous[1])
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size}
+
+
+class SQLiteResponseBackend:
+    name = "shared"
+
+    def __init__(self, path, max_entries=20000):
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._writes = 0
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            # Invalidated orders keep their row, with a higher generation and no body
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS story_response ("
+                "tripetto_id TEXT PRIMARY KEY, generation INTEGER NOT NULL, "
+                "etag TEXT, body BLOB, stored_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_story_response_stored_at "
+                "ON story_response (stored_at)"
+            )
+        return self._connection
+
+    def lookup(self, tripetto_id):
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT generation, etag, body FROM story_response WHERE tripetto_id = ?",
+                    (tripetto_id,),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return 0, None
+        generation, etag, body = row
+        return generation, (etag, body) if body is not None else None
+
+    def store(self, tripetto_id, generation, etag, body):
+        with self._lock:
+            connection = self._connect()
+            stored = connection.execute(
+                "INSERT INTO story_response VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (tripetto_id) DO UPDATE SET "
+                "etag = excluded.etag, body = excluded.body, stored_at = excluded.stored_at "
+                "WHERE story_response.generation = excluded.generation",
+                (tripetto_id, generation, etag, body, time.time()),
+            ).rowcount
+            self._writes += 1
+            # Evict the oldest entries every 100 writes
+            if self._writes % 100 == 0:
+                evicted = connection.execute(
+                    "DELETE FROM story_response WHERE tripetto_id IN ("
+                    "SELECT tripetto_id FROM story_response ORDER BY stored_at DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+                self.evictions += max(evicted, 0)
+            connection.commit()
+            return stored > 0
+
+    def invalidate(self, tripetto_id):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT INTO story_response VALUES (?, 1, NULL, NULL, ?) "
+                "ON CONFLICT (tripetto_id) DO UPDATE SET "
+                "generation = story_response.generation + 1, etag = NULL, body = NULL, "
+                "stored_at = excluded.stored_at",
+                (tripetto_id, time.time()),
+            )
+            connection.commit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": self._connect()
+                .execute("SELECT COUNT(*) FROM story_response WHERE body IS NOT NULL")
+                .fetchone()[0]
+            }
+
+
+class ResponseCache:
+    def __init__(self, backend, enabled=None):
+        """
+        :param backend: Where entries are kept, a MemoryResponseBackend or
+            SQLiteResponseBackend.
+        :param enabled: Whether lookups and stores happen at all.
+        """
+        self.backend = backend
+        self.enabled = (
+            config.get("RESPONSE_CACHE", "1") == "1" if enabled is None else enabled
+        )
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, tripetto_id, load):
+        """
+        Returns the ETag and body of an order's response, or None if there is no such
+        order.
+
+        :param load: Function returning the serialized response (str or bytes) from the
+            database, or None. Called only on a cache miss.
+        """
+        if not self.enabled:
+            body = load()
+            if body is None:
+                return None
+            body = body.encode() if isinstance(body, str) else body
+            return make_etag(body), body
+
+        try:
+            generation, entry = self.backend.lookup(tripetto_id)
+        except Exception as e:
+            logging.error(f"Error reading {self.backend.name} response cache: {e}")
+            generation, entry = None, None
+        if entry is not None:
+            self._count("hits")
+            return entry
+
+        self._count("misses")
+        body = load()
+        if body is None:
+            return None
+        body = body.encode() if isinstance(body, str) else body
+        etag = make_etag(body)
+        if generation is not None:
+            try:
+                if self.backend.store(tripetto_id, generation, etag, body):
+                    self._count("stores")
+            except Exception as e:
+                logging.error(f"Error writing {self.backend.name} response cache: {e}")
+        return etag, body
+
+    def invalidate(self, tripetto_id):
+        """
+        Drops the cached response of an order. Call it after the change is committed.
+        """
+        if not self.enabled:
+            return
+        try:
+            self.backend.invalidate(tripetto_id)
+            self._count("invalidations")
+        except Exception as e:
+            logging.error(f"Error invalidating {self.backend.name} response cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["evictions"] = self.backend.evictions
+        try:
+            stats.update(self.backend.stats())
+        except Exception as e:
+            logging.error(
+                f"Error reading {self.backend.name} response cache stats: {e}"
+            )
+        return stats
+
+
+def _backend_from_env():
+    path = config.get("RESPONSE_CACHE_PATH")
+    if path:
+        return SQLiteResponseBackend(
+            path, int(config.get("RESPONSE_CACHE_ENTRIES", "20000"))
+        )
+    return MemoryResponseBackend(
+        int(config.get("RESPONSE_CACHE_ENTRIES", "2048")),
+        int(config.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+        float(config.get("RESPONSE_CACHE_TTL", "5")),
+    )
+
+
+# Shared cache of /get-story-data responses
+response_cache = ResponseCache(_backend_from_env())
@@ -0,0 +1,81 @@
+"""
+This module coalesces identical in-flight calls, so concurrent orders with the same
+inputs share one upstream call.
+
+When several orders with the same child traits and style arrive together, each would
+otherwise run the same assistant call and render the same child image prompt. With
+``single_flight.run``, the first caller starts the call and later callers with the same
+key wait for its result instead. Only calls that are still running are shared; results
+are not kept afterwards, which is the caches' job.
+
+The shared call runs as a task of its own, so a caller that is cancelled does not cancel
+it for the others. It is cancelled once no caller is waiting for it any more.
+"""
+
+import asyncio
+import threading
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, namespace, name):
+        with self._lock:
+            entry = self._stats.setdefault(namespace, {"calls": 0, "coalesced": 0})
+            entry[name] += 1
+
+    async def run(self, namespace, key, func):
+        """
+        Returns the result of ``func()``, or of the identical call already in flight.
+
+        :param namespace: Kind of call, e.g. "child_image_prompt", used for metrics.
+        :param key: Hashable key of the call's inputs within the namespace.
+        :param func: Function returning the coroutine of the call.
+        """
+        flight_key = (asyncio.get_running_loop(), namespace, key)
+        flight = self._flights.get(flight_key)
+        if flight is None:
+            flight = _Flight(asyncio.create_task(func()))
+            self._flights[flight_key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(flight_key, flight))
+            self._count(namespace, "calls")
+        else:
+            self._count(namespace, "coalesced")
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def _finish(self, flight_key, flight):
+        if self._flights.get(flight_key) is flight:
+            del self._flights[flight_key]
+        # Waiters get the failure; this keeps it from being reported as never retrieved
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self):
+        with self._lock:
+            stats = {namespace: dict(entry) for namespace, entry in self._stats.items()}
+        for _, namespace, _ in list(self._flights):
+            stats.setdefault(namespace, {"calls": 0, "coalesced": 0})
+            stats[namespace]["in_flight"] = stats[namespace].get("in_flight", 0) + 1
+        for entry in stats.values():
+            entry.setdefault("in_flight", 0)
+        return stats
+
+
+# Shared by the assistant cache and the image generators
+single_flight = SingleFlight()
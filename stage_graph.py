@@ -0,0 +1,257 @@
+"""
+This module runs pipeline stages as a dependency graph.
+
+Every stage starts as soon as the stages and inputs it requires are available, so
+independent branches, such as the story and the child reference image, run at the same
+time. A stage whose output is already checkpointed is not run again, and a run can take
+over the still running or finished stages of an earlier run of the same order. After a
+run, ``critical_path`` names the chain of stages that determined its duration.
+
+A stage can also consume another stage's output while it is produced: the producer puts
+items in a ``Feed`` given as an input, and the consumer lists the producer in
+``overlaps`` so it starts together with it instead of after it.
+"""
+
+import asyncio
+import logging
+import time
+
+from telemetry import span
+
+
+class Stage:
+    def __init__(self, name, func, requires=(), checkpoint=None, overlaps=()):
+        """
+        :param name: Name of the stage, of its span, and of its output for dependent
+            stages.
+        :param func: Coroutine function called with the required outputs as keyword
+            arguments.
+        :param requires: Names of the stages and inputs this stage needs.
+        :param checkpoint: Checkpoint name under which the output is saved, or None to
+            not save it.
+        :param overlaps: Names of stages whose output this stage reads through a Feed
+            while they run. The stage starts once they have started.
+        """
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.checkpoint = checkpoint
+        self.overlaps = tuple(overlaps)
+
+    @property
+    def predecessors(self):
+        return self.requires + self.overlaps
+
+
+class Feed:
+    """
+    Items passed from a running stage to the stages that overlap it. Consumers iterate
+    it with ``async for`` until the producer closes it, and get the producer's error if
+    it fails.
+    """
+
+    def __init__(self, items=None):
+        """
+        :param items: Optional items of a feed that is complete from the start, e.g.
+            restored from a checkpoint.
+        """
+        self.items = list(items or ())
+        self.closed = items is not None
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def put(self, item):
+        self.items.append(item)
+        self._changed.set()
+
+    def close(self):
+        self.closed = True
+        self._changed.set()
+
+    def fail(self, error):
+        self.error = error
+        self.close()
+
+    async def __aiter__(self):
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                return
+            self._changed.clear()
+            await self._changed.wait()
+
+
+class StageGraph:
+    def __init__(self, stages):
+        self.stages = {stage.name: stage for stage in stages}
+
+    def _needed(self, targets, inputs):
+        # Stages given as inputs are not run, and neither are the stages only they
+        # depend on
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name in needed or name in inputs or name not in self.stages:
+                continue
+            needed.add(name)
+            pending.extend(self.stages[name].predecessors)
+        return needed
+
+    def start(self, inputs, checkpoints, targets=None, previous=None):
+        """
+        Starts the stages needed for ``targets`` (all stages by default) on the running
+        loop.
+
+        :param inputs: Values available from the start, by name. A stage given as an
+            input is not run.
+        :param checkpoints: Checkpoints consulted before running a stage and updated
+            after it.
+        :param previous: Optional earlier GraphRun of the same order whose stages are
+            taken over instead of being run again, unless they failed.
+        :return: A GraphRun.
+        """
+        run = GraphRun(self, inputs, checkpoints, previous)
+        for name in sorted(self._needed(targets or self.stages, inputs)):
+            run._task(name)
+        return run
+
+
+class GraphRun:
+    def __init__(self, graph, inputs, checkpoints, previous):
+        self.graph = graph
+        self.inputs = dict(inputs)
+        self.checkpoints = checkpoints
+        self.previous = previous
+        self.tasks = {}
+        # {stage: (started, finished, source)}, with source "run", "checkpoint" or
+        # "previous"
+        self.timings = {}
+        self.started_at = time.monotonic()
+        self._started = {}
+
+    def _task(self, name):
+        if name not in self.tasks:
+            task = asyncio.get_running_loop().create_task(self._run_stage(name))
+            # Failures are raised by wait() or result(); this keeps unawaited ones from
+            # being reported as never retrieved
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self.tasks[name] = task
+        return self.tasks[name]
+
+    def _started_event(self, name):
+        if name not in self._started:
+            self._started[name] = asyncio.Event()
+        return self._started[name]
+
+    async def _wait_started(self, name):
+        if name in self.inputs:
+            return
+        self._task(name)
+        await self._started_event(name).wait()
+
+    async def _value(self, name):
+        if name in self.inputs:
+            return self.inputs[name]
+        if name not in self.graph.stages:
+            raise KeyError(f"Missing pipeline input: {name}")
+        return await self._task(name)
+
+    async def _run_stage(self, name):
+        stage = self.graph.stages[name]
+        if stage.checkpoint:
+            value = self.checkpoints.get(stage.checkpoint)
+            if value is not None:
+                now = time.monotonic()
+                self.timings[name] = (now, now, "checkpoint")
+                self._started_event(name).set()
+                return value
+
+        previous_task = self.previous.tasks.get(name) if self.previous else None
+        if previous_task is not None:
+            self._started_event(name).set()
+            try:
+                value = await asyncio.shield(previous_task)
+            except asyncio.CancelledError:
+                if not previous_task.cancelled():
+                    raise
+            except Exception as e:
+                logging.warning(
+                    f"Stage {name} of the earlier run failed, running it again: {e}"
+                )
+            else:
+                self.timings[name] = (*self.previous.timings[name][:2], "previous")
+                if stage.checkpoint:
+                    await self.checkpoints.save(stage.checkpoint, value)
+                return value
+
+        requirements = dict(
+            zip(
+                stage.requires,
+                await asyncio.gather(
+                    *(self._value(required) for required in stage.requires)
+                ),
+            )
+        )
+        await asyncio.gather(
+            *(self._wait_started(overlapped) for overlapped in stage.overlaps)
+        )
+        self._started_event(name).set()
+        started = time.monotonic()
+        try:
+            with span(name):
+                value = await stage.func(**requirements)
+        finally:
+            self.timings[name] = (started, time.monotonic(), "run")
+        if stage.checkpoint:
+            await self.checkpoints.save(stage.checkpoint, value)
+        return value
+
+    async def result(self, name):
+        """
+        Waits for one stage and returns its output.
+        """
+        return await self._value(name)
+
+    async def wait(self):
+        """
+        Waits for every started stage and returns their outputs by name. When a stage
+        fails, the other stages are cancelled and its exception is raised.
+        """
+        try:
+            await asyncio.gather(*self.tasks.values())
+        except BaseException:
+            self.cancel()
+            raise
+        return {name: task.result() for name, task in self.tasks.items()}
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    def critical_path(self):
+        """
+        Returns the chain of stages that determined when the run finished, as a list of
+        ``(stage, seconds, source)`` in execution order.
+        """
+        if not self.timings:
+            return []
+        path = []
+        name = max(self.timings, key=lambda stage: self.timings[stage][1])
+        while name is not None:
+            started, finished, source = self.timings[name]
+            path.append((name, round(finished - started, 3), source))
+            predecessors = [
+                predecessor
+                for predecessor in self.graph.stages[name].predecessors
+                if predecessor in self.timings
+            ]
+            name = max(
+                predecessors, key=lambda stage: self.timings[stage][1], default=None
+            )
+        return path[::-1]
@@ -0,0 +1,242 @@
+"""
+This module contains the storage layer for orders: engine settings, schema migration and
+the story store used by the Flask views and the image jobs.
+
+SQLite databases run in WAL mode, so readers are not blocked by the job workers' writes,
+and every engine keeps a bounded connection pool. Page URIs are upserted one row per
+page as pages complete. The /get-story-data response is stored serialized, so reads are
+a single indexed lookup that parses nothing, and every write invalidates the copy held
+by the response cache.
+"""
+
+import logging
+import sqlite3
+from datetime import datetime
+
+import orjson
+from sqlalchemy import event, inspect, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+
+import config
+from models import StoryData, StoryPage, db
+
+POOL_SIZE = int(config.get("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(config.get("DB_MAX_OVERFLOW", "20"))
+POOL_RECYCLE = int(config.get("DB_POOL_RECYCLE", "1800"))
+SQLITE_BUSY_TIMEOUT = float(config.get("DB_SQLITE_BUSY_TIMEOUT", "30"))
+
+
+@event.listens_for(Engine, "connect")
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # WAL makes NORMAL durable against application crashes at a fraction of the fsyncs
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def engine_options(database_url):
+    """
+    Returns SQLALCHEMY_ENGINE_OPTIONS for a database URL. Set them before
+    ``db.init_app``.
+    """
+    options = {"pool_size": POOL_SIZE, "max_overflow": MAX_OVERFLOW}
+    if database_url.startswith("sqlite"):
+        if database_url in ("sqlite://", "sqlite:///:memory:"):
+            return {}
+        options["connect_args"] = {
+            "timeout": SQLITE_BUSY_TIMEOUT,
+            "check_same_thread": False,
+        }
+    else:
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = POOL_RECYCLE
+    return options
+
+
+def migrate():
+    """
+    Creates missing tables, then adds the columns and indexes that existing tables lack.
+    Must be called within an app context.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(
+                    text(
+                        f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'
+                    )
+                )
+            logging.info("Added column %s.%s", table.name, column.name)
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+class StoryStore:
+    def __init__(self, app, response_cache=None):
+        """
+        :param app: Flask app whose database stores the stories.
+        :param response_cache: Optional ResponseCache invalidated on every write to an
+            order.
+        """
+        self.app = app
+        self.response_cache = response_cache
+
+    def _invalidate(self, tripetto_id):
+        if self.response_cache is not None:
+            self.response_cache.invalidate(tripetto_id)
+
+    def create(
+        self,
+        tripetto_id,
+        order,
+        story_configuration,
+        visual_configuration,
+        story,
+        status,
+    ):
+        """
+        Stores a new order. Must be called within an app context.
+        """
+        db.session.add(
+            StoryData(
+                tripettoId=tripetto_id,
+                order=order,
+                story_configuration=story_configuration,
+                visual_configuration=visual_configuration,
+                story=story,
+                image_urls=[],
+                status=status,
+            )
+        )
+        db.session.commit()
+        self._invalidate(tripetto_id)
+
+    def exists(self, tripetto_id):
+        """
+        Must be called within an app context.
+        """
+        return (
+            db.session.query(StoryData.id).filter_by(tripettoId=tripetto_id).first()
+            is not None
+        )
+
+    def update(self, tripetto_id, **fields):
+        """
+        Updates columns of an order and drops its serialized response.
+        """
+        with self.app.app_context():
+            db.session.query(StoryData).filter_by(tripettoId=tripetto_id).update(
+                {**fields, "response_json": None, "updated_at": datetime.utcnow()}
+            )
+            db.session.commit()
+        self._invalidate(tripetto_id)
+
+    def save_page(self, tripetto_id, label, uri):
+        """
+        Inserts or replaces the image URI of one page in a single statement, so pages
+        finishing at the same time never overwrite each other.
+        """
+        values = {
+            "tripettoId": tripetto_id,
+            "label": label,
+            "uri": uri,
+            "updated_at": datetime.utcnow(),
+        }
+        with self.app.app_context():
+            dialect = db.engine.dialect.name
+            if dialect in ("sqlite", "postgresql"):
+                insert = sqlite_insert if dialect == "sqlite" else postgresql_insert
+                statement = insert(StoryPage).values(**values)
+                db.session.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=["tripettoId", "label"],
+                        set_={"uri": uri, "updated_at": values["updated_at"]},
+                    )
+                )
+            else:
+                updated = (
+                    db.session.query(StoryPage)
+                    .filter_by(tripettoId=tripetto_id, label=label)
+                    .update({"uri": uri, "updated_at": values["updated_at"]})
+                )
+                if not updated:
+                    db.session.add(StoryPage(**values))
+            db.session.query(StoryData).filter_by(tripettoId=tripetto_id).update(
+                {"response_json": None, "updated_at": values["updated_at"]}
+            )
+            db.session.commit()
+        self._invalidate(tripetto_id)
+
+    def pages(self, tripetto_id):
+        """
+        Returns the page URIs of an order by page label. Must be called within an app
+        context.
+        """
+        pages = dict(
+            db.session.query(StoryPage.label, StoryPage.uri)
+            .filter_by(tripettoId=tripetto_id)
+            .order_by(StoryPage.label)
+        )
+        image_urls = (
+            db.session.query(StoryData.image_urls)
+            .filter_by(tripettoId=tripetto_id)
+            .scalar()
+        )
+        # Books from before pages were stored in StoryPage keep them in image_urls
+        if isinstance(image_urls, dict):
+            return {**image_urls, **pages}
+        return pages
+
+    def response(self, tripetto_id):
+        """
+        Returns the serialized /get-story-data response of an order, or None if there is
+        no such order. The response is built and stored on the first read after each
+        change. Must be called within an app context.
+        """
+        row = (
+            db.session.query(StoryData.id, StoryData.response_json)
+            .filter_by(tripettoId=tripetto_id)
+            .first()
+        )
+        if row is None:
+            return None
+        if row.response_json is not None:
+            return row.response_json
+
+        story_data = db.session.get(StoryData, row.id)
+        image_urls = self.pages(tripetto_id) or story_data.image_urls
+        response_json = orjson.dumps(
+            {
+                "tripettoId": tripetto_id,
+                "order": story_data.order,
+                "story_configuration": story_data.story_configuration,
+                "visual_configuration": story_data.visual_configuration,
+                "story": story_data.story,
+                "image_urls": image_urls,
+            },
+            option=orjson.OPT_SORT_KEYS,
+        ).decode()
+        # Only store the response if nothing changed the order while it was being built
+        db.session.query(StoryData).filter_by(
+            id=row.id, response_json=None, updated_at=story_data.updated_at
+        ).update(
+            {"response_json": response_json, "updated_at": story_data.updated_at},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return response_json
@@ -0,0 +1,371 @@
+"""
+This module records tracing spans and per-stage latency histograms for the pipeline.
+
+Spans nest through a context variable, so spans opened by tasks that a stage starts
+become children of that stage. Finished spans are kept in a bounded in-memory buffer and
+can also be appended to a JSON-lines file. Their durations feed Prometheus-style
+histograms, which ``render_metrics`` exposes together with the counters of the other
+modules.
+"""
+
+import contextvars
+import logging
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import orjson
+
+import config
+
+# Stages range from sub-second API calls to orders that take tens of minutes
+DEFAULT_BUCKETS = (
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+    1200,
+    1800,
+)
+
+TRACE_EXPORT_PATH = config.get("TRACE_EXPORT_PATH", "")
+TRACE_BUFFER_SIZE = int(config.get("TRACE_BUFFER_SIZE", "2000"))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Histogram:
+    """
+    Cumulative histogram with labels, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name, description, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # {label values: [bucket counts..., +Inf count, sum]}
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.setdefault(
+                tuple(label_values), [0] * (len(self.buckets) + 1) + [0.0]
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def quantile(self, q, *label_values):
+        """
+        Estimates a quantile from the buckets, as Prometheus' histogram_quantile does.
+        """
+        with self._lock:
+            series = self._series.get(tuple(label_values))
+            if not series:
+                return None
+            series = list(series)
+        total = series[len(self.buckets)]
+        rank = q * total
+        lower_bound, lower_count = 0.0, 0
+        for index, bound in enumerate(self.buckets):
+            if series[index] >= rank:
+                in_bucket = series[index] - lower_count
+                if not in_bucket:
+                    return bound
+                return (
+                    lower_bound
+                    + (bound - lower_bound) * (rank - lower_count) / in_bucket
+                )
+            lower_bound, lower_count = bound, series[index]
+        return self.buckets[-1]
+
+    def summary(self):
+        """
+        Returns the count, p50 and p95 of every label combination.
+        """
+        with self._lock:
+            counts = {
+                labels: series[len(self.buckets)]
+                for labels, series in self._series.items()
+            }
+        return {
+            labels: {
+                "count": count,
+                "p50": self.quantile(0.5, *labels),
+                "p95": self.quantile(0.95, *labels),
+            }
+            for labels, count in sorted(counts.items())
+        }
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = _format_labels(zip(self.label_names, label_values))
+            for index, bound in enumerate(self.buckets):
+                bucket_labels = _format_labels(
+                    [
+                        *zip(self.label_names, label_values),
+                        ("le", _format_number(bound)),
+                    ]
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {values[index]}")
+            inf_labels = _format_labels(
+                [*zip(self.label_names, label_values), ("le", "+Inf")]
+            )
+            lines.append(f"{self.name}_bucket{inf_labels} {values[len(self.buckets)]}")
+            lines.append(f"{self.name}_sum{labels} {_format_number(values[-1])}")
+            lines.append(f"{self.name}_count{labels} {values[len(self.buckets)]}")
+        return lines
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+stage_latency = Histogram(
+    "lsw_stage_duration_seconds",
+    "Duration of pipeline stages and API calls.",
+    ("stage", "status"),
+)
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        # The order id is inherited so every span of an order can be looked up by it
+        self.tripetto_id = attributes.pop("tripettoId", None) or (
+            parent.tripetto_id if parent else None
+        )
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.status = "ok"
+        self.error = None
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "tripettoId": self.tripetto_id,
+            "start": self.started_at,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter:
+    def __init__(self, path=None, buffer_size=None):
+        """
+        :param path: Optional JSON-lines file that finished spans are appended to.
+        :param buffer_size: Number of recent spans kept in memory.
+        """
+        self.path = path
+        self.recent = deque(maxlen=buffer_size or TRACE_BUFFER_SIZE)
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def export(self, span):
+        record = span.to_dict()
+        with self._lock:
+            self.recent.append(record)
+        if not self.path:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def spans(self, tripetto_id=None, trace_id=None):
+        with self._lock:
+            records = list(self.recent)
+        return [
+            record
+            for record in records
+            if (tripetto_id is None or record["tripettoId"] == tripetto_id)
+            and (trace_id is None or record["trace_id"] == trace_id)
+        ]
+
+    def _ensure_started(self):
+        # Spans are written by a background thread so the event loop never blocks on the
+        # file
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=10000)
+            self._thread = threading.Thread(
+                target=self._run, name="span-exporter", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while not self._queue.empty() and len(records) < 500:
+                records.append(self._queue.get_nowait())
+            try:
+                with open(self.path, "ab") as trace_file:
+                    trace_file.write(
+                        b"".join(
+                            orjson.dumps(record, default=str) + b"\n"
+                            for record in records
+                        )
+                    )
+            except Exception as e:
+                logging.warning(f"Failed to export {len(records)} spans: {e}")
+
+
+exporter = SpanExporter(TRACE_EXPORT_PATH)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times a block as a span named ``name``, nested under the current span.
+
+    Pass ``tripettoId`` to tag the span and its children with an order.
+    """
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    started = time.monotonic()
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.error = str(e) or type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration = time.monotonic() - started
+        stage_latency.observe(current.duration, name, current.status)
+        exporter.export(current)
+
+
+def current_span():
+    return _current_span.get()
+
+
+_collectors = []
+
+
+def register_collector(prefix, collect, label=None):
+    """
+    Adds the counters of another module to the metrics output.
+
+    :param prefix: Metric name prefix, e.g. "http_pool".
+    :param collect: Function returning a dict of numeric values, or with ``label`` a
+        dict of such dicts keyed by the label value. Nested dicts are flattened into the
+        metric name.
+    :param label: Label name for the keys of the outer dict.
+    """
+    _collectors.append((prefix, collect, label))
+
+
+def _flatten(values, prefix=""):
+    for key, value in values.items():
+        name = f"{prefix}_{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)) and math.isfinite(value):
+            yield name, value
+
+
+def _metric_name(*parts):
+    name = "_".join(str(part) for part in parts if part)
+    return "".join(char if char.isalnum() or char == "_" else "_" for char in name)
+
+
+def render_metrics():
+    """
+    Returns every histogram and collector in the Prometheus text exposition format.
+    """
+    lines = stage_latency.render()
+    for prefix, collect, label in _collectors:
+        try:
+            values = collect()
+        except Exception as e:
+            logging.warning(f"Failed to collect {prefix} metrics: {e}")
+            continue
+        samples = {}
+        if label:
+            for label_value, series in values.items():
+                if isinstance(series, dict):
+                    for name, value in _flatten(series):
+                        samples.setdefault(name, []).append(
+                            ({label: label_value}, value)
+                        )
+        else:
+            for name, value in _flatten(values):
+                samples.setdefault(name, []).append(({}, value))
+        for name, series in sorted(samples.items()):
+            metric = _metric_name("lsw", prefix, name)
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, value in series:
+                lines.append(
+                    f"{metric}{_format_labels(labels.items())} {_format_number(value)}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def stage_summary():
+    """
+    Returns the count, p50 and p95 of every span name that finished successfully.
+    """
+    return {
+        stage: values
+        for (stage, status), values in stage_latency.summary().items()
+        if status == "ok"
+    }
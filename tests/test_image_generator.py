@@ -0,0 +1,230 @@
+"""
+Tests of the concurrent renderer against a local fake ImaginePro server with injected
+latency.
+"""
+
+import asyncio
+import itertools
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import http_pool
+from image_generator import ImageGenerator
+from image_status import status_tracker
+
+# Seconds added to every request, and taken by an upscale
+LATENCY = 0.01
+UPSCALE_SECONDS = 0.02
+
+
+class FakeImaginePro:
+    """
+    Renders a prompt "<name> <seconds>" in that many seconds, and counts the renders in
+    flight from the imagine request until the upscaled image is fetched, per API key and
+    in total.
+    """
+
+    def __init__(self):
+        self.messages = {}
+        self.active = {}
+        self.peak = {}
+        self.active_total = 0
+        self.peak_total = 0
+        self.imagined = []
+        self._ids = itertools.count()
+        self.app = web.Application(middlewares=[self._latency])
+        self.app.router.add_post("/imagine", self.imagine)
+        self.app.router.add_post("/button", self.button)
+        self.app.router.add_get("/message/{message_id}", self.message)
+
+    @web.middleware
+    async def _latency(self, request, handler):
+        await asyncio.sleep(LATENCY)
+        return await handler(request)
+
+    def _add_message(self, **message):
+        message_id = f"m{next(self._ids)}"
+        self.messages[message_id] = message
+        return message_id
+
+    async def imagine(self, request):
+        key = request.headers["Authorization"]
+        prompt = (await request.json())["prompt"]
+        self.imagined.append(prompt)
+        self.active[key] = self.active.get(key, 0) + 1
+        self.peak[key] = max(self.peak.get(key, 0), self.active[key])
+        self.active_total += 1
+        self.peak_total = max(self.peak_total, self.active_total)
+        seconds = float(prompt.split()[-1])
+        message_id = self._add_message(
+            key=key, prompt=prompt, ready_at=asyncio.get_running_loop().time() + seconds
+        )
+        return web.json_response({"messageId": message_id})
+
+    async def button(self, request):
+        grid = self.messages[(await request.json())["messageId"]]
+        message_id = self._add_message(
+            key=grid["key"],
+            prompt=grid["prompt"],
+            ready_at=asyncio.get_running_loop().time() + UPSCALE_SECONDS,
+            upscale=True,
+        )
+        return web.json_response({"messageId": message_id})
+
+    async def message(self, request):
+        message_id = request.match_info["message_id"]
+        message = self.messages[message_id]
+        if asyncio.get_running_loop().time() < message["ready_at"]:
+            return web.json_response(
+                {"messageId": message_id, "status": "PROCESSING", "progress": 50}
+            )
+        if message.get("upscale") and not message.get("fetched"):
+            message["fetched"] = True
+            self.active[message["key"]] -= 1
+            self.active_total -= 1
+        return web.json_response(
+            {
+                "messageId": message_id,
+                "status": "DONE",
+                "progress": 100,
+                "uri": f"https://images.test/{message['prompt'].split()[0]}",
+            }
+        )
+
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    for name in ("RPS", "BURST", "KEY_RPS", "KEY_BURST"):
+        monkeypatch.setenv(f"RATE_LIMIT_IMAGINEPRO_{name}", "1000")
+    monkeypatch.setenv("MID_WEBHOOK_URL", "")
+    monkeypatch.setattr(status_tracker, "push_enabled", False)
+    monkeypatch.setattr(status_tracker, "initial_interval", 0.01)
+    monkeypatch.setattr(status_tracker, "min_interval", 0.01)
+    monkeypatch.setattr(status_tracker, "max_interval", 0.02)
+
+
+async def _serve(test):
+    fake = FakeImaginePro()
+    server = TestServer(fake.app)
+    await server.start_server()
+    try:
+        return await test(fake, str(server.make_url("")))
+    finally:
+        await http_pool.close()
+        await server.close()
+
+
+def run(test):
+    return asyncio.run(_serve(test))
+
+
+def test_images_are_returned_in_page_order():
+    # Later pages finish first
+    prompts = [f"page{index} {0.2 - index * 0.04:.2f}" for index in range(5)]
+
+    async def test(fake, base_url):
+        generator = ImageGenerator("key", base_url=base_url, max_concurrency=5)
+        return await generator.generate_images(prompts)
+
+    image_uris = run(test)
+    assert image_uris == [f"https://images.test/page{index}" for index in range(5)]
+
+
+def test_per_key_limit_holds():
+    prompts = [f"page{index} 0.05" for index in range(8)]
+
+    async def test(fake, base_url):
+        generator = ImageGenerator("key", base_url=base_url, max_concurrency=2)
+        image_uris = await generator.generate_images(prompts)
+        return fake, image_uris
+
+    fake, image_uris = run(test)
+    assert all(image_uris)
+    assert fake.peak["Bearer key"] == 2
+
+
+def test_per_key_limit_follows_each_generator():
+    async def test(fake, base_url):
+        peaks = []
+        for max_concurrency in (1, 3):
+            generator = ImageGenerator(
+                "key", base_url=base_url, max_concurrency=max_concurrency
+            )
+            await generator.generate_images(
+                [f"limit{max_concurrency}-{index} 0.05" for index in range(6)]
+            )
+            peaks.append(fake.peak.pop("Bearer key"))
+        return peaks
+
+    assert run(test) == [1, 3]
+
+
+def test_global_limit_holds_across_keys(monkeypatch):
+    monkeypatch.setenv("MID_GLOBAL_MAX_CONCURRENCY", "3")
+
+    async def test(fake, base_url):
+        generators = [
+            ImageGenerator(key, base_url=base_url, max_concurrency=2)
+            for key in ("a", "b")
+        ]
+        return fake, await asyncio.gather(
+            *(
+                generator.generate_images([f"{key}{index} 0.05" for index in range(4)])
+                for key, generator in zip(("a", "b"), generators)
+            )
+        )
+
+    fake, results = run(test)
+    assert all(all(image_uris) for image_uris in results)
+    assert fake.peak_total == 3
+    assert max(fake.peak.values()) <= 2
+
+
+def test_on_result_fires_once_per_page_as_it_finishes():
+    prompts = [f"page{index} {0.3 - index * 0.1:.1f}" for index in range(3)]
+    reported = []
+
+    async def test(fake, base_url):
+        loop = asyncio.get_running_loop()
+
+        async def on_result(index, image_uri):
+            reported.append((index, image_uri, loop.time()))
+
+        generator = ImageGenerator("key", base_url=base_url, max_concurrency=3)
+        await generator.generate_images(prompts, on_result=on_result)
+        return loop.time()
+
+    finished_at = run(test)
+    assert [index for index, _, _ in reported] == [2, 1, 0]
+    assert all(
+        image_uri == f"https://images.test/page{index}"
+        for index, image_uri, _ in reported
+    )
+    # The fastest page is reported well before the slowest one is done
+    assert finished_at - reported[0][2] > 0.1
+
+
+def test_stream_renders_prompts_as_they_arrive():
+    imagined_before_last_prompt = []
+    reported = []
+
+    async def test(fake, base_url):
+        async def prompts():
+            for index in range(3):
+                yield f"page{index} 0.05"
+                await asyncio.sleep(0.15)
+            imagined_before_last_prompt.extend(fake.imagined)
+            yield "page3 0.05"
+
+        def on_result(index, image_uri):
+            reported.append(index)
+
+        generator = ImageGenerator("key", base_url=base_url, max_concurrency=2)
+        return await generator.generate_image_stream(prompts(), on_result=on_result)
+
+    image_uris = run(test)
+    assert image_uris == [f"https://images.test/page{index}" for index in range(4)]
+    assert len(imagined_before_last_prompt) == 3
+    assert sorted(reported) == [0, 1, 2, 3]
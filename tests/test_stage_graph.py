@@ -0,0 +1,70 @@
+"""
+Tests of the stage graph's handling of stages whose output is given as an input.
+"""
+
+import asyncio
+
+from job_queue import Checkpoints
+from stage_graph import Feed, Stage, StageGraph
+
+
+def test_stage_given_as_input_does_not_run():
+    calls = []
+
+    async def configuration():
+        calls.append("configuration")
+        return "configuration"
+
+    async def story(configuration):
+        calls.append("story")
+        return "generated story"
+
+    async def pages(story):
+        calls.append("pages")
+        return f"pages of {story}"
+
+    graph = StageGraph(
+        [
+            Stage("configuration", configuration),
+            Stage("story", story, ("configuration",)),
+            Stage("pages", pages, ("story",)),
+        ]
+    )
+
+    async def run():
+        graph_run = graph.start(
+            {"story": "given story"}, Checkpoints(), targets=["pages"]
+        )
+        return await graph_run.wait()
+
+    outputs = asyncio.run(run())
+    # Neither the story nor the stage only it depends on runs
+    assert calls == ["pages"]
+    assert outputs == {"pages": "pages of given story"}
+
+
+def test_overlapped_stage_given_as_input_does_not_run():
+    calls = []
+
+    async def prompts(feed):
+        calls.append("prompts")
+        feed.put("generated prompt")
+        feed.close()
+
+    async def pages(feed):
+        return [prompt async for prompt in feed]
+
+    graph = StageGraph(
+        [
+            Stage("prompts", prompts, ("feed",)),
+            Stage("pages", pages, ("feed",), overlaps=("prompts",)),
+        ]
+    )
+
+    async def run():
+        inputs = {"prompts": ["given prompt"], "feed": Feed(["given prompt"])}
+        return await graph.start(inputs, Checkpoints()).wait()
+
+    outputs = asyncio.run(run())
+    assert calls == []
+    assert outputs == {"pages": ["given prompt"]}
@@ -0,0 +1,414 @@
+"""
+This module records the service's outbound HTTP traffic to a cassette file and replays
+it, so the orchestration can be profiled offline, without network access or API credits.
+
+With TRAFFIC_MODE=record, requests go out as usual and every exchange is appended to
+TRAFFIC_CASSETTE: the request, the response status and headers, and the body in the
+chunks it arrived in, with their timing. With TRAFFIC_MODE=replay, requests are answered
+from the cassette and nothing is sent. TRAFFIC_REPLAY_SPEED scales the recorded timing:
+1 replays it as recorded, 0.1 ten times faster, and 0 answers at once. Streamed
+responses, such as assistant runs, are replayed chunk by chunk.
+
+OpenAI calls are covered by the httpx transport returned by ``transport``, and
+ImaginePro and littlestorywriter.com calls by the aiohttp session wrapper returned by
+``wrap_session``. The synchronous webhook logger is not covered; leave WEBHOOK_URL empty
+when replaying.
+
+Cassettes are gzip-compressed JSON lines, one exchange per line. A request is answered
+with the next unused exchange of the same method, URL and body. When the body differs,
+e.g. for a randomly picked upscale button or another order's content, the next unused
+exchange of the same method and URL is used. Once those run out, the last one is
+repeated, so extra status polls get the final status.
+"""
+
+import asyncio
+import atexit
+import base64
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import httpx
+import orjson
+
+import config
+
+MODES = ("off", "record", "replay")
+
+# Response headers that describe the recorded transfer rather than the response
+SKIPPED_HEADERS = {
+    "content-length",
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+    "date",
+}
+
+
+class CassetteMiss(ConnectionError):
+    """
+    Raised in replay mode for a request that has no recorded exchange.
+    """
+
+
+def _body_hash(body):
+    return hashlib.sha1(body or b"").hexdigest()[:16]
+
+
+def _encode(chunk):
+    try:
+        return chunk.decode()
+    except UnicodeDecodeError:
+        return {"b64": base64.b64encode(chunk).decode()}
+
+
+def _decode(chunk):
+    if isinstance(chunk, dict):
+        return base64.b64decode(chunk["b64"])
+    return chunk.encode()
+
+
+class Cassette:
+    def __init__(self, path, speed=1.0):
+        """
+        :param path: Cassette file, appended to when recording.
+        :param speed: Factor applied to the recorded timing when replaying.
+        """
+        self.path = path
+        self.speed = speed
+        self.stats = {
+            "recorded": 0,
+            "replayed": 0,
+            "fallbacks": 0,
+            "repeats": 0,
+            "misses": 0,
+        }
+        self._lock = threading.Lock()
+        self._file = None
+        self._exchanges = None
+        self._used = set()
+        self._by_body = defaultdict(deque)
+        self._by_url = defaultdict(deque)
+        self._last = {}
+
+    def record(self, method, url, body, status, headers, latency, chunks):
+        """
+        Appends an exchange. ``chunks`` is a list of ``(seconds after the headers,
+        bytes)``.
+        """
+        exchange = {
+            "method": method,
+            "url": url,
+            "body": _body_hash(body),
+            "status": status,
+            "headers": [
+                [name, value]
+                for name, value in headers
+                if name.lower() not in SKIPPED_HEADERS
+            ],
+            "latency": round(latency, 4),
+            "chunks": [[round(offset, 4), _encode(chunk)] for offset, chunk in chunks],
+        }
+        line = orjson.dumps(exchange) + b"\n"
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, "ab")
+            self._file.write(line)
+            # Each exchange is written out, so an interrupted recording stays readable
+            self._file.flush()
+            self.stats["recorded"] += 1
+
+    def _load(self):
+        exchanges = []
+        if os.path.exists(self.path):
+            with gzip.open(self.path, "rb") as cassette_file:
+                try:
+                    for line in cassette_file:
+                        if line.strip():
+                            exchanges.append(orjson.loads(line))
+                except (EOFError, orjson.JSONDecodeError):
+                    # A recording that was not closed ends without a gzip trailer, or
+                    # mid-line
+                    logging.warning("Cassette %s is truncated", self.path)
+        for index, exchange in enumerate(exchanges):
+            url_key = (exchange["method"], exchange["url"])
+            self._by_body[(*url_key, exchange["body"])].append(index)
+            self._by_url[url_key].append(index)
+            self._last[url_key] = index
+        self._exchanges = exchanges
+        logging.info("Loaded %d exchanges from cassette %s", len(exchanges), self.path)
+
+    def match(self, method, url, body):
+        """
+        Returns the recorded exchange answering a request.
+
+        :raises CassetteMiss: If the method and URL were never recorded.
+        """
+        url_key = (method, url)
+        with self._lock:
+            if self._exchanges is None:
+                self._load()
+            for queue, counter in (
+                (self._by_body[(*url_key, _body_hash(body))], "replayed"),
+                (self._by_url[url_key], "fallbacks"),
+            ):
+                while queue and queue[0] in self._used:
+                    queue.popleft()
+                if queue:
+                    index = queue.popleft()
+                    self._used.add(index)
+                    self.stats[counter] += 1
+                    return self._exchanges[index]
+            if url_key in self._last:
+                self.stats["repeats"] += 1
+                return self._exchanges[self._last[url_key]]
+            self.stats["misses"] += 1
+        raise CassetteMiss(f"No recorded exchange for {method} {url} in {self.path}")
+
+    async def chunks(self, exchange):
+        """
+        Yields the body chunks of an exchange at their recorded pace.
+        """
+        previous = 0.0
+        for offset, chunk in exchange["chunks"]:
+            if self.speed and offset > previous:
+                await asyncio.sleep((offset - previous) * self.speed)
+            previous = offset
+            yield _decode(chunk)
+
+    async def wait_latency(self, exchange):
+        if self.speed:
+            await asyncio.sleep(exchange["latency"] * self.speed)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    def __init__(self, cassette, request, response, started, received):
+        self._cassette = cassette
+        self._request = request
+        self._response = response
+        self._started = started
+        self._received = received
+        self._chunks = []
+
+    async def __aiter__(self):
+        async for chunk in self._response.aiter_raw():
+            self._chunks.append((time.monotonic() - self._received, chunk))
+            yield chunk
+
+    async def aclose(self):
+        await self._response.aclose()
+        self._cassette.record(
+            self._request.method,
+            str(self._request.url),
+            self._request.content,
+            self._response.status_code,
+            self._response.headers.multi_items(),
+            self._received - self._started,
+            self._chunks,
+        )
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, cassette, exchange):
+        self._cassette = cassette
+        self._exchange = exchange
+
+    async def __aiter__(self):
+        async for chunk in self._cassette.chunks(self._exchange):
+            yield chunk
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport that records the exchanges of another transport, or replays them.
+    """
+
+    def __init__(self, cassette, mode, transport=None):
+        self.cassette = cassette
+        self.mode = mode
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        body = await request.aread()
+        if self.mode == "replay":
+            exchange = self.cassette.match(request.method, str(request.url), body)
+            await self.cassette.wait_latency(exchange)
+            return httpx.Response(
+                exchange["status"],
+                headers=exchange["headers"],
+                stream=_ReplayStream(self.cassette, exchange),
+                request=request,
+            )
+        started = time.monotonic()
+        response = await self._transport.handle_async_request(request)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(
+                self.cassette, request, response, started, time.monotonic()
+            ),
+            extensions=response.extensions,
+            request=request,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class CassetteResponse:
+    """
+    The parts of an aiohttp response that the service reads, backed by a recorded
+    exchange.
+    """
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self._body = body
+
+    async def read(self):
+        return self._body
+
+    async def text(self, encoding="utf-8"):
+        return self._body.decode(encoding)
+
+    async def json(self, **kwargs):
+        return orjson.loads(self._body) if self._body else None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class CassetteSession:
+    """
+    Wraps an aiohttp session so that requests made with ``request``, ``get`` and
+    ``post`` are recorded or replayed. Everything else is passed to the session.
+    """
+
+    def __init__(self, session, cassette, mode):
+        self._session = session
+        self.cassette = cassette
+        self.mode = mode
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        return _SessionRequest(self, method, str(url), kwargs)
+
+
+class _SessionRequest:
+    def __init__(self, session, method, url, kwargs):
+        self._session = session
+        self._method = method
+        self._url = url
+        self._kwargs = kwargs
+
+    def _body(self):
+        if self._kwargs.get("json") is not None:
+            return orjson.dumps(self._kwargs["json"], option=orjson.OPT_SORT_KEYS)
+        data = self._kwargs.get("data")
+        return data.encode() if isinstance(data, str) else data
+
+    async def __aenter__(self):
+        cassette = self._session.cassette
+        if self._session.mode == "replay":
+            exchange = cassette.match(self._method, self._url, self._body())
+            await cassette.wait_latency(exchange)
+            body = b"".join([chunk async for chunk in cassette.chunks(exchange)])
+            headers = {name: value for name, value in exchange["headers"]}
+            return CassetteResponse(exchange["status"], headers, body)
+
+        started = time.monotonic()
+        async with self._session._session.request(
+            self._method, self._url, **self._kwargs
+        ) as response:
+            received = time.monotonic()
+            body = await response.read()
+            cassette.record(
+                self._method,
+                self._url,
+                self._body(),
+                response.status,
+                list(response.headers.items()),
+                received - started,
+                [(time.monotonic() - received, body)],
+            )
+            return CassetteResponse(response.status, response.headers, body)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+_lock = threading.Lock()
+_cassette = None
+
+
+def mode():
+    value = config.get("TRAFFIC_MODE", "off")
+    if value not in MODES:
+        raise ValueError(f"Unknown traffic mode: {value}")
+    return value
+
+
+def cassette():
+    """
+    Returns the cassette of this process, or None when TRAFFIC_MODE is off.
+    """
+    global _cassette
+    if mode() == "off":
+        return None
+    if _cassette is None:
+        with _lock:
+            if _cassette is None:
+                _cassette = Cassette(
+                    config.get("TRAFFIC_CASSETTE", "traffic.jsonl.gz"),
+                    float(config.get("TRAFFIC_REPLAY_SPEED", "1")),
+                )
+                atexit.register(_cassette.close)
+    return _cassette
+
+
+def transport(inner=None):
+    """
+    Returns an httpx transport for outbound API calls, recording or replaying per
+    TRAFFIC_MODE.
+    """
+    current = cassette()
+    if current is None:
+        return inner or httpx.AsyncHTTPTransport()
+    return CassetteTransport(current, mode(), inner)
+
+
+def wrap_session(session):
+    """
+    Returns an aiohttp session that records or replays per TRAFFIC_MODE, or ``session``
+    itself.
+    """
+    current = cassette()
+    if current is None:
+        return session
+    return CassetteSession(session, current, mode())
+
+
+def stats():
+    return dict(_cassette.stats) if _cassette is not None else {}